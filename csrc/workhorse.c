@@ -4,18 +4,47 @@
 #include <stdio.h>
 #include <signal.h>
 #include <stdarg.h>
+#include <sys/stat.h>
 
 #include "gz/miniz.c"
 
 #ifdef _WIN32 // 32/64 bit windows
 #pragma message ( "*** compiling for windows ***" )
 #include <windows.h>
+#else
+#include <sys/time.h>
+#include <sys/mman.h>
+#include <fcntl.h>
+#include <unistd.h>
 #endif
 
 #define SCANBUFSIZE (1024*1024)
 #define MIN(A,B) (A<B?A:B)
 #define MAX(A,B) (A>B?A:B)
 
+#ifdef __GNUC__
+#define popcount64(x) __builtin_popcountll(x)
+#define ctz64(x) __builtin_ctzll(x)
+#define load_relaxed(x) __atomic_load_n(&(x), __ATOMIC_RELAXED)
+#define store_relaxed(x, v) __atomic_store_n(&(x), (v), __ATOMIC_RELAXED)
+#else
+#define load_relaxed(x) (x)
+#define store_relaxed(x, v) ((x) = (v))
+int popcount64(unsigned long long x)
+{
+    x = x - ((x >> 1) & 0x5555555555555555ULL);
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+    x = (x + (x >> 4)) & 0x0F0F0F0F0F0F0F0FULL;
+    return (int) ((x * 0x0101010101010101ULL) >> 56);
+}
+int ctz64(unsigned long long x)
+{
+    int i;
+    for(i=0; !(x & 1); i++, x>>=1);
+    return i;
+}
+#endif
+
 
 #if 0
 #define DBG(fmt, ...) fprintf(stderr, fmt "\n", __VA_ARGS__)
@@ -26,23 +55,88 @@
 
 /* data structures {{{1 */
 
-typedef struct ll_item_ {
+struct hit {
     int seqi;
-    long fpos;
+    long long fpos; // (long has only 32 bits on LLP64, see FILE_POS_BITS)
     int spos;
     int length;
     int readlength;
-    struct ll_item_ *next;
-} ll_item;
+    size_t seq; // offset of hit sequence in hits->seqs
+};
+
+struct hits { // found by one thread
+    struct hit *items;
+    long n, size;
+    long counted; // number of hits added to threadstats seqhits, seqbasehits
+    char *seqs; // all hit sequences
+    size_t seqs_n, seqs_size;
+    const struct covmap *cov; // accumulate bases instead of hits if set
+    unsigned int *bases; // per position of all coverages : A,C,G,T,N
+    long *counts; // per sequence : hits, bases not yet added to globals
+    char *covdirty; // per coverage : bases counted since last batch
+    int *touched; // coverages with bases counted since last batch
+    int ntouched;
+    int compact; // batch : bases only contains the touched coverages
+    struct batches *batches; // hand over hits to findseqs_iter() if set
+    long nbatch; // hits added since last batch was handed over
+};
+
+struct batches { // queue of hits handed over to findseqs_iter()
+    struct hits *items; // ring buffer of size items
+    int size, head, n;
+    long batchsize; // minimum number of hits per batch
+    int running; // scanning threads that did not yet finish
+    int closed; // batches are discarded (iterator was abandoned)
+    pthread_mutex_t mutex;
+    pthread_cond_t put, got;
+};
+
+struct covmap { // maps sequences onto coverages
+    int n; // number of coverages
+    int nseqs;
+    long *offsets; // n+1 positions : coverage i starts at offsets[i]
+    int *covi; // per sequence : coverage index
+    char *plus; // per sequence : whether sequence is on the + strand
+};
+
+struct checkpoint {
+    size_t upos; // position in inflated file where state was saved
+    size_t start; // first record starting at or after upos
+    long cpos; // position in compressed file where to continue reading
+    inflate_state *state; // NULL at the beginning of a BGZF block
+};
+
+struct gzindex {
+    char *fname;
+    long size; // of compressed file
+    time_t mtime;
+    unsigned char trailer[8]; // CRC32 and ISIZE of (last) gzip member
+    size_t total; // size of inflated file
+    int bgzf; // checkpoints at block boundaries (start is not a record)
+    struct checkpoint *cps;
+    int n, allocated;
+    size_t bytes; // memory used by checkpoints (see GZINDEX_MAX_BYTES)
+    int users; // scans inflating ranges (see gzindex_get())
+    int dropped; // removed from gzindexes, freed when no longer used
+    struct gzindex *next;
+};
+
+struct fastq_size { // of every file opened by fastq_open
+    size_t compressed; // size of file
+    size_t inflated; // estimated (unless exact) size of inflated data
+    long long isize; // ISIZE of last gzip member (-1 if unknown)
+    int exact;
+};
 
 struct fastq_file {
+    struct scanner *sc; // errors and stats
     const char **fnames; // NULL terminated
     int fname_i; // pointing to NEXT file to be opened
     FILE *fd; // of current file
 
     size_t size; // sum of filesizes of all files
     size_t ftell0; // sum of filesizes of files already read
-    size_t fpos; // within inflated data, not reset between files
+    long long fpos; // within inflated data (see fastq_open), not reset between files
     int eof; // set to 1 when end of file reached
 
     const char *buf; // partial record from last read
@@ -53,36 +147,216 @@ struct fastq_file {
     char *inbuf; // buffer for reading deflated data
     mz_stream mzs; // miniz dat structure
     long remaining; // bytes still to be read in current .gz file
+
+    pthread_mutex_t mutex;
+    long long fpos0; // fpos at beginning of current file
+    struct gzindex *gzi; // being built while reading current .gz file
+    int range; // set if only part of a file is read (see fastq_open_range)
+    int exact; // fastq_size_estimated was set from indexes
+    struct fastq_size *sizes; // of every file (NULL for ranges)
+    FILE *stream; // read instead of opening fnames[0] (see fastq_open)
+    int streaming; // current file is a stream (remaining is not known)
+};
+
+struct range {
+    const char *fnames[2];
+    struct gzindex *gzi; // set in first range of file (see unmap_ranges)
+    struct checkpoint *cp;
+    long long base; // fpos of beginning of file
+    long long start, end; // fpos of first record in range / after range
+    int resync; // start, end are block boundaries (see scan_ranges)
+    const char *data; // mapped .fastq file or NULL if file is inflated
+    size_t length; // of mapped file
+};
+
+struct packed {
+    const char *raw;
+    unsigned long long *bases; // 2 bits per base, 32 bases per word
+    unsigned long long *mask; // lower bit of base set if not one of ACGT
+    int size; // number of words allocated
+};
+
+struct chunk {
+    char *buf; // SCANBUFSIZE, contains only complete records
+    size_t bl; // bytes in buf
+    long long fpos; // file position of first byte in buf
+};
+
+struct ring {
+    struct scanner *sc; // stats reader_stall, worker_stall
+    struct chunk *chunks;
+    int n; // number of chunks
+    int *empty, nempty; // stack of chunks that can be filled
+    int *full, head, nfull; // queue of filled chunks (in file order)
+    int readers; // reader threads that did not yet finish
+    int done; // readers finished or scanning aborted
+    pthread_mutex_t mutex;
+    pthread_cond_t filled, emptied;
+};
+
+struct seed {
+    unsigned int check; // more hash bits to filter bucket collisions
+    int seqi;
+    int pos;
+};
+
+struct automaton {
+    int width; // number of character classes
+    unsigned char cls[256]; // class 0 : character does not occur in sequences
+    int *seqlengths;
+    int *delta; // transitions (width per node)
+    int *fail;
+    int *depth;
+    int *out; // first sequence ending at node or -1
+    int *dict; // next node on fail chain where a sequence ends or -1
+    int *next; // next sequence identical to sequence or -1
+    int *lo, *hi; // sorted[lo..hi-1] are sequences starting with node
+    int *sorted;
+};
+
+struct seqindex {
+    int maxerrors, minoverlap; // index was built for these
+    int k; // seed length; set to 0 if all reads are scanned brute force
+    int minlength; // shorter sequences/reads are scanned brute force
+    int shift; // 64 - log2(number of buckets)
+    unsigned long long bk; // SEED_BASE^(k-1) for rolling hash
+    long *buckets; // offsets into seeds (number of buckets + 1)
+    struct seed *seeds;
+    struct automaton *ac; // only used for exact matching (maxerrors==0)
+    char *indexed; // indexed[seqi] is set if candidates are found via index
+    int nseqs;
+    struct packed *packed; // all sequences
+};
+
+struct diagonal {
+    int seqi;
+    int d; // read[x] is aligned with seq[x-d]
+};
+
+struct candidates {
+    struct diagonal *items;
+    long n, size;
+};
+
+#define MAX_READLENGTH 1024
+#define AMIN_STEPS 5
+#define CACHE_LINE_SIZE 64
+
+struct threadstats { // updated by one scanning thread only (see Scanner.stats())
+    long records_parsed;
+    long records_sampled; // records scanned when subsampling
+    size_t parsed; // bytes of ranges (sequentially read bytes : fastq_parsed)
+    size_t sampled_bytes; // bytes of records scanned when subsampling
+    long rls_longest;
+    long rls_buf[MAX_READLENGTH];
+    long nrecords;
+    long nN, nG, nA, nC, nT, nX;
+    long *all_rls_buf[2*AMIN_STEPS];
+    long *seqhits, *seqbasehits;
+    char padding[CACHE_LINE_SIZE]; // no false sharing with next thread
+};
+
+struct workspace { // per thread buffers
+    struct scanargs *args;
+    struct candidates cands;
+    struct packed read;
+    struct hits hits;
+    struct threadstats *stats;
 };
 
 struct scanargs {
-    struct fastq_file *fastq;
+    struct scanner *sc;
+    struct fastq_file **fastqs; // one per file, read concurrently
+    int nfastqs;
+    struct ring *ring;
+    struct range *ranges; // parallel inflating of indexed .gz files
+    int nranges, nextrange;
     char **seqlist;
     int *seqlengths;
-    ll_item *root;
-    PyObject *pyhitseqs;
+    int *templates; // per sequence : template number (see retire_saturated)
+    struct seqindex *index;
+    struct covmap *cov; // NULL if hits are returned
+};
+
+#define ERRSTR_LENGTH 1024
+
+struct scanner { // engine state, one per kvarq.engine.Scanner
+    // see Scanner.config()
+    int maxerrors;
+    int minoverlap;
+    int minreadlength;
+    int nthreads;
+    int maxcoverage;
+    double sample;
+    int sample_seed;
+    int gzindex;
+    char Amin, Azero;
+    int domore;
+
+    int running, stop;
+    // python pthreads exception handling
+    PyObject *exception;
+    char errstr[ERRSTR_LENGTH];
+    // synchronizing
+    pthread_mutex_t hits_mutex;
+    pthread_mutex_t range_mutex;
+    pthread_mutex_t fastq_mutex; // stats updated by several readers
+
+    // stats
+    size_t fastq_size_estimated, fastq_parsed;
+    int nseqs;
+    int sigints_base; // value of sigints when the scan started
+    struct threadstats *threadstats; // one per scanning thread
+    int nthreadstats;
+    // templates are retired when reaching maxcoverage (all their sequences
+    // are then no longer matched)
+    int ntemplates;
+    int *tmploffsets; // sequences of template t are tmplseqs[tmploffsets[t]..]
+    int *tmplseqs;
+    long *tmplmaxbasehits;
+    int *seqtemplate;
+    char *seqretired; // read by scanning threads with load_relaxed()
+    int nretired;
+    double reader_stall, worker_stall; // seconds waited for empty/filled chunks
+};
+
+typedef struct {
+    PyObject_HEAD
+    struct scanner sc;
+} Scanner;
+
+struct reader { // reads one of the files into the chunk ring
+    struct scanargs *args;
+    struct fastq_file *fastq;
+};
+
+struct scan { // state of findseqs() from starting to joining threads
+    const char **fnames;
+    FILE **streams; // per file : file descriptor passed instead of name
+    int nstreams;
+    const char **singles; // fnames[i], NULL for every file (see fastq_open)
+    struct reader *readers;
+    struct scanargs args;
+    struct ring ring;
+    int ring_ok; // ring was initialized
+    struct workspace *workspaces;
+    int nworkspaces;
+    struct batches *batches; // NULL unless findseqs_iter()
+    pthread_t *threads;
+    int nstarted;
 };
 
 
 /* globals {{{1 */
 
-int running=0, stop=0;
-// see engine_config()
-int maxerrors=0;
-int minoverlap=20;
-int minreadlength=10;
-int nthreads=1;
-char Amin='!', Azero='!';
-int domore=0;
+// scanner used by the module functions findseqs() etc
+Scanner *default_scanner;
 // synchronizing
-pthread_mutex_t ll_mutex = PTHREAD_MUTEX_INITIALIZER;
-pthread_mutex_t rl_mutex = PTHREAD_MUTEX_INITIALIZER;
-pthread_mutex_t fastq_read_mutex = PTHREAD_MUTEX_INITIALIZER;
-pthread_mutex_t records_parsed_mutex = PTHREAD_MUTEX_INITIALIZER;
 pthread_mutex_t log_mutex = PTHREAD_MUTEX_INITIALIZER;
+pthread_mutex_t gzindex_mutex = PTHREAD_MUTEX_INITIALIZER;
 pthread_mutex_t profile_mutex = PTHREAD_MUTEX_INITIALIZER;
 // python objects for interfacing etc
-PyObject *engine_mod, *hittuple;
+PyObject *engine_mod, *hittuple, *arraytype;
 // python object for logging output
 PyObject *lo_log;
 long LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR, LOG_FATAL;
@@ -91,22 +365,24 @@ long LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR, LOG_FATAL;
 char *lo_log_bufs[LO_LOG_MAX_MESSAGES];
 int lo_log_levels[LO_LOG_MAX_MESSAGES];
 int lo_log_i = 0;
-// python pthreads exception handling
-PyObject *exception, *fastq_exception;
-#define ERRSTR_LENGTH 1024
-char errstr[ERRSTR_LENGTH];
-
-// stats
-size_t fastq_size_estimated, fastq_parsed;
-int sigints, nseqs;
-long *seqbasehits, *seqhits, records_parsed;
-long nrecords;
-long nN, nG, nA, nC, nT, nX;
-#define MAX_READLENGTH 1024
-long rls_longest;
-long rls_buf[MAX_READLENGTH];
-#define AMIN_STEPS 5
-long **all_rls_buf;
+PyObject *fastq_exception;
+
+// stats : <CTRL-C> caught since the module was loaded (never reset, every
+// scanner reports the number caught since the beginning of its scan)
+int sigints;
+
+// indexes of .gz files read during previous scans (most recent first);
+// older indexes are dropped when they use more than that many bytes
+#define GZINDEX_MAX_BYTES (256*1024*1024)
+#define GZ_CHECKPOINT_SPACING (8*1024*1024)
+// compressed bytes inflated to estimate the inflated size (see gz_estimate)
+#define GZ_PROBE_SIZE (256*1024)
+// file_pos of records in the i-th file of a scan start at i << FILE_POS_BITS
+#define FILE_POS_BITS 44
+#define MAP_RANGE_SIZE (8*1024*1024)
+// records are subsampled in blocks of that many bytes (see config())
+#define SAMPLE_BLOCK_SIZE (64*1024)
+struct gzindex *gzindexes = NULL;
 
 
 /* signal handler {{{1 */
@@ -123,7 +399,7 @@ BOOL CtrlHandler(DWORD fdwCtrlType)
     } 
     return FALSE;
 } 
-long thread_self() {
+long thread_self(void) {
     return (long) (pthread_self()).p;
 }
 long pthread2long(pthread_t x) {
@@ -134,7 +410,7 @@ void sigint_cb(int sig)
 {
     sigints++;
 }
-long thread_self() {
+long thread_self(void) {
     return (long) pthread_self();
 }
 long pthread2long(pthread_t x) {
@@ -145,6 +421,19 @@ long pthread2long(pthread_t x) {
 
 /* utility functions {{{1 */
 
+// wall clock time in seconds
+
+double now(void)
+{
+#ifdef _WIN32 // 32/64 bit windows
+    return GetTickCount() / 1e3;
+#else
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1e6;
+#endif
+}
+
 // use globals LOG_{DEBUG|INFO|WARNING|ERROR|FATAL} as first argument
 // can only be called outside of Py_BEGIN_ALLOW_THREADS .. Py_END_ALLOW_THREADS !
 
@@ -174,28 +463,35 @@ void lo_log_msg_add(int level, char *fmt, ...)
     vsnprintf(buf + strlen(buf), LOG_BUF_SIZE - strlen(buf), fmt, args);
     va_end(args);
 
+    pthread_mutex_lock(&log_mutex);
     if (lo_log_i < LO_LOG_MAX_MESSAGES) {
-	pthread_mutex_lock(&log_mutex);
 	lo_log_levels[lo_log_i] = level;
 	lo_log_bufs[lo_log_i++] = buf;
-	pthread_mutex_unlock(&log_mutex);
+	buf = NULL;
     }
+    pthread_mutex_unlock(&log_mutex);
+    free(buf);
 }
 
 // again outside Py_BEGIN_ALLOW_THREADS .. Py_END_ALLOW_THREADS to print
-// messages registered via lo_log_msg_add
+// messages registered via lo_log_msg_add (threads of other scanners
+// might still be adding messages)
 
-void lo_log_msg_print() {
-    int i, level;
-    char *buf;
+void lo_log_msg_print(void) {
+    int i, n, levels[LO_LOG_MAX_MESSAGES];
+    char *bufs[LO_LOG_MAX_MESSAGES];
 
-    for(i = 0; i < lo_log_i; i++) {
-	buf = lo_log_bufs[i];
-	level = lo_log_levels[i];
-	PyObject_CallObject(lo_log, Py_BuildValue("(is)", level, buf));
-	free(buf);
-    }
+    pthread_mutex_lock(&log_mutex);
+    n = lo_log_i;
+    memcpy(levels, lo_log_levels, n * sizeof(int));
+    memcpy(bufs, lo_log_bufs, n * sizeof(char *));
     lo_log_i = 0;
+    pthread_mutex_unlock(&log_mutex);
+
+    for(i = 0; i < n; i++) {
+	PyObject_CallObject(lo_log, Py_BuildValue("(is)", levels[i], bufs[i]));
+	free(bufs[i]);
+    }
 }
 
 void dump_record(char *startrecord, char *startread, int rl)
@@ -295,7 +591,7 @@ void profile_stop(char *name)
     pthread_mutex_unlock(&profile_mutex);
 }
 
-void profile_dump()
+void profile_dump(void)
 {
     int i;
 
@@ -313,62 +609,133 @@ int profiles_n = 0;
 
 void profile_start(char *name) {}
 void profile_stop(char *name) {}
-void profile_dump() {}
+void profile_dump(void) {}
 
 #endif
 
 
 /* stats functions {{{1 */
 
+/*
+ * every scanning thread updates its own struct threadstats without locking;
+ * Scanner.stats() sums them up (while scanning, the sums are approximate)
+ */
+
 /* init {{{2 */
 
-void init_stats(char **seqlist)
+void free_stats(struct scanner *sc)
 {
     int i;
 
-    //FIXME : allocated structures are never freed
+    for(i=0; i<sc->nthreadstats; i++)
+	free(sc->threadstats[i].seqhits);
+    free(sc->threadstats);
+    sc->threadstats = NULL;
+    sc->nthreadstats = 0;
+}
 
-    memset((void *) rls_buf, 0, sizeof(rls_buf));
-    rls_longest = -1;
+void free_templates(struct scanner *sc)
+{
+    free(sc->tmploffsets);
+    free(sc->tmplseqs);
+    free(sc->tmplmaxbasehits);
+    free(sc->seqtemplate);
+    free(sc->seqretired);
+    sc->tmploffsets = sc->tmplseqs = sc->seqtemplate = NULL;
+    sc->tmplmaxbasehits = NULL;
+    sc->seqretired = NULL;
+    sc->ntemplates = 0;
+}
+
+/**
+ * allocates zeroed statistics for n scanning threads (the statistics of
+ * the previous scan are freed)
+ *
+ * @param templates template number of every sequence in seqlist
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int init_stats(struct scanner *sc, char **seqlist, const int *templates, int n)
+{
+    struct threadstats *ts;
+    long *counts;
+    int i, j;
+
+    free_stats(sc);
 
-    nrecords = nA = nG = nC = nT = nN = nX = 0;
+    for(sc->nseqs=0; seqlist[sc->nseqs]; sc->nseqs++);
 
-    if (all_rls_buf) {
-	for(i=0; i<2*AMIN_STEPS; i++)
-	    free(all_rls_buf[i]);
-	free(all_rls_buf);
+    sc->threadstats = (struct threadstats *) calloc(n, sizeof(struct threadstats));
+    if (sc->threadstats == NULL)
+	return -1;
+    for(sc->nthreadstats=0; sc->nthreadstats<n; sc->nthreadstats++)
+    {
+	// padded as well : counts are updated for every hit
+	counts = (long *) calloc(2*sc->nseqs + 2*AMIN_STEPS*MAX_READLENGTH +
+		CACHE_LINE_SIZE/sizeof(long), sizeof(long));
+	if (counts == NULL)
+	{
+	    free_stats(sc);
+	    return -1;
+	}
+	ts = sc->threadstats + sc->nthreadstats;
+	ts->rls_longest = -1;
+	ts->seqhits = counts;
+	ts->seqbasehits = counts + sc->nseqs;
+	for(j=0; j<2*AMIN_STEPS; j++)
+	    ts->all_rls_buf[j] = counts + 2*sc->nseqs + j*MAX_READLENGTH;
     }
-    all_rls_buf = (long **) malloc(sizeof(long *) * AMIN_STEPS*2);
-    for(i=0; i<2*AMIN_STEPS; i++) {
-	all_rls_buf[i] = (long *) malloc(sizeof(long) * MAX_READLENGTH);
-	memset((void *) all_rls_buf[i], 0, sizeof(long) * MAX_READLENGTH);
+
+    free_templates(sc);
+    for(i=0, sc->ntemplates=0; i<sc->nseqs; i++)
+	sc->ntemplates = MAX(sc->ntemplates, templates[i] + 1);
+    sc->tmploffsets = (int *) calloc(sc->ntemplates + 2, sizeof(int));
+    sc->tmplseqs = (int *) malloc(sizeof(int) * (sc->nseqs + 1));
+    sc->tmplmaxbasehits = (long *) calloc(sc->ntemplates + 1, sizeof(long));
+    sc->seqtemplate = (int *) malloc(sizeof(int) * (sc->nseqs + 1));
+    sc->seqretired = (char *) calloc(sc->nseqs + 1, 1);
+    if (sc->tmploffsets == NULL || sc->tmplseqs == NULL ||
+	    sc->tmplmaxbasehits == NULL || sc->seqtemplate == NULL ||
+	    sc->seqretired == NULL)
+	return -1;
+
+    // a template is retired when its sequences together reach maxcoverage
+    // (e.g. a template and its reverse complement)
+    for(i=0; i<sc->nseqs; i++)
+    {
+	sc->seqtemplate[i] = templates[i];
+	sc->tmploffsets[templates[i] + 2]++;
+	sc->tmplmaxbasehits[templates[i]] = MAX(sc->tmplmaxbasehits[templates[i]],
+		(long) sc->maxcoverage * (long) strlen(seqlist[i]));
     }
+    for(i=0; i<sc->ntemplates; i++)
+	sc->tmploffsets[i + 2] += sc->tmploffsets[i + 1];
+    for(i=0; i<sc->nseqs; i++)
+	sc->tmplseqs[sc->tmploffsets[templates[i] + 1]++] = i;
+    sc->nretired = 0;
+    sc->reader_stall = sc->worker_stall = 0;
 
-    for(nseqs=0; seqlist[nseqs]; nseqs++);
-    seqbasehits = (long *) malloc(sizeof(long) * nseqs);
-    memset((void *) seqbasehits, 0, sizeof(long) * nseqs);
-    seqhits = (long *) malloc(sizeof(long) * nseqs);
-    memset((void *) seqhits, 0, sizeof(long) * nseqs);
-    records_parsed = 0;
+    return 0;
 }
 
 /* add infos {{{2 */
 
-void analyse_record(char *rstart, long blen)
+void analyse_record(struct scanner *sc, struct threadstats *ts,
+	char *rstart, long blen)
 {
     int i;
     char *ptr,*qtr;
-    nrecords++;
+    ts->nrecords++;
     for(ptr=rstart, i=0; i<4 && ptr-rstart<blen; ptr++) {
 	if (*ptr == '\n')
 	    i++;
 	if (i == 0) switch(*ptr) {
-	    case 'N': nN += 1; break;
-	    case 'A': nA += 1; break;
-	    case 'G': nG += 1; break;
-	    case 'T': nT += 1; break;
-	    case 'C': nC += 1; break;
-	    default: nX += 1; break;
+	    case 'N': ts->nN += 1; break;
+	    case 'A': ts->nA += 1; break;
+	    case 'G': ts->nG += 1; break;
+	    case 'T': ts->nT += 1; break;
+	    case 'C': ts->nC += 1; break;
+	    default: ts->nX += 1; break;
 	}
     }
     if (i<4) return;
@@ -377,1187 +744,5050 @@ void analyse_record(char *rstart, long blen)
 	    i++;
     for(i=0; i<2*AMIN_STEPS; i++)
 	for(++ptr, qtr=ptr; *ptr!='\n'; ptr++)
-	    if (*ptr<(Amin+(i<AMIN_STEPS?-i-1:i-AMIN_STEPS+1))) {
+	    if (*ptr<(sc->Amin+(i<AMIN_STEPS?-i-1:i-AMIN_STEPS+1))) {
 		if (qtr)
-		    all_rls_buf[i][qtr-ptr>=MAX_READLENGTH ? MAX_READLENGTH-1 : ptr-qtr]++;
+		    ts->all_rls_buf[i][qtr-ptr>=MAX_READLENGTH ? MAX_READLENGTH-1 : ptr-qtr]++;
 		qtr = NULL;
 	    } else if (!qtr) qtr=ptr;
 }
 
-void add_records_parsed(long n) {
-    pthread_mutex_lock(&records_parsed_mutex);
-    // DBG("records_parsed : %ld -> %ld", records_parsed, records_parsed + n);
-    records_parsed += n;
-    pthread_mutex_unlock(&records_parsed_mutex);
-}
-
-void add_rl(long rl)
+void add_rl(struct threadstats *ts, long rl)
 {
-    pthread_mutex_lock(&rl_mutex);
     if (rl>=0 && rl<MAX_READLENGTH)
-	rls_buf[rl]++;
-    if (rl > rls_longest)
-	rls_longest = rl;
-    pthread_mutex_unlock(&rl_mutex);
+	ts->rls_buf[rl]++;
+    if (rl > ts->rls_longest)
+	ts->rls_longest = rl;
 }
 
-/* findseqs {{{1 */
-
-/* adding hits {{{2 */
+/**
+ * @return number of bases of hits of sequence seqi found by all threads
+ */
 
-ll_item *add_hit(ll_item *item, int seqi, long fpos, int spos, int length, int readlength, PyObject *pyhitseqs, char *hitseq)
+long sum_seqbasehits(struct scanner *sc, int seqi)
 {
-    PyObject *pyhitseq;
-    pthread_mutex_lock(&ll_mutex);
-
-    //DBG("adding item seqi=%d fpos=%li spos=%i length=%i (thread %li)",
-    //        seqi, fpos, spos, length, thread_self());
+    long n;
+    int i;
 
-    while(item->next != NULL)
-	item = item->next;
-    item->next = (ll_item *) malloc(sizeof(ll_item));
+    for(i=0, n=0; i<sc->nthreadstats; i++)
+	n += sc->threadstats[i].seqbasehits[seqi];
 
-    if (item->next == NULL)
-    {
-	pthread_mutex_unlock(&ll_mutex);
-	return (ll_item *) PyErr_NoMemory();
-    }
+    return n;
+}
 
-    item->next->seqi = seqi;
-    item->next->fpos = fpos;
-    item->next->spos = spos;
-    item->next->length = length;
-    item->next->readlength = readlength;
-    item->next->next = NULL;
-    // DBG("added %ld at %ld (thread %ld)", which, pos, thread_self());
+/* findseqs {{{1 */
 
-    seqbasehits[seqi] += length;
-    seqhits[seqi]++;
+/* accumulating coverages {{{2 */
 
-    pyhitseq = PyString_FromStringAndSize(hitseq, length);
-    PyList_Append(pyhitseqs, pyhitseq);
-    Py_XDECREF(pyhitseq);
+/*
+ * instead of returning every hit, the bases of hits can be counted per
+ * position of the (+ strand) coverages they map to; every thread counts
+ * in its own struct hits and the counts are summed after scanning
+ */
 
-    pthread_mutex_unlock(&ll_mutex);
-    return item->next;
+void covmap_free(struct covmap *cov)
+{
+    if (cov == NULL)
+	return;
+    free(cov->offsets);
+    free(cov->covi);
+    free(cov->plus);
+    free(cov);
 }
 
-void free_ll(ll_item *root)
+/**
+ * @param obj sequence of (coverage index, on_plus_strand) per sequence
+ * @return new struct covmap or NULL (with python exception set)
+ */
+
+struct covmap *covmap_new(PyObject *obj, int *seqlengths, int n)
 {
-    ll_item *tmp;
+    struct covmap *cov;
+    PyObject *item;
+    long *lengths;
+    int i, ci, plus;
 
-    while(root !=NULL)
+    if (!PySequence_Check(obj) || PySequence_Size(obj) != n)
     {
-	tmp = root->next;
-	free(root);
-	root = tmp;
+	PyErr_SetString(PyExc_TypeError,
+		"coverages must be sequence of (coverage_nr, on_plus_strand) per sequence");
+	return NULL;
     }
-}
 
-/* parse .gz {{{2 */
+    cov = (struct covmap *) calloc(1, sizeof(struct covmap));
+    if (cov == NULL)
+	return (struct covmap *) PyErr_NoMemory();
+    cov->nseqs = n;
+    cov->covi = (int *) malloc(sizeof(int) * (n + 1));
+    cov->plus = (char *) malloc(n + 1);
+    if (cov->covi == NULL || cov->plus == NULL)
+    {
+	covmap_free(cov);
+	return (struct covmap *) PyErr_NoMemory();
+    }
 
-#define GZ_DEFLATED     8
-#define GZ_ASCII_FLAG   0x01 /* bit 0 set: file probably ascii text */
-#define GZ_CONTINUATION 0x02 /* bit 1 set: continuation of multi-part gzip file */
-#define GZ_EXTRA_FIELD  0x04 /* bit 2 set: extra field present */
-#define GZ_ORIG_NAME    0x08 /* bit 3 set: original file name present */
-#define GZ_COMMENT      0x10 /* bit 4 set: file comment present */
-#define GZ_ENCRYPTED    0x20 /* bit 5 set: file is encrypted */
-#define GZ_RESERVED     0xC0 /* bit 6,7:   reserved */
+    for(i=0; i<n; i++)
+    {
+	item = PySequence_GetItem(obj, i);
+	if (item == NULL || !PyArg_ParseTuple(item, "ii", &ci, &plus) || ci < 0)
+	{
+	    Py_XDECREF(item);
+	    covmap_free(cov);
+	    PyErr_SetString(PyExc_TypeError,
+		    "coverages must be sequence of (coverage_nr, on_plus_strand) per sequence");
+	    return NULL;
+	}
+	Py_DECREF(item);
+	cov->covi[i] = ci;
+	cov->plus[i] = plus != 0;
+	cov->n = MAX(cov->n, ci + 1);
+    }
+
+    // all sequences mapped onto the same coverage must have same length
+    lengths = (long *) malloc(sizeof(long) * (cov->n + 1));
+    cov->offsets = (long *) malloc(sizeof(long) * (cov->n + 1));
+    if (lengths == NULL || cov->offsets == NULL)
+    {
+	free(lengths);
+	covmap_free(cov);
+	return (struct covmap *) PyErr_NoMemory();
+    }
+    for(ci=0; ci<cov->n; ci++)
+	lengths[ci] = -1;
+    for(i=0; i<n; i++)
+    {
+	ci = cov->covi[i];
+	if (lengths[ci] != -1 && lengths[ci] != seqlengths[i])
+	{
+	    PyErr_Format(PyExc_ValueError,
+		    "sequences mapped onto coverage %d differ in length", ci);
+	    free(lengths);
+	    covmap_free(cov);
+	    return NULL;
+	}
+	lengths[ci] = seqlengths[i];
+    }
+    cov->offsets[0] = 0;
+    for(ci=0; ci<cov->n; ci++)
+	cov->offsets[ci + 1] = cov->offsets[ci] + MAX(0, lengths[ci]);
+    free(lengths);
+
+    return cov;
+}
 
 /**
- * advances file position past gz header
+ * adds bases of hit to per thread coverage counts (without locking)
  *
- * checks for a valid gz header (starting with magix bytes 0x1F 0x8B)
- * in file stream and advances file pointer past the header; no data
- * is returned but the correctness of the gz format (without encryption,
- * continuation, or reserved features) is asserted
+ * bases other than ACGT are counted as N; bases on the - strand are
+ * complemented and counted at the corresponding + strand position
  *
- * @param fd FILE pointer
- * @param dist how many random bytes can be accepted before the header
- *
- * @return NULL if successful, otherwise descriptive error string
+ * @return 0 on success, -1 if memory could not be allocated
  */
 
-const char *skip_gz_header(FILE *fd, int dist)
+int add_bases(struct hits *hits, int seqi, int spos, int length,
+	const char *hitseq)
 {
-    // (based on gzip 1.2.4 source code)
-    // 2 bytes : magic 1F 8B
-    // 1 byte  : method -- must be DEFLATED
-    // 1 byte  : flags -- does not support CONTINUATION, ENCRYPTED, RESERVED
-    // 4 bytes : timestamp
-    // 1 byte  : extra flags
-    // 1 byte  : os type
-    // optional : original name
-    // optional : comment
-
-    int state, c, flags, i, n, y;
-
-    for(state=0, c=fgetc(fd), y=0; state != 2 && y<=dist && c != -1; c=fgetc(fd)) {
-        if (c == 0x1F && state == 0)
-            state++;
-        else if (c == 0x8B && state ==1)
-            state++;
-        else {
-            state=0;
-            y++;
-        }
-    }
-
-    if (state != 2)
-        return "magic bytes not found";
-    //if (y) fprintf(stderr, "ignored %d<%d prior to header\n", y, dist);
+    const struct covmap *cov = hits->cov;
+    unsigned int *bases;
+    long last;
+    int i, j, b;
 
-    if (c != GZ_DEFLATED) {
-        return "expected method==DEFLATED";
+    if (hits->bases == NULL)
+    {
+	hits->bases = (unsigned int *) calloc(
+		5 * cov->offsets[cov->n] + 1, sizeof(unsigned int));
+	if (hits->bases == NULL)
+	    return -1;
     }
-    flags = fgetc(fd);
-    if (flags & (GZ_CONTINUATION | GZ_ENCRYPTED | GZ_RESERVED)) {
-        return "unsupported flags (CONTINUATION or ENCRYPTED or RESERVED)";
+    if (hits->counts == NULL)
+    {
+	hits->counts = (long *) calloc(2 * cov->nseqs + 1, sizeof(long));
+	if (hits->counts == NULL)
+	    return -1;
     }
-    for(i=0; i<4 + 2; i++)
-        // ignore stamp, extra flags, os type
-        (void) fgetc(fd);
-    if (flags & GZ_EXTRA_FIELD) {
-        n = fgetc(fd);
-        n|= fgetc(fd) << 8;
-        // fprintf(stderr, "ingoring extra field length %d\n", n);
-        while(n--) (void) fgetc(fd);
+    if (hits->covdirty == NULL)
+    {
+	hits->covdirty = (char *) calloc(cov->n + 1, 1);
+	hits->touched = (int *) malloc(sizeof(int) * (cov->n + 1));
+	if (hits->covdirty == NULL || hits->touched == NULL)
+	{
+	    free(hits->covdirty);
+	    free(hits->touched);
+	    hits->covdirty = NULL;
+	    hits->touched = NULL;
+	    return -1;
+	}
     }
-    if (flags & GZ_ORIG_NAME) {
-        // fprintf(stderr, "ignoring original name\n");
-        do {
-            c = fgetc(fd);
-        } while (c>0);
+
+    if (!hits->covdirty[cov->covi[seqi]])
+    {
+	hits->covdirty[cov->covi[seqi]] = 1;
+	hits->touched[hits->ntouched++] = cov->covi[seqi];
     }
-    if (flags & GZ_COMMENT) {
-        // fprintf(stderr, "ignoring comment\n");
-        do {
-            c = fgetc(fd);
-        } while (c>0);
+    bases = hits->bases + 5 * cov->offsets[cov->covi[seqi]];
+    last = cov->offsets[cov->covi[seqi] + 1] - cov->offsets[cov->covi[seqi]] - 1;
+    for(i=0, j=MAX(0, spos); i<length; i++, j++)
+    {
+	switch(hitseq[i]) {
+	    case 'A': b = 0; break;
+	    case 'C': b = 1; break;
+	    case 'G': b = 2; break;
+	    case 'T': b = 3; break;
+	    default: b = 4;
+	}
+	if (cov->plus[seqi])
+	    bases[5*j + b]++;
+	else
+	    bases[5*(last-j) + (b == 4 ? 4 : 3-b)]++;
     }
 
-    return NULL; // success
-}
+    hits->counts[2*seqi]++;
+    hits->counts[2*seqi + 1] += length;
+    hits->nbatch++;
 
+    return 0;
+}
 
-/* read from .fastq files {{{2 */
+/* adding hits {{{2 */
 
 /**
- * opens next file in sequence of fastq->fnames
- *
- * this next file can be a .fastq or .fastq.gz file regardless of
- * whether the last file type (although time estimates will be totally
- * wrong if filetypes are mixed)
+ * adds hit to per thread buffers (without locking)
  *
- * @param fastq fastq_structure where fastq_i points to file that
- *     should be opened next
- * @return 0 in case of success, -1 in case of error (globals exception
- *     and errstr are set accordingly)
+ * @param hitseq part of read that matches sequence
+ * @return 0 on success, -1 if memory could not be allocated
  */
 
-int fastq_open_next(struct fastq_file *fastq)
+int add_hit(struct hits *hits, int seqi, long long fpos, int spos, int length,
+	int readlength, const char *hitseq)
 {
-    const char *fname, *ret;
-
-    if (fastq->fname_i > 0) {
-	// close open file & add bytes already read
-	fastq->ftell0 += ftell(fastq->fd);
-	fclose(fastq->fd);
-    }
+    struct hit *items;
+    char *seqs;
+    struct hit *hit;
 
-    fname = fastq->fnames[fastq->fname_i];
-    fastq->fname_i++;
+    if (hits->cov != NULL)
+	return add_bases(hits, seqi, spos, length, hitseq);
 
-    // CAREFUL : opening the file in mode "r" will result in '\r' being discarded
-    //           from the bytes read into buffer !
-    fastq->fd = fopen(fname,"rb");
-    if (fastq->fd == NULL)
+    if (hits->n == hits->size)
     {
-	exception = PyExc_IOError;
-	snprintf(errstr, ERRSTR_LENGTH, "cannot open file");
-	return -1;
+	items = (struct hit *) realloc(hits->items,
+		sizeof(struct hit) * (hits->size ? 2 * hits->size : 1024));
+	if (items == NULL)
+	    return -1;
+	hits->items = items;
+	hits->size = hits->size ? 2 * hits->size : 1024;
     }
-
-    if (strcmp(fname + strlen(fname) - 3, ".gz") == 0)
+    if (hits->seqs_n + length > hits->seqs_size)
     {
-	// initialize datastructure for inflating
-	fastq->compressed = 1;
+	seqs = (char *) realloc(hits->seqs,
+		MAX(2 * hits->seqs_size, hits->seqs_n + length + 65536));
+	if (seqs == NULL)
+	    return -1;
+	hits->seqs = seqs;
+	hits->seqs_size = MAX(2 * hits->seqs_size, hits->seqs_n + length + 65536);
+    }
 
-	// must be reset before call to mz_inflateInit2
-	memset((void *) &fastq->mzs, 0, sizeof(mz_stream));
+    hit = hits->items + hits->n++;
+    hit->seqi = seqi;
+    hit->fpos = fpos;
+    hit->spos = spos;
+    hit->length = length;
+    hit->readlength = readlength;
+    hit->seq = hits->seqs_n;
+    memcpy(hits->seqs + hits->seqs_n, hitseq, length);
+    hits->seqs_n += length;
+    hits->nbatch++;
 
-	if (mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS) != MZ_OK)
-	{
-	    fclose(fastq->fd);
-	    exception = PyExc_RuntimeError;
-	    snprintf(errstr, ERRSTR_LENGTH, "cannot mz_inflateInit()");
-	    return -1;
-	}
+    return 0;
+}
 
-	if (fastq->inbuf == NULL)
-	    fastq->inbuf = malloc(SCANBUFSIZE);
+/**
+ * retires the template of sequence seqi if the bases of the hits of all
+ * its sequences reached maxcoverage : its sequences are no longer matched
+ * and scanning is stopped when all templates are retired (call with
+ * hits_mutex locked)
+ */
 
-	if (fastq->inbuf == NULL)
-	{
-	    fclose(fastq->fd);
-	    exception = PyExc_MemoryError;
-	    snprintf(errstr, ERRSTR_LENGTH, "cannot allocate inbuf");
-	    return -1;
-	}
+void retire_saturated(struct scanner *sc, int seqi)
+{
+    long basehits;
+    int t, i;
 
-	fastq->mzs.next_in = (const unsigned char *) fastq->inbuf;
-	fseek(fastq->fd, 0, SEEK_END);
-	fastq->remaining = ftell(fastq->fd);
-	fseek(fastq->fd, 0, SEEK_SET);
-	ret = skip_gz_header(fastq->fd, 0);
-	if (ret != NULL)
+    if (sc->maxcoverage <= 0 || sc->seqretired[seqi])
+	return;
+
+    t = sc->seqtemplate[seqi];
+    for(i=sc->tmploffsets[t], basehits=0; i<sc->tmploffsets[t + 1]; i++)
+	basehits += sum_seqbasehits(sc, sc->tmplseqs[i]);
+    if (basehits < sc->tmplmaxbasehits[t])
+	return;
+
+    for(i=sc->tmploffsets[t]; i<sc->tmploffsets[t + 1]; i++)
+	store_relaxed(sc->seqretired[sc->tmplseqs[i]], 1);
+    if (++sc->nretired == sc->ntemplates)
+    {
+	lo_log_msg_add(LOG_INFO, "all templates reached coverage %d", sc->maxcoverage);
+	sc->stop++;
+    }
+}
+
+/**
+ * adds hits found since last call to the seqhits, seqbasehits of the
+ * scanning thread (only locks hits_mutex for retiring sequences)
+ */
+
+void count_hits(struct scanner *sc, struct hits *hits, struct threadstats *ts)
+{
+    struct hit *hit;
+    long counted;
+    int i;
+
+    counted = hits->counted;
+    for(hit=hits->items+counted; hit<hits->items+hits->n; hit++)
+    {
+	ts->seqbasehits[hit->seqi] += hit->length;
+	ts->seqhits[hit->seqi]++;
+    }
+    hits->counted = hits->n;
+    if (hits->counts != NULL)
+	for(i=0; i<hits->cov->nseqs; i++)
 	{
-	    fclose(fastq->fd);
-	    exception = PyExc_IOError;
-	    snprintf(errstr, ERRSTR_LENGTH, "no valid gzip header found "
-		    "at beginning of file : %s", ret);
-	    return -1;
+	    ts->seqhits[i] += hits->counts[2*i];
+	    ts->seqbasehits[i] += hits->counts[2*i + 1];
 	}
-	fastq->remaining -= ftell(fastq->fd);
 
-	// random guess
-	fastq_size_estimated *= 3;
+    if (sc->maxcoverage > 0)
+    {
+	pthread_mutex_lock(&sc->hits_mutex);
+	for(hit=hits->items+counted; hit<hits->items+hits->n; hit++)
+	    retire_saturated(sc, hit->seqi);
+	if (hits->counts != NULL)
+	    for(i=0; i<hits->cov->nseqs; i++)
+		if (hits->counts[2*i] > 0)
+		    retire_saturated(sc, i);
+	pthread_mutex_unlock(&sc->hits_mutex);
     }
 
-    return 0;
+    if (hits->counts != NULL)
+	memset(hits->counts, 0, sizeof(long) * 2 * hits->cov->nseqs);
+}
+
+void hits_free(struct hits *hits)
+{
+    free(hits->items);
+    free(hits->seqs);
+    free(hits->bases);
+    free(hits->counts);
+    free(hits->covdirty);
+    free(hits->touched);
+    memset(hits, 0, sizeof(struct hits));
+}
+
+struct sorted_hit {
+    struct hit *hit;
+    const char *seqs;
+};
+
+/**
+ * sorts hits by file position (a read is scanned by a single thread :
+ * hits of a read stay in the order they were found)
+ */
+
+int sorted_hit_cmp(const void *a, const void *b)
+{
+    const struct hit *x = ((const struct sorted_hit *) a)->hit;
+    const struct hit *y = ((const struct sorted_hit *) b)->hit;
+
+    if (x->fpos != y->fpos)
+	return x->fpos < y->fpos ? -1 : 1;
+    return x < y ? -1 : x > y;
 }
 
 /**
- * opens a .fastq file for further access via fastq_read
- *
- * also initializes globals fastq_size_estimated and fastq_parsed
+ * @param typecode of array.array
+ * @param data values of array
+ * @param size of data in bytes
+ * @return new array.array or NULL
+ */
+
+PyObject *new_array(const char *typecode, const void *data, size_t size)
+{
+    PyObject *str, *ret;
+
+    str = PyString_FromStringAndSize((const char *) data, size);
+    if (str == NULL)
+	return NULL;
+    ret = PyObject_CallFunction(arraytype, "sO", typecode, str);
+    Py_DECREF(str);
+
+    return ret;
+}
+
+/**
+ * creates array.array("l") of 64 bit integers; python 2 has no array type
+ * of 64 bit integers if long has only 32 bits (LLP64, e.g. 64 bit
+ * windows), in which case a list of integers is returned instead
  *
- * @param fnames NULL terminated array of paths of the .fastq files
- * @return pointer to fastq file object or NULL in case of error
- *         (PyErr_SetString called with appropriate arguments)
+ * @param data values
+ * @param n number of values
+ * @return new reference or NULL on error
  */
 
-struct fastq_file *fastq_open(const char **fnames)
+PyObject *new_longlong_array(const long long *data, long n)
 {
-    struct fastq_file *fastq;
-    int i;
-    FILE *fd;
+    PyObject *ret, *item;
+    long i;
 
-    fastq = (struct fastq_file *) malloc(sizeof(struct fastq_file));
-    if (fastq == NULL)
+    if (sizeof(long) == sizeof(long long))
+	return new_array("l", data, sizeof(long long) * n);
+
+    ret = PyList_New(n);
+    for(i=0; ret != NULL && i<n; i++)
     {
-	exception = PyExc_MemoryError;
-	snprintf(errstr, ERRSTR_LENGTH, "cannot allocate struct fastq_file");
-	return NULL;
+	item = PyLong_FromLongLong(data[i]);
+	if (item == NULL)
+	{
+	    Py_DECREF(ret);
+	    return NULL;
+	}
+	PyList_SET_ITEM(ret, i, item);
     }
 
-    memset(fastq, 0, sizeof(struct fastq_file));
-    fastq->fnames = fnames;
+    return ret;
+}
 
-    // determine overall file size
-    for(i = 0; fastq->fnames[i]; i++)
+/**
+ * converts sorted hits into a dictionary of array.array (one per field of
+ * kvarq.engine.Hit) and the hit sequences into a tuple (string containing
+ * all sequences, array.array of n+1 offsets into this string); file_pos
+ * and offsets are 64 bit integers (see new_longlong_array)
+ *
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int columnar_hits(struct sorted_hit *sorted, long n, PyObject **pyhits, PyObject **pyhitseqs)
+{
+    int *seqis, *sposs, *lengths, *readlengths;
+    long long *fposs, *offsets;
+    PyObject *data, *arrays[6];
+    char *ptr;
+    long i;
+
+    seqis = (int *) malloc(sizeof(int) * (n + 1));
+    sposs = (int *) malloc(sizeof(int) * (n + 1));
+    lengths = (int *) malloc(sizeof(int) * (n + 1));
+    readlengths = (int *) malloc(sizeof(int) * (n + 1));
+    fposs = (long long *) malloc(sizeof(long long) * (n + 1));
+    offsets = (long long *) malloc(sizeof(long long) * (n + 1));
+
+    memset(arrays, 0, sizeof(arrays));
+    data = NULL;
+    if (seqis && sposs && lengths && readlengths && fposs && offsets)
     {
-	fd = fopen(fastq->fnames[i], "rb");
-	if (fd == NULL)
+	for(i=0, offsets[0]=0; i<n; i++)
 	{
-	    free(fastq);
-	    exception = PyExc_IOError;
-	    snprintf(errstr, ERRSTR_LENGTH,
-		    "cannot open file '%s' for getting filesize", fastq->fnames[i]);
-	    return NULL;
+	    seqis[i] = sorted[i].hit->seqi;
+	    fposs[i] = sorted[i].hit->fpos;
+	    sposs[i] = sorted[i].hit->spos;
+	    lengths[i] = sorted[i].hit->length;
+	    readlengths[i] = sorted[i].hit->readlength;
+	    offsets[i+1] = offsets[i] + sorted[i].hit->length;
 	}
-	fseek(fd, 0, SEEK_END);
-	fastq->size += ftell(fd);
-	fclose(fd);
+
+	arrays[0] = new_array("i", seqis, sizeof(int) * n);
+	arrays[1] = new_longlong_array(fposs, n);
+	arrays[2] = new_array("i", sposs, sizeof(int) * n);
+	arrays[3] = new_array("i", lengths, sizeof(int) * n);
+	arrays[4] = new_array("i", readlengths, sizeof(int) * n);
+	arrays[5] = new_longlong_array(offsets, n + 1);
+	data = PyString_FromStringAndSize(NULL, offsets[n]);
+	if (data != NULL)
+	    for(i=0, ptr=PyString_AS_STRING(data); i<n; i++)
+	    {
+		memcpy(ptr, sorted[i].seqs + sorted[i].hit->seq, sorted[i].hit->length);
+		ptr += sorted[i].hit->length;
+	    }
     }
 
-    // initialize globals fastq_parsed, fastq_size_estimated
-    fastq_parsed = 0;
-    fastq_size_estimated = fastq->size;
+    free(seqis);
+    free(sposs);
+    free(lengths);
+    free(readlengths);
+    free(fposs);
+    free(offsets);
 
-    if (fastq_open_next(fastq) != 0)
+    *pyhits = *pyhitseqs = NULL;
+    for(i=0; i<6 && arrays[i]!=NULL; i++);
+    if (i == 6 && data != NULL)
     {
-	free(fastq);
-	return NULL;
+	*pyhits = Py_BuildValue("{sOsOsOsOsO}",
+		"seq_nr", arrays[0],
+		"file_pos", arrays[1],
+		"seq_pos", arrays[2],
+		"length", arrays[3],
+		"readlength", arrays[4]);
+	*pyhitseqs = Py_BuildValue("(OO)", data, arrays[5]);
     }
+    for(i=0; i<6; i++)
+	Py_XDECREF(arrays[i]);
+    Py_XDECREF(data);
 
-    return fastq;
+    if (*pyhits == NULL || *pyhitseqs == NULL)
+    {
+	Py_XDECREF(*pyhits);
+	Py_XDECREF(*pyhitseqs);
+	*pyhits = *pyhitseqs = NULL;
+	return -1;
+    }
+
+    return 0;
 }
 
 /**
- * get length of last partial fastq record in buffer
+ * merges hits of all threads (must be called holding the GIL)
  *
- * @param buf data read from .fastq file
- * @param n length of data in buf
- * @return length of last partial record in buf; -1 if no partial buf found at end
+ * @param hits per thread hits
+ * @param n number of threads
+ * @param columnar whether to return arrays instead of tuples (see
+ *     columnar_hits)
+ * @param pyhits set to tuple of hittuple
+ * @param pyhitseqs set to list of hit sequences (same order as pyhits)
+ * @return 0 on success, -1 if memory could not be allocated
  */
 
-int fastq_rewind(char *buf, int n)
+int merge_hits(struct hits **hits, int n, int columnar, PyObject **pyhits, PyObject **pyhitseqs)
 {
+    struct sorted_hit *sorted;
+    struct hit *hit;
+    PyObject *item, *values;
+    long i, j, total;
+    int ret;
 
-    // we scan for /^\+/ (line3) and then accept the next /^@/ (line1) as the
-    // beginning of a record note that /^\+/ could also be a PHRED score
-    // therefore accept a repeated /^\+/ as the "real" line3
+    for(i=0, total=0; i<n; i++)
+	total += hits[i]->n;
 
-    int state = 0; // 1=found line3
-    int i = 1;
+    sorted = (struct sorted_hit *) malloc(sizeof(struct sorted_hit) * (total + 1));
+    if (sorted == NULL)
+	return -1;
+    for(i=0, total=0; i<n; i++)
+	for(j=0; j<hits[i]->n; j++, total++)
+	{
+	    sorted[total].hit = hits[i]->items + j;
+	    sorted[total].seqs = hits[i]->seqs;
+	}
+    qsort(sorted, total, sizeof(struct sorted_hit), sorted_hit_cmp);
 
-    while (i + 1 < n)
+    if (columnar)
     {
-	if (buf[n - i] == '+' && 
-		(buf[n - i - 1] == '\n' || buf[n - i - 1] == '\r'))
-	    state = 1; // state might have been 0 OR 1 (see note above)
-	else if (state == 1 && buf[n - i] == '@' &&
-		(buf[n - i - 1] == '\n' || buf[n - i - 1] == '\r'))
-	    return i;
-	i++;
+	ret = columnar_hits(sorted, total, pyhits, pyhitseqs);
+	free(sorted);
+	return ret;
     }
 
-    return -1;
+    *pyhits = PyTuple_New(total);
+    *pyhitseqs = PyList_New(total);
+    for(i=0; *pyhits != NULL && *pyhitseqs != NULL && i<total; i++)
+    {
+	hit = sorted[i].hit;
+	values = Py_BuildValue("(iLiii)", hit->seqi, hit->fpos, hit->spos,
+		hit->length, hit->readlength);
+	item = values == NULL ? NULL : PyObject_CallObject(hittuple, values);
+	Py_XDECREF(values);
+	if (item == NULL)
+	    break;
+	PyTuple_SET_ITEM(*pyhits, i, item);
+
+	item = PyString_FromStringAndSize(sorted[i].seqs + hit->seq, hit->length);
+	if (item == NULL)
+	    break;
+	PyList_SET_ITEM(*pyhitseqs, i, item);
+    }
+    free(sorted);
+
+    if (i < total || *pyhits == NULL || *pyhitseqs == NULL)
+    {
+	Py_XDECREF(*pyhits);
+	Py_XDECREF(*pyhitseqs);
+	*pyhits = *pyhitseqs = NULL;
+	return -1;
+    }
+
+    return 0;
 }
 
 /**
- * reads content from a .fastq file -- multithread safe
- *
- * also updates globals fastq_size_estimated and fastq_parsed
- *
- * @param fastq pointer as returned by fastq_open
- * @param buf where the read data is saved
- * @param buf_size maximum number of bytes that can be saved in buf
- * @param fposp pointer to file position of first byte in buffer
+ * converts the base counts of a batch that only contains the coverages
+ * touched since the previous batch (see take_touched) into a dictionary of
+ * array.array('l') indexed by coverage number
  *
- * @return number of bytes read; this is normally smaller than buf_size
- *         and the last character is guaranteed to be the end of a
- *         record (unless the file ends with a partial record).
- *         returns 0 if EOF is encountered and -1 in case of error
- *         (with exception/errstr globals accordingly set)
+ * @return 0 on success, -1 if memory could not be allocated
  */
 
-size_t fastq_read(struct fastq_file *fastq, char *buf, size_t buf_size, size_t *fposp)
+int touched_coverages(const struct hits *batch, const struct covmap *cov,
+	PyObject **pycovs)
 {
-    size_t n, leftovers, m;
-    long pos;
-    int status;
-    unsigned int avail_in, avail_out;
-    const char *msg;
+    const unsigned int *bases;
+    long *counts, i, length;
+    PyObject *item, *key;
+    int j, ci, err;
 
-    profile_start("fastq_read");
-    pthread_mutex_lock(&fastq_read_mutex);
+    *pycovs = PyDict_New();
+    for(j=0, bases=batch->bases; *pycovs != NULL && j<batch->ntouched; j++)
+    {
+	ci = batch->touched[j];
+	length = 5 * (cov->offsets[ci + 1] - cov->offsets[ci]);
+	item = NULL;
+	counts = (long *) malloc(sizeof(long) * (length + 1));
+	if (counts != NULL)
+	{
+	    for(i=0; i<length; i++)
+		counts[i] = bases[i];
+	    item = new_array("l", counts, sizeof(long) * length);
+	    free(counts);
+	}
+	bases += length;
 
-    // eof? open next file if available
-    if (fastq->eof != 0) {
-	if (fastq->fnames[fastq->fname_i] != NULL)
-	    if (fastq_open_next(fastq) != 0)
-		return -1;
+	if (item != NULL)
+	{
+	    key = PyInt_FromLong(ci);
+	    err = key == NULL || PyDict_SetItem(*pycovs, key, item) != 0;
+	    Py_XDECREF(key);
+	    Py_DECREF(item);
+	    if (err)
+		item = NULL;
+	}
+	if (item == NULL)
+	{
+	    Py_DECREF(*pycovs);
+	    *pycovs = NULL;
+	}
     }
 
-    // copy partial record from last read
-    if (fastq->buf_size > 0)
-    {
-	if (fastq->buf_size > buf_size) {
-	    exception = PyExc_RuntimeError;
-	    strncpy(errstr, "buf_size < fastq->buf_size !", ERRSTR_LENGTH);
+    return *pycovs == NULL ? -1 : 0;
+}
 
-	    pthread_mutex_unlock(&fastq_read_mutex);
-	    profile_stop("fastq_read");
-	    return -1;
-	}
+/**
+ * sums the per thread base counts into one array.array('l') per coverage
+ * (5 counts A,C,G,T,N for every position on the + strand)
+ *
+ * @param sparse return a dictionary indexed by coverage number that only
+ *     contains coverages with bases counted instead of a list
+ * @return 0 on success, -1 if memory could not be allocated
+ */
 
-	leftovers = fastq->buf_size;
-	memcpy(buf, fastq->buf, leftovers);
-	free((void *) fastq->buf);
-	fastq->buf_size = 0;
+int merge_coverages(struct hits **hits, int n, const struct covmap *cov,
+	int sparse, PyObject **pycovs)
+{
+    long *sums, i, total;
+    PyObject *item, *key;
+    int j, ci, err;
 
-    } else {
-	leftovers = 0;
-    }
+    if (sparse && n == 1 && hits[0]->compact)
+	return touched_coverages(hits[0], cov, pycovs);
 
-    // first byte of buffer within (inflated) file
-    *fposp = fastq->fpos - leftovers;
-    n = 0;
-    fastq->eof = 0;
+    total = 5 * cov->offsets[cov->n];
+    sums = (long *) calloc(total + 1, sizeof(long));
+    if (sums == NULL)
+	return -1;
+    for(j=0; j<n; j++)
+	if (hits[j]->bases != NULL)
+	    for(i=0; i<total; i++)
+		sums[i] += hits[j]->bases[i];
 
-    if (fastq->compressed)
+    *pycovs = sparse ? PyDict_New() : PyList_New(cov->n);
+    for(ci=0; *pycovs != NULL && ci<cov->n; ci++)
     {
-	// read compressed data
-	fastq->mzs.next_out = (unsigned char *) (buf + leftovers);
-	fastq->mzs.avail_out = buf_size - leftovers;
-	do
+	if (sparse)
 	{
-	    // fill up (deflated) inbuf if empty
-	    if (fastq->mzs.avail_in == 0)
-	    {
-		m = MIN(SCANBUFSIZE, fastq->remaining);
-		if (fread(fastq->inbuf, 1, m, fastq->fd) != m)
-		{
-		    exception = PyExc_IOError;
-		    strncpy(errstr, "could not read enough bytes from .fastq.gz", ERRSTR_LENGTH);
-		    if (ferror(fastq->fd) != 0)
-			strcat(errstr, " : I/O error");
-		    if (feof(fastq->fd) != 0)
-			strcat(errstr, " : premature EOF");
+	    for(i=5*cov->offsets[ci]; i<5*cov->offsets[ci + 1] && sums[i]==0; i++);
+	    if (i == 5*cov->offsets[ci + 1])
+		continue;
+	}
+	item = new_array("l", sums + 5 * cov->offsets[ci],
+		sizeof(long) * 5 * (cov->offsets[ci + 1] - cov->offsets[ci]));
+	if (item != NULL && sparse)
+	{
+	    key = PyInt_FromLong(ci);
+	    err = key == NULL || PyDict_SetItem(*pycovs, key, item) != 0;
+	    Py_XDECREF(key);
+	    Py_DECREF(item);
+	    if (err)
+		item = NULL;
+	}
+	else if (item != NULL)
+	    PyList_SET_ITEM(*pycovs, ci, item);
+	if (item == NULL)
+	{
+	    Py_DECREF(*pycovs);
+	    *pycovs = NULL;
+	    break;
+	}
+    }
+    free(sums);
 
-		    pthread_mutex_unlock(&fastq_read_mutex);
-		    profile_stop("fastq_read");
-		    return -1;
-		}
-		/*DBG("\nread %ld bytes into inbuf", m);*/
-		fastq->mzs.next_in = (const unsigned char *) fastq->inbuf;
-		fastq->mzs.avail_in = m;
-		fastq->remaining -= m;
-	    }
+    return *pycovs == NULL ? -1 : 0;
+}
 
-	    // inflate inbuf -> buf
-	    avail_in = fastq->mzs.avail_in;
-	    avail_out = fastq->mzs.avail_out;
-	    //DBG("will inflate avail_in=%d avail_out=%d", avail_in, avail_out);
-	    status = mz_inflate(&fastq->mzs, Z_SYNC_FLUSH);
+/* batches of hits {{{2 */
 
-	    if ((status != MZ_OK) && (status != MZ_STREAM_END))
-	    {
-		exception = PyExc_IOError;
-		snprintf(errstr, ERRSTR_LENGTH,
-			"error while inflating compressed data : status=%d"
-			" fpos=%ld ftell=%ld+%ld avail_in=%d",
-			status, fastq->fpos, fastq->ftell0, ftell(fastq->fd),
-			fastq->mzs.avail_in);
-		// strncpy(errstr, "error while inflating compressed data", ERRSTR_LENGTH);
+/*
+ * findseqs_iter() : every scanning thread hands over the hits (or base
+ * counts) it found so far to the python thread after scanning a chunk
+ * that brought them to at least batchsize; the queue is bounded and
+ * scanning threads wait while it is full
+ */
 
-		pthread_mutex_unlock(&fastq_read_mutex);
-		profile_stop("fastq_read");
-		return -1;
-	    }
+void batches_free(struct batches *batches)
+{
+    int i;
 
-	    // update bytes read in deflated stream
-	    n += avail_out - fastq->mzs.avail_out;
+    if (batches == NULL)
+	return;
+    for(i=0; i<batches->n; i++)
+	hits_free(batches->items + (batches->head + i) % batches->size);
+    free(batches->items);
+    pthread_mutex_destroy(&batches->mutex);
+    pthread_cond_destroy(&batches->put);
+    pthread_cond_destroy(&batches->got);
+    free(batches);
+}
 
-	    /*
-	       DBG("fastq_read [%li] : inflated %d -> %d bytes",
-	       thread_self(),
-	       avail_in - fastq->mzs.avail_in, avail_out - fastq->mzs.avail_out);
-	       */
+/**
+ * @param size maximum number of batches waiting to be consumed
+ * @param batchsize minimum number of hits per batch
+ * @param running number of scanning threads that will call batches_done()
+ * @return new struct batches or NULL if memory could not be allocated
+ */
 
-	    // some versions of gzip create files with many successive deflated streams
-	    if (status == MZ_STREAM_END &&
-		    fastq->remaining + fastq->mzs.avail_in > 10)
-	    {
-		// rewind file
-		fseek(fastq->fd, -((long) fastq->mzs.avail_in), SEEK_CUR);
-		fastq->remaining += fastq->mzs.avail_in;
-		// read header -- 2-7 bytes between streams !?
-		pos = ftell(fastq->fd);
-		msg = skip_gz_header(fastq->fd, 10);
-		if (msg != NULL)
-		{
-		    lo_log_msg_add(LOG_ERROR, "cannot read next deflated stream "
+struct batches *batches_new(int size, long batchsize, int running)
+{
+    struct batches *batches;
+
+    batches = (struct batches *) calloc(1, sizeof(struct batches));
+    if (batches == NULL)
+	return NULL;
+    batches->items = (struct hits *) calloc(size, sizeof(struct hits));
+    if (batches->items == NULL)
+    {
+	free(batches);
+	return NULL;
+    }
+    batches->size = size;
+    batches->batchsize = batchsize;
+    batches->running = running;
+    pthread_mutex_init(&batches->mutex, NULL);
+    pthread_cond_init(&batches->put, NULL);
+    pthread_cond_init(&batches->got, NULL);
+
+    return batches;
+}
+
+/**
+ * moves the base counts of the coverages touched since the last batch from
+ * hits into batch, so that a batch does not contain the counts of all
+ * coverages (the thread continues counting in the same, now zeroed, array)
+ *
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int take_touched(struct hits *hits, struct hits *batch)
+{
+    const struct covmap *cov = hits->cov;
+    unsigned int *bases;
+    long length, total;
+    int j, ci;
+
+    for(j=0, total=0; j<hits->ntouched; j++)
+	total += cov->offsets[hits->touched[j] + 1] - cov->offsets[hits->touched[j]];
+    batch->bases = (unsigned int *) malloc(sizeof(unsigned int) * (5 * total + 1));
+    batch->touched = (int *) malloc(sizeof(int) * (hits->ntouched + 1));
+    if (batch->bases == NULL || batch->touched == NULL)
+    {
+	free(batch->bases);
+	free(batch->touched);
+	batch->bases = NULL;
+	batch->touched = NULL;
+	return -1;
+    }
+
+    for(j=0, bases=batch->bases; j<hits->ntouched; j++)
+    {
+	ci = hits->touched[j];
+	length = 5 * (cov->offsets[ci + 1] - cov->offsets[ci]);
+	memcpy(bases, hits->bases + 5 * cov->offsets[ci],
+		sizeof(unsigned int) * length);
+	memset(hits->bases + 5 * cov->offsets[ci], 0,
+		sizeof(unsigned int) * length);
+	hits->covdirty[ci] = 0;
+	bases += length;
+    }
+    memcpy(batch->touched, hits->touched, sizeof(int) * hits->ntouched);
+    batch->ntouched = hits->ntouched;
+    batch->compact = 1;
+    hits->ntouched = 0;
+
+    return 0;
+}
+
+/**
+ * hands over the hits of a scanning thread if at least batchsize hits were
+ * added since the last batch (or any hits if all is set); call after
+ * count_hits()
+ */
+
+void batches_put(struct hits *hits, int all)
+{
+    struct batches *batches = hits->batches;
+    struct hits batch;
+
+    if (batches == NULL || hits->nbatch == 0 ||
+	    (!all && hits->nbatch < batches->batchsize))
+	return;
+
+    // the thread continues with empty buffers (or zeroed base counts)
+    batch = *hits;
+    batch.counts = NULL;
+    batch.batches = NULL;
+    batch.covdirty = NULL;
+    batch.touched = NULL;
+    batch.ntouched = 0;
+    hits->items = NULL;
+    hits->seqs = NULL;
+    hits->n = hits->size = hits->counted = hits->nbatch = 0;
+    hits->seqs_n = hits->seqs_size = 0;
+    if (hits->bases != NULL && take_touched(hits, &batch) != 0)
+    {
+	// (without memory for a copy, the counts of all coverages are
+	// handed over)
+	batch.bases = hits->bases;
+	if (hits->covdirty != NULL)
+	    memset(hits->covdirty, 0, hits->cov->n);
+	hits->ntouched = 0;
+    }
+    if (batch.bases == hits->bases)
+	hits->bases = NULL;
+
+    pthread_mutex_lock(&batches->mutex);
+    while(batches->n == batches->size && !batches->closed)
+	pthread_cond_wait(&batches->got, &batches->mutex);
+    if (batches->closed)
+	hits_free(&batch);
+    else
+    {
+	batches->items[(batches->head + batches->n++) % batches->size] = batch;
+	pthread_cond_signal(&batches->put);
+    }
+    pthread_mutex_unlock(&batches->mutex);
+}
+
+/**
+ * called by every scanning thread when it finishes (hands over the
+ * remaining hits)
+ */
+
+void batches_done(struct hits *hits)
+{
+    struct batches *batches = hits->batches;
+
+    if (batches == NULL)
+	return;
+    batches_put(hits, 1);
+    pthread_mutex_lock(&batches->mutex);
+    batches->running--;
+    pthread_cond_broadcast(&batches->put);
+    pthread_mutex_unlock(&batches->mutex);
+}
+
+/**
+ * waits for the next batch
+ *
+ * @param batch is filled with hits that must be freed with hits_free()
+ * @return 1 if batch was filled, 0 if all scanning threads finished
+ */
+
+int batches_get(struct batches *batches, struct hits *batch)
+{
+    int got = 0;
+
+    pthread_mutex_lock(&batches->mutex);
+    while(batches->n == 0 && batches->running > 0)
+	pthread_cond_wait(&batches->put, &batches->mutex);
+    if (batches->n > 0)
+    {
+	*batch = batches->items[batches->head];
+	batches->head = (batches->head + 1) % batches->size;
+	batches->n--;
+	pthread_cond_signal(&batches->got);
+	got = 1;
+    }
+    pthread_mutex_unlock(&batches->mutex);
+
+    return got;
+}
+
+/**
+ * no more batches will be consumed : wakes up waiting scanning threads
+ */
+
+void batches_close(struct batches *batches)
+{
+    pthread_mutex_lock(&batches->mutex);
+    batches->closed = 1;
+    pthread_cond_broadcast(&batches->got);
+    pthread_mutex_unlock(&batches->mutex);
+}
+
+/* parse .gz {{{2 */
+
+#define GZ_DEFLATED     8
+#define GZ_ASCII_FLAG   0x01 /* bit 0 set: file probably ascii text */
+#define GZ_CONTINUATION 0x02 /* bit 1 set: continuation of multi-part gzip file */
+#define GZ_EXTRA_FIELD  0x04 /* bit 2 set: extra field present */
+#define GZ_ORIG_NAME    0x08 /* bit 3 set: original file name present */
+#define GZ_COMMENT      0x10 /* bit 4 set: file comment present */
+#define GZ_ENCRYPTED    0x20 /* bit 5 set: file is encrypted */
+#define GZ_RESERVED     0xC0 /* bit 6,7:   reserved */
+
+/**
+ * advances file position past gz header
+ *
+ * checks for a valid gz header (starting with magix bytes 0x1F 0x8B)
+ * in file stream and advances file pointer past the header; no data
+ * is returned but the correctness of the gz format (without encryption,
+ * continuation, or reserved features) is asserted
+ *
+ * @param fd FILE pointer
+ * @param dist how many random bytes can be accepted before the header
+ *
+ * @return NULL if successful, otherwise descriptive error string
+ */
+
+const char *skip_gz_header(FILE *fd, int dist)
+{
+    // (based on gzip 1.2.4 source code)
+    // 2 bytes : magic 1F 8B
+    // 1 byte  : method -- must be DEFLATED
+    // 1 byte  : flags -- does not support CONTINUATION, ENCRYPTED, RESERVED
+    // 4 bytes : timestamp
+    // 1 byte  : extra flags
+    // 1 byte  : os type
+    // optional : original name
+    // optional : comment
+
+    int state, c, flags, i, n, y;
+
+    for(state=0, c=fgetc(fd), y=0; state != 2 && y<=dist && c != -1; c=fgetc(fd)) {
+        if (c == 0x1F && state == 0)
+            state++;
+        else if (c == 0x8B && state ==1)
+            state++;
+        else {
+            state=0;
+            y++;
+        }
+    }
+
+    if (state != 2)
+        return "magic bytes not found";
+    //if (y) fprintf(stderr, "ignored %d<%d prior to header\n", y, dist);
+
+    if (c != GZ_DEFLATED) {
+        return "expected method==DEFLATED";
+    }
+    flags = fgetc(fd);
+    if (flags & (GZ_CONTINUATION | GZ_ENCRYPTED | GZ_RESERVED)) {
+        return "unsupported flags (CONTINUATION or ENCRYPTED or RESERVED)";
+    }
+    for(i=0; i<4 + 2; i++)
+        // ignore stamp, extra flags, os type
+        (void) fgetc(fd);
+    if (flags & GZ_EXTRA_FIELD) {
+        n = fgetc(fd);
+        n|= fgetc(fd) << 8;
+        // fprintf(stderr, "ingoring extra field length %d\n", n);
+        while(n--) (void) fgetc(fd);
+    }
+    if (flags & GZ_ORIG_NAME) {
+        // fprintf(stderr, "ignoring original name\n");
+        do {
+            c = fgetc(fd);
+        } while (c>0);
+    }
+    if (flags & GZ_COMMENT) {
+        // fprintf(stderr, "ignoring comment\n");
+        do {
+            c = fgetc(fd);
+        } while (c>0);
+    }
+
+    return NULL; // success
+}
+
+/**
+ * parses gz header in memory (see skip_gz_header)
+ *
+ * @param buf where to look for the header
+ * @param n number of bytes in buf
+ * @param dist how many random bytes can be accepted before the header
+ * @param bsize set to the size of the BGZF block if the header contains
+ *     a BC extra subfield (as written by bgzip), set to 0 otherwise
+ *
+ * @return length of header (including preceding bytes), 0 if buf ends
+ *     before the header, -1 if no valid header was found
+ */
+
+long gz_header_length(const unsigned char *buf, size_t n, int dist, long *bsize)
+{
+    size_t i, j, end;
+    int flags, slen;
+
+    *bsize = 0;
+
+    for(i=0; i<=dist && i+1<n; i++)
+	if (buf[i] == 0x1F && buf[i+1] == 0x8B)
+	    break;
+    if (i > dist)
+	return -1;
+    if (i + 10 > n)
+	return 0;
+
+    if (buf[i+2] != GZ_DEFLATED)
+	return -1;
+    flags = buf[i+3];
+    if (flags & (GZ_CONTINUATION | GZ_ENCRYPTED | GZ_RESERVED))
+	return -1;
+    i += 10;
+
+    if (flags & GZ_EXTRA_FIELD) {
+	if (i + 2 > n)
+	    return 0;
+	end = i + 2 + (buf[i] | (buf[i+1] << 8));
+	if (end > n)
+	    return 0;
+	// subfields : SI1, SI2, 2 bytes length, data
+	for(j=i+2; j+4<=end; j+=4+slen) {
+	    slen = buf[j+2] | (buf[j+3] << 8);
+	    if (buf[j] == 'B' && buf[j+1] == 'C' && slen == 2 && j+6 <= end)
+		*bsize = (buf[j+4] | (buf[j+5] << 8)) + 1;
+	}
+	i = end;
+    }
+    if (flags & GZ_ORIG_NAME) {
+	for(; i<n && buf[i]; i++);
+	if (i++ == n)
+	    return 0;
+    }
+    if (flags & GZ_COMMENT) {
+	for(; i<n && buf[i]; i++);
+	if (i++ == n)
+	    return 0;
+    }
+
+    return i;
+}
+
+/**
+ * reads ISIZE (size of inflated data modulo 2^32) from the trailer of the
+ * last gzip member of a file
+ *
+ * @param fd FILE pointer (file position is changed)
+ * @return ISIZE or -1 if it cannot be read
+ */
+
+long long gz_isize(FILE *fd)
+{
+    unsigned char trailer[4];
+
+    if (fseek(fd, -4, SEEK_END) != 0 || fread(trailer, 1, 4, fd) != 4)
+	return -1;
+
+    return trailer[0] | (trailer[1] << 8) | (trailer[2] << 16) |
+	((long long) trailer[3] << 24);
+}
+
+/**
+ * estimates the size of the inflated data of a .gz file : if the file
+ * consists of a single gzip member, its size is ISIZE plus a multiple of
+ * 2^32 and only this multiple has to be guessed
+ *
+ * @param isize see gz_isize()
+ * @param guess approximate size of the inflated data
+ * @return ISIZE plus the multiple of 2^32 nearest to guess; guess if this
+ *     value is less than half of guess (as for files with several gzip
+ *     members, where ISIZE is the size of the last member only) or ISIZE
+ *     is unknown
+ */
+
+size_t gz_usize(long long isize, size_t guess)
+{
+    unsigned long long usize;
+
+    if (isize < 0)
+	return guess;
+
+    usize = isize;
+    while (usize + (1ULL << 31) < guess)
+	usize += 1ULL << 32;
+
+    if (2 * usize < guess)
+	return guess;
+
+    return usize;
+}
+
+/**
+ * estimates the size of the inflated data of a .gz file by inflating its
+ * first GZ_PROBE_SIZE bytes and extrapolating (see gz_usize); this is the
+ * estimate returned by inflated_size() and kvarq.fastq.inflated_size()
+ *
+ * @param fd FILE pointer (file position is changed)
+ * @param compressed size of the file
+ * @param isize see gz_isize()
+ * @return estimated size (exact if the whole file was inflated); the size
+ *     of the file if it does not start with a gzip header
+ */
+
+size_t gz_estimate(FILE *fd, size_t compressed, long long isize)
+{
+    unsigned char *inbuf, *outbuf;
+    mz_stream mzs;
+    size_t m, consumed, inflated;
+    int status;
+
+    if (fseek(fd, 0, SEEK_SET) != 0 || skip_gz_header(fd, 0) != NULL)
+	return compressed;
+    consumed = ftell(fd);
+
+    inbuf = (unsigned char *) malloc(GZ_PROBE_SIZE);
+    outbuf = (unsigned char *) malloc(SCANBUFSIZE);
+    memset((void *) &mzs, 0, sizeof(mz_stream));
+    if (inbuf == NULL || outbuf == NULL ||
+	    mz_inflateInit2(&mzs, -MZ_DEFAULT_WINDOW_BITS) != MZ_OK)
+    {
+	free(inbuf);
+	free(outbuf);
+	return gz_usize(isize, compressed);
+    }
+
+    m = fread(inbuf, 1, GZ_PROBE_SIZE - MIN(consumed, GZ_PROBE_SIZE), fd);
+    mzs.next_in = inbuf;
+    mzs.avail_in = m;
+    inflated = 0;
+    do
+    {
+	mzs.next_out = outbuf;
+	mzs.avail_out = SCANBUFSIZE;
+	status = mz_inflate(&mzs, MZ_NO_FLUSH);
+	inflated += SCANBUFSIZE - mzs.avail_out;
+    } while (status == MZ_OK && mzs.avail_out == 0);
+    consumed += m - mzs.avail_in;
+
+    mz_inflateEnd(&mzs);
+    free(inbuf);
+    free(outbuf);
+
+    if (status == MZ_STREAM_END)
+    {
+	consumed += 8; // trailer
+	if (consumed == compressed)
+	    return inflated;
+    }
+
+    return gz_usize(isize, (size_t) ((double) inflated * compressed /
+		MAX(1, consumed)));
+}
+
+/**
+ * checks whether a stream starts with a gzip header (without consuming
+ * any data : streams cannot be rewound)
+ *
+ * @return 1 if the first byte is the first magic byte of a gzip header
+ *     (.fastq files start with '@'), 0 otherwise
+ */
+
+int gz_sniff(FILE *fd)
+{
+    int c;
+
+    c = fgetc(fd);
+    if (c == EOF)
+	return 0;
+    ungetc(c, fd);
+
+    return c == 0x1F;
+}
+
+
+/* index .gz files {{{2 */
+
+/*
+ * if the scanner is configured with gzindex=1, the state of the
+ * decompressor is saved every GZ_CHECKPOINT_SPACING bytes of inflated data
+ * while a .gz file is read sequentially; when the same file is scanned
+ * again, every thread can then resume inflating at one of these checkpoints
+ * and scan the corresponding part of the file
+ *
+ * gzindexes is shared by all scanners (locked by gzindex_mutex); indexes
+ * that are used by a scan are only freed after gzindex_release()
+ *
+ * the indexes are only kept in memory (a checkpoint holds a whole
+ * inflate_state) : they only speed up rescans of the same file within one
+ * process (e.g. the GUI), which is why they are not built by default; BGZF
+ * files are indexed without inflating them (see bgzf_index) and without
+ * saving any decompressor state
+ */
+
+void gzindex_free(struct gzindex *gzi)
+{
+    int i;
+
+    if (gzi == NULL)
+	return;
+    for(i=0; i<gzi->n; i++)
+	free(gzi->cps[i].state);
+    free(gzi->cps);
+    free(gzi->fname);
+    free(gzi);
+}
+
+/**
+ * reads last 8 bytes of file
+ *
+ * @return 0 on success, -1 on error
+ */
+
+int gz_trailer(const char *fname, unsigned char *trailer)
+{
+    FILE *fd;
+    int ret;
+
+    fd = fopen(fname, "rb");
+    if (fd == NULL)
+	return -1;
+    ret = fseek(fd, -8, SEEK_END) == 0 && fread(trailer, 1, 8, fd) == 8 ? 0 : -1;
+    fclose(fd);
+
+    return ret;
+}
+
+/**
+ * @return index of file if it was completely read before (and was not
+ *     modified since), NULL otherwise; the index must be released with
+ *     gzindex_release()
+ */
+
+struct gzindex *gzindex_find(const char *fname)
+{
+    struct gzindex *gzi;
+    struct stat st;
+    unsigned char trailer[8];
+
+    if (stat(fname, &st) != 0 || gz_trailer(fname, trailer) != 0)
+	return NULL;
+
+    pthread_mutex_lock(&gzindex_mutex);
+    for(gzi=gzindexes; gzi!=NULL; gzi=gzi->next)
+	if (strcmp(gzi->fname, fname) == 0 &&
+		gzi->size == (long) st.st_size && gzi->mtime == st.st_mtime &&
+		memcmp(gzi->trailer, trailer, 8) == 0)
+	{
+	    gzi->users++;
+	    break;
+	}
+    pthread_mutex_unlock(&gzindex_mutex);
+
+    return gzi;
+}
+
+void gzindex_release(struct gzindex *gzi)
+{
+    pthread_mutex_lock(&gzindex_mutex);
+    if (--gzi->users == 0 && gzi->dropped)
+	gzindex_free(gzi);
+    pthread_mutex_unlock(&gzindex_mutex);
+}
+
+/**
+ * @param fname name of the .gz file to index
+ * @return new (empty) index or NULL if the file cannot be read or memory
+ *         could not be allocated
+ */
+
+struct gzindex *gzindex_new(const char *fname)
+{
+    struct gzindex *gzi;
+    struct stat st;
+
+    if (stat(fname, &st) != 0)
+	return NULL;
+
+    gzi = (struct gzindex *) calloc(1, sizeof(struct gzindex));
+    if (gzi == NULL)
+	return NULL;
+    if (gz_trailer(fname, gzi->trailer) != 0)
+    {
+	free(gzi);
+	return NULL;
+    }
+    gzi->fname = (char *) malloc(strlen(fname) + 1);
+    if (gzi->fname == NULL)
+    {
+	free(gzi);
+	return NULL;
+    }
+    strcpy(gzi->fname, fname);
+    gzi->size = (long) st.st_size;
+    gzi->mtime = st.st_mtime;
+
+    return gzi;
+}
+
+/**
+ * saves current state of decompressor in index
+ *
+ * @param mzs decompressor or NULL at the beginning of a deflated stream
+ * @param upos position within inflated file
+ * @param cpos position within compressed file of next byte to inflate
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int gzindex_checkpoint(struct gzindex *gzi, mz_stream *mzs, size_t upos, long cpos)
+{
+    struct checkpoint *cps;
+    inflate_state *state;
+
+    if (gzi->n == gzi->allocated)
+    {
+	cps = (struct checkpoint *) realloc(gzi->cps,
+		sizeof(struct checkpoint) * (gzi->allocated + 16));
+	if (cps == NULL)
+	    return -1;
+	gzi->cps = cps;
+	gzi->allocated += 16;
+	gzi->bytes += sizeof(struct checkpoint) * 16;
+    }
+
+    state = NULL;
+    if (mzs != NULL)
+    {
+	state = (inflate_state *) malloc(sizeof(inflate_state));
+	if (state == NULL)
+	    return -1;
+	memcpy(state, mzs->state, sizeof(inflate_state));
+	gzi->bytes += sizeof(inflate_state);
+    }
+
+    gzi->cps[gzi->n].upos = upos;
+    gzi->cps[gzi->n].start = upos == 0 ? 0 : (size_t) -1; // see gzindex_records
+    gzi->cps[gzi->n].cpos = cpos;
+    gzi->cps[gzi->n].state = state;
+    gzi->n++;
+
+    return 0;
+}
+
+/**
+ * sets start of checkpoints that precede the record boundary at upos
+ */
+
+void gzindex_records(struct gzindex *gzi, size_t upos)
+{
+    int i;
+
+    for(i=gzi->n-1; i>=0 && gzi->cps[i].start==(size_t) -1; i--);
+    for(i++; i<gzi->n && gzi->cps[i].upos<=upos; i++)
+	gzi->cps[i].start = upos;
+}
+
+/**
+ * adds completed index to gzindexes (replacing older indexes of the same
+ * file and dropping the oldest indexes if all indexes together use more than
+ * GZINDEX_MAX_BYTES; gzi itself is always kept); gzi is owned by gzindexes
+ * afterwards
+ *
+ * @param total size of the inflated file
+ */
+
+void gzindex_store(struct gzindex *gzi, size_t total)
+{
+    struct gzindex **gzip, *old;
+    size_t bytes;
+
+    gzi->total = total;
+    gzindex_records(gzi, total);
+
+    pthread_mutex_lock(&gzindex_mutex);
+    for(gzip=&gzindexes, bytes=gzi->bytes; *gzip!=NULL; )
+	if (strcmp((*gzip)->fname, gzi->fname) == 0 ||
+		(bytes += (*gzip)->bytes) > GZINDEX_MAX_BYTES)
+	{
+	    old = *gzip;
+	    *gzip = old->next;
+	    old->dropped = 1;
+	    if (old->users == 0)
+		gzindex_free(old);
+	}
+	else
+	    gzip = &(*gzip)->next;
+
+    gzi->next = gzindexes;
+    gzindexes = gzi;
+    pthread_mutex_unlock(&gzindex_mutex);
+}
+
+/**
+ * indexes a BGZF file (a series of gzip members that contain their
+ * compressed size in the header and their inflated size in the trailer)
+ * without inflating it; checkpoints are set at block boundaries every
+ * GZ_CHECKPOINT_SPACING bytes of inflated data
+ *
+ * must be called without holding the GIL (see fastq_open() and
+ * prepare_ranges())
+ *
+ * @return index (that was added to gzindexes, to be released with
+ *     gzindex_release()) or NULL if the file is not a valid BGZF file or
+ *     memory could not be allocated
+ */
+
+struct gzindex *bgzf_index(const char *fname)
+{
+    struct gzindex *gzi;
+    FILE *fd;
+    unsigned char header[256], isize[4];
+    long pos, hlen, bsize;
+    size_t upos, m;
+
+    gzi = gzindex_new(fname);
+    if (gzi == NULL)
+	return NULL;
+    fd = fopen(fname, "rb");
+    if (fd == NULL)
+    {
+	gzindex_free(gzi);
+	return NULL;
+    }
+
+    for(pos=0, upos=0; pos<gzi->size; pos+=bsize)
+    {
+	if (fseek(fd, pos, SEEK_SET) != 0)
+	    break;
+	m = fread(header, 1, sizeof(header), fd);
+	hlen = gz_header_length(header, m, 0, &bsize);
+	if (hlen <= 0 || bsize < hlen + 8 || pos + bsize > gzi->size)
+	    break;
+	if (fseek(fd, pos + bsize - 4, SEEK_SET) != 0 ||
+		fread(isize, 1, 4, fd) != 4)
+	    break;
+
+	m = isize[0] | (isize[1] << 8) | (isize[2] << 16) | ((size_t) isize[3] << 24);
+	if (m > 0 && (gzi->n == 0 ||
+		    upos >= gzi->cps[gzi->n - 1].upos + GZ_CHECKPOINT_SPACING))
+	{
+	    if (gzindex_checkpoint(gzi, NULL, upos, pos + hlen) != 0)
+		break;
+	    gzi->cps[gzi->n - 1].start = upos;
+	}
+	upos += m;
+    }
+    fclose(fd);
+
+    if (pos != gzi->size)
+    {
+	gzindex_free(gzi);
+	return NULL;
+    }
+
+    gzi->bgzf = 1;
+    gzi->users = 1;
+    gzindex_store(gzi, upos);
+    return gzi;
+}
+
+/**
+ * @return index of file (from previous scan or built if file is a BGZF
+ *     file) or NULL; the index must be released with gzindex_release()
+ */
+
+struct gzindex *gzindex_get(const char *fname)
+{
+    struct gzindex *gzi;
+
+    gzi = gzindex_find(fname);
+    if (gzi == NULL)
+	gzi = bgzf_index(fname);
+
+    return gzi;
+}
+
+/* read from .fastq files {{{2 */
+
+/**
+ * opens next file in sequence of fastq->fnames
+ *
+ * this next file can be a .fastq or .fastq.gz file regardless of
+ * whether the last file type (although time estimates will be totally
+ * wrong if filetypes are mixed)
+ *
+ * @param fastq fastq_structure where fastq_i points to file that
+ *     should be opened next
+ * @return 0 in case of success, -1 in case of error (exception and
+ *     errstr of scanner are set accordingly)
+ */
+
+int fastq_open_next(struct fastq_file *fastq)
+{
+    struct scanner *sc = fastq->sc;
+    const char *fname, *ret;
+    struct gzindex *gzi;
+
+    if (fastq->fname_i > 0) {
+	// close open file & add bytes already read
+	fastq->ftell0 += ftell(fastq->fd);
+	fclose(fastq->fd);
+	if (fastq->compressed)
+	    mz_inflateEnd(&fastq->mzs);
+	fastq->compressed = 0;
+    }
+
+    fname = fastq->fnames[fastq->fname_i];
+    fastq->fname_i++;
+
+    // CAREFUL : opening the file in mode "r" will result in '\r' being discarded
+    //           from the bytes read into buffer !
+    fastq->streaming = fastq->stream != NULL;
+    if (fastq->streaming)
+    {
+	fastq->fd = fastq->stream;
+	fastq->stream = NULL;
+    }
+    else
+	fastq->fd = fopen(fname,"rb");
+    if (fastq->fd == NULL)
+    {
+	sc->exception = PyExc_IOError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot open file");
+	return -1;
+    }
+
+    if (fastq->streaming ? gz_sniff(fastq->fd) :
+	    strcmp(fname + strlen(fname) - 3, ".gz") == 0)
+    {
+	// initialize datastructure for inflating
+	fastq->compressed = 1;
+
+	// must be reset before call to mz_inflateInit2
+	memset((void *) &fastq->mzs, 0, sizeof(mz_stream));
+
+	if (mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS) != MZ_OK)
+	{
+	    fclose(fastq->fd);
+	    sc->exception = PyExc_RuntimeError;
+	    snprintf(sc->errstr, ERRSTR_LENGTH, "cannot mz_inflateInit()");
+	    return -1;
+	}
+
+	if (fastq->inbuf == NULL)
+	    fastq->inbuf = malloc(SCANBUFSIZE);
+
+	if (fastq->inbuf == NULL)
+	{
+	    fclose(fastq->fd);
+	    sc->exception = PyExc_MemoryError;
+	    snprintf(sc->errstr, ERRSTR_LENGTH, "cannot allocate inbuf");
+	    return -1;
+	}
+
+	fastq->mzs.next_in = (const unsigned char *) fastq->inbuf;
+	if (fastq->streaming)
+	    // until end of stream (see fastq_read)
+	    fastq->remaining = LONG_MAX / 2;
+	else
+	{
+	    fseek(fastq->fd, 0, SEEK_END);
+	    fastq->remaining = ftell(fastq->fd);
+	    fseek(fastq->fd, 0, SEEK_SET);
+	}
+	ret = skip_gz_header(fastq->fd, 0);
+	if (ret != NULL)
+	{
+	    fclose(fastq->fd);
+	    sc->exception = PyExc_IOError;
+	    snprintf(sc->errstr, ERRSTR_LENGTH, "no valid gzip header found "
+		    "at beginning of file : %s", ret);
+	    return -1;
+	}
+	// build index while reading (unless there is already an index or
+	// indexing is not configured, see config())
+	fastq->fpos0 = fastq->fpos;
+	if (fastq->streaming)
+	    return 0;
+	fastq->remaining -= ftell(fastq->fd);
+	gzi = gzindex_get(fname);
+	if (gzi != NULL)
+	    gzindex_release(gzi);
+	else if (sc->gzindex)
+	{
+	    fastq->gzi = gzindex_new(fname);
+	    if (fastq->gzi != NULL && gzindex_checkpoint(fastq->gzi,
+			&fastq->mzs, 0, ftell(fastq->fd)) != 0)
+	    {
+		gzindex_free(fastq->gzi);
+		fastq->gzi = NULL;
+	    }
+	}
+    }
+
+    return 0;
+}
+
+/**
+ * frees fastq_file after fastq_open() failed (and the stream that was not
+ * yet handed over to fastq_open_next())
+ */
+
+void fastq_open_failed(struct fastq_file *fastq)
+{
+    if (fastq->stream != NULL)
+	fclose(fastq->stream);
+    pthread_mutex_destroy(&fastq->mutex);
+    free(fastq->inbuf);
+    free(fastq->sizes);
+    free(fastq);
+}
+
+/**
+ * opens a .fastq file for further access via fastq_read
+ *
+ * also adds the size of the files to fastq_size_estimated of scanner : the
+ * size of .gz files is exact if they are indexed (see gzindex_get), and
+ * otherwise estimated (see gz_estimate) until the file was read to the end
+ *
+ * @param fnames NULL terminated array of paths of the .fastq files
+ * @param fpos file position of the first record (see FILE_POS_BITS)
+ * @param stream if not NULL then this (single) file is read instead of
+ *     opening fnames[0], which is only used in messages; the stream is
+ *     read sequentially (can be a pipe) and closed by fastq_close() (or
+ *     when fastq_open() fails), its size is not known beforehand
+ * @return pointer to fastq file object or NULL in case of error
+ *         (PyErr_SetString called with appropriate arguments)
+ */
+
+struct fastq_file *fastq_open(struct scanner *sc, const char **fnames, long long fpos,
+	FILE *stream)
+{
+    struct fastq_file *fastq;
+    struct fastq_size *fsize;
+    struct gzindex *gzi;
+    int i;
+    FILE *fd;
+
+    fastq = (struct fastq_file *) malloc(sizeof(struct fastq_file));
+    if (fastq == NULL)
+    {
+	if (stream != NULL)
+	    fclose(stream);
+	sc->exception = PyExc_MemoryError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot allocate struct fastq_file");
+	return NULL;
+    }
+
+    memset(fastq, 0, sizeof(struct fastq_file));
+    fastq->sc = sc;
+    fastq->fnames = fnames;
+    fastq->fpos = fpos;
+    fastq->stream = stream;
+    pthread_mutex_init(&fastq->mutex, NULL);
+
+    for(i = 0; fastq->fnames[i]; i++);
+    fastq->sizes = (struct fastq_size *) calloc(i, sizeof(struct fastq_size));
+    if (fastq->sizes == NULL)
+    {
+	sc->exception = PyExc_MemoryError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot allocate file sizes");
+	fastq_open_failed(fastq);
+	return NULL;
+    }
+
+    // determine overall file size (and size of inflated data)
+    fastq->exact = 1;
+    for(i = 0; fastq->fnames[i]; i++)
+    {
+	fsize = fastq->sizes + i;
+	fsize->isize = -1;
+	fsize->exact = 1;
+	if (stream != NULL)
+	    // size unknown : only bytes read are reported
+	    continue;
+
+	fd = fopen(fastq->fnames[i], "rb");
+	if (fd == NULL)
+	{
+	    sc->exception = PyExc_IOError;
+	    snprintf(sc->errstr, ERRSTR_LENGTH,
+		    "cannot open file '%s' for getting filesize", fastq->fnames[i]);
+	    fastq_open_failed(fastq);
+	    return NULL;
+	}
+	fseek(fd, 0, SEEK_END);
+	fsize->compressed = fsize->inflated = ftell(fd);
+
+	if (strcmp(fastq->fnames[i] + strlen(fastq->fnames[i]) - 3, ".gz") == 0)
+	{
+	    if ((gzi = gzindex_get(fastq->fnames[i])) != NULL)
+	    {
+		fsize->inflated = gzi->total;
+		gzindex_release(gzi);
+	    }
+	    else
+	    {
+		// refined while file is inflated (see fastq_read)
+		fsize->isize = gz_isize(fd);
+		fsize->inflated = gz_estimate(fd, fsize->compressed, fsize->isize);
+		fsize->exact = fastq->exact = 0;
+	    }
+	}
+	fclose(fd);
+
+	fastq->size += fsize->compressed;
+	sc->fastq_size_estimated += fsize->inflated;
+    }
+
+    if (fastq_open_next(fastq) != 0)
+    {
+	fastq_open_failed(fastq);
+	return NULL;
+    }
+
+    return fastq;
+}
+
+/**
+ * opens a .fastq.gz file to inflate a range of records starting at
+ * a checkpoint (see struct gzindex); doesn't update stats
+ * fastq_size_estimated and fastq_parsed
+ *
+ * @param range the file is range->fnames[0]
+ * @return pointer to fastq file object or NULL in case of error
+ *         (exception and errstr of scanner are set accordingly)
+ */
+
+struct fastq_file *fastq_open_range(struct scanner *sc, struct range *range)
+{
+    struct fastq_file *fastq;
+
+    fastq = (struct fastq_file *) calloc(1, sizeof(struct fastq_file));
+    if (fastq != NULL)
+	fastq->inbuf = (char *) malloc(SCANBUFSIZE);
+    if (fastq == NULL || fastq->inbuf == NULL)
+    {
+	free(fastq);
+	sc->exception = PyExc_MemoryError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot allocate struct fastq_file");
+	return NULL;
+    }
+
+    fastq->sc = sc;
+    fastq->fnames = range->fnames;
+    fastq->fname_i = 1;
+    fastq->range = 1;
+    fastq->compressed = 1;
+    pthread_mutex_init(&fastq->mutex, NULL);
+
+    fastq->fd = fopen(fastq->fnames[0], "rb");
+    if (fastq->fd == NULL)
+    {
+	pthread_mutex_destroy(&fastq->mutex);
+	free(fastq->inbuf);
+	free(fastq);
+	sc->exception = PyExc_IOError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot open file");
+	return NULL;
+    }
+
+    if (mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS) != MZ_OK)
+    {
+	fclose(fastq->fd);
+	pthread_mutex_destroy(&fastq->mutex);
+	free(fastq->inbuf);
+	free(fastq);
+	sc->exception = PyExc_RuntimeError;
+	snprintf(sc->errstr, ERRSTR_LENGTH, "cannot mz_inflateInit()");
+	return NULL;
+    }
+    if (range->cp->state != NULL)
+	memcpy(fastq->mzs.state, range->cp->state, sizeof(inflate_state));
+
+    fseek(fastq->fd, 0, SEEK_END);
+    fastq->size = ftell(fastq->fd);
+    fastq->remaining = fastq->size - range->cp->cpos;
+    fseek(fastq->fd, range->cp->cpos, SEEK_SET);
+    fastq->fpos = fastq->fpos0 = range->base + range->cp->upos;
+
+    return fastq;
+}
+
+/**
+ * get length of last partial fastq record in buffer
+ *
+ * @param buf data read from .fastq file
+ * @param n length of data in buf
+ * @return length of last partial record in buf; -1 if no partial buf found at end
+ */
+
+int fastq_rewind(char *buf, int n)
+{
+
+    // we scan for /^\+/ (line3) and then accept the next /^@/ (line1) as the
+    // beginning of a record note that /^\+/ could also be a PHRED score
+    // therefore accept a repeated /^\+/ as the "real" line3
+
+    int state = 0; // 1=found line3
+    int i = 1;
+
+    while (i + 1 < n)
+    {
+	if (buf[n - i] == '+' && 
+		(buf[n - i - 1] == '\n' || buf[n - i - 1] == '\r'))
+	    state = 1; // state might have been 0 OR 1 (see note above)
+	else if (state == 1 && buf[n - i] == '@' &&
+		(buf[n - i - 1] == '\n' || buf[n - i - 1] == '\r'))
+	    return i;
+	i++;
+    }
+
+    return -1;
+}
+
+/**
+ * finds beginning of first record in a buffer that can start in the
+ * middle of a record
+ *
+ * a line starting with '@' is the first line of a record iff the line
+ * two lines further down starts with '+' (if the '@' starts a PHRED score
+ * then the line two lines further down is a base sequence)
+ *
+ * @param buf data read from .fastq file
+ * @param n length of data in buf
+ * @param linestart whether buf[0] is at the beginning of a line
+ * @return offset of first record in buf or -1 if none found
+ */
+
+long fastq_resync(const char *buf, size_t n, int linestart)
+{
+    size_t i, j;
+    int lines;
+
+    for(i=0; i<n; i++)
+    {
+	if ((i == 0 ? !linestart : buf[i - 1] != '\n') || buf[i] != '@')
+	    continue;
+	for(j=i, lines=0; j<n && lines<2; j++)
+	    if (buf[j] == '\n')
+		lines++;
+	if (lines == 2 && j < n && buf[j] == '+')
+	    return i;
+    }
+
+    return -1;
+}
+
+/**
+ * reads content from a .fastq file -- multithread safe
+ *
+ * also updates fastq_size_estimated and fastq_parsed of scanner
+ *
+ * @param fastq pointer as returned by fastq_open
+ * @param buf where the read data is saved
+ * @param buf_size maximum number of bytes that can be saved in buf
+ * @param fposp pointer to file position of first byte in buffer
+ *
+ * @return number of bytes read; this is normally smaller than buf_size
+ *         and the last character is guaranteed to be the end of a
+ *         record (unless the file ends with a partial record).
+ *         returns 0 if EOF is encountered and -1 in case of error
+ *         (with exception/errstr of scanner accordingly set)
+ */
+
+size_t fastq_read(struct fastq_file *fastq, char *buf, size_t buf_size, long long *fposp)
+{
+    struct scanner *sc = fastq->sc;
+    struct fastq_size *fsize;
+    size_t n, leftovers, m, got, usize;
+    long pos, hlen, bsize, cpos;
+    int status;
+    unsigned int avail_out;
+    const char *msg;
+
+    profile_start("fastq_read");
+    pthread_mutex_lock(&fastq->mutex);
+
+    // eof? open next file if available
+    if (fastq->eof != 0) {
+	if (fastq->fnames[fastq->fname_i] != NULL)
+	    if (fastq_open_next(fastq) != 0)
+	    {
+		pthread_mutex_unlock(&fastq->mutex);
+		profile_stop("fastq_read");
+		return -1;
+	    }
+    }
+
+    // copy partial record from last read
+    if (fastq->buf_size > 0)
+    {
+	if (fastq->buf_size > buf_size) {
+	    sc->exception = PyExc_RuntimeError;
+	    strncpy(sc->errstr, "buf_size < fastq->buf_size !", ERRSTR_LENGTH);
+
+	    pthread_mutex_unlock(&fastq->mutex);
+	    profile_stop("fastq_read");
+	    return -1;
+	}
+
+	leftovers = fastq->buf_size;
+	memcpy(buf, fastq->buf, leftovers);
+	free((void *) fastq->buf);
+	fastq->buf_size = 0;
+
+    } else {
+	leftovers = 0;
+    }
+
+    // first byte of buffer within (inflated) file
+    *fposp = fastq->fpos - leftovers;
+    n = 0;
+    fastq->eof = 0;
+
+    if (fastq->compressed)
+    {
+	// read compressed data
+	fastq->mzs.next_out = (unsigned char *) (buf + leftovers);
+	fastq->mzs.avail_out = buf_size - leftovers;
+	do
+	{
+	    // fill up (deflated) inbuf if empty
+	    if (fastq->mzs.avail_in == 0)
+	    {
+		m = MIN(SCANBUFSIZE, fastq->remaining);
+		got = fread(fastq->inbuf, 1, m, fastq->fd);
+		if (got < m && fastq->streaming && ferror(fastq->fd) == 0)
+		    // end of stream
+		    fastq->remaining = m = got;
+		if (got != m)
+		{
+		    sc->exception = PyExc_IOError;
+		    strncpy(sc->errstr, "could not read enough bytes from .fastq.gz", ERRSTR_LENGTH);
+		    if (ferror(fastq->fd) != 0)
+			strcat(sc->errstr, " : I/O error");
+		    if (feof(fastq->fd) != 0)
+			strcat(sc->errstr, " : premature EOF");
+
+		    pthread_mutex_unlock(&fastq->mutex);
+		    profile_stop("fastq_read");
+		    return -1;
+		}
+		/*DBG("\nread %ld bytes into inbuf", m);*/
+		fastq->mzs.next_in = (const unsigned char *) fastq->inbuf;
+		fastq->mzs.avail_in = m;
+		fastq->remaining -= m;
+	    }
+
+	    // inflate inbuf -> buf
+	    avail_out = fastq->mzs.avail_out;
+	    //DBG("will inflate avail_in=%d avail_out=%d", fastq->mzs.avail_in, avail_out);
+	    status = mz_inflate(&fastq->mzs, Z_SYNC_FLUSH);
+
+	    if ((status != MZ_OK) && (status != MZ_STREAM_END))
+	    {
+		sc->exception = PyExc_IOError;
+		snprintf(sc->errstr, ERRSTR_LENGTH,
+			"error while inflating compressed data : status=%d"
+			" fpos=%lld ftell=%ld+%ld avail_in=%d",
+			status, fastq->fpos, fastq->ftell0, ftell(fastq->fd),
+			fastq->mzs.avail_in);
+		// strncpy(errstr, "error while inflating compressed data", ERRSTR_LENGTH);
+
+		pthread_mutex_unlock(&fastq->mutex);
+		profile_stop("fastq_read");
+		return -1;
+	    }
+
+	    // update bytes read in deflated stream
+	    n += avail_out - fastq->mzs.avail_out;
+
+	    /*
+	       DBG("fastq_read [%li] : inflated -> %d bytes",
+	       thread_self(),
+	       avail_out - fastq->mzs.avail_out);
+	       */
+
+	    // some versions of gzip create files with many successive deflated
+	    // streams (BGZF files consist of blocks of at most 64kb); the next
+	    // header is skipped in inbuf if it is complete
+	    if (status == MZ_STREAM_END &&
+		    fastq->remaining + fastq->mzs.avail_in > 10 &&
+		    (hlen = gz_header_length(fastq->mzs.next_in,
+			fastq->mzs.avail_in, 10, &bsize)) > 0)
+	    {
+		fastq->mzs.next_in += hlen;
+		fastq->mzs.avail_in -= hlen;
+		// reset stream (leaves input and output pointers untouched)
+		mz_inflateEnd(&fastq->mzs);
+		mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS);
+	    }
+	    else if (status == MZ_STREAM_END && fastq->streaming)
+	    {
+		// streams cannot be rewound : complete header in inbuf
+		memmove(fastq->inbuf, fastq->mzs.next_in, fastq->mzs.avail_in);
+		m = SCANBUFSIZE - fastq->mzs.avail_in;
+		got = fread(fastq->inbuf + fastq->mzs.avail_in, 1, m, fastq->fd);
+		fastq->mzs.next_in = (const unsigned char *) fastq->inbuf;
+		fastq->mzs.avail_in += got;
+		hlen = gz_header_length(fastq->mzs.next_in,
+			fastq->mzs.avail_in, 10, &bsize);
+		if (got < m)
+		    fastq->remaining = 0;
+		if (hlen > 0)
+		{
+		    fastq->mzs.next_in += hlen;
+		    fastq->mzs.avail_in -= hlen;
+		    mz_inflateEnd(&fastq->mzs);
+		    mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS);
+		}
+		else if (fastq->mzs.avail_in > 10)
+		{
+		    lo_log_msg_add(LOG_ERROR, "cannot read next deflated stream "
+			    "in compressed stream");
+		    fastq->remaining = fastq->mzs.avail_in = 0;
+		}
+		else
+		    fastq->mzs.avail_in = 0;
+	    }
+	    else if (status == MZ_STREAM_END &&
+		    fastq->remaining + fastq->mzs.avail_in > 10)
+	    {
+		// rewind file
+		fseek(fastq->fd, -((long) fastq->mzs.avail_in), SEEK_CUR);
+		fastq->remaining += fastq->mzs.avail_in;
+		// read header -- 2-7 bytes between streams !?
+		pos = ftell(fastq->fd);
+		msg = skip_gz_header(fastq->fd, 10);
+		if (msg != NULL)
+		{
+		    lo_log_msg_add(LOG_ERROR, "cannot read next deflated stream "
 			    "in compressed file : %s", msg);
 		    fastq->remaining = 0;
 		}
-		else
+		else
+		{
+		    fastq->remaining -= ftell(fastq->fd) - pos;
+		    // reset stream
+		    mz_inflateEnd(&fastq->mzs);
+		    mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS);
+		    // reset input
+		    fastq->mzs.avail_in = 0;
+		}
+	    }
+
+	    if (fastq->gzi != NULL && fastq->fpos + n - fastq->fpos0 >=
+		    fastq->gzi->cps[fastq->gzi->n - 1].upos + GZ_CHECKPOINT_SPACING)
+		if (gzindex_checkpoint(fastq->gzi, &fastq->mzs,
+			    fastq->fpos + n - fastq->fpos0,
+			    ftell(fastq->fd) - fastq->mzs.avail_in) != 0)
+		{
+		    // scanning can continue without index
+		    gzindex_free(fastq->gzi);
+		    fastq->gzi = NULL;
+		}
+
+	    // continue reading as long as there is space in output buffer
+	    // AND input is available (less than 10 bytes may remain in input
+	    // buffer without being processed by miniz)
+	} while(fastq->remaining + fastq->mzs.avail_in > 10 &&
+		fastq->mzs.avail_out > 0);
+
+	/*DBG("after while: remaining %ld mzs.avail_in %d mzs.avail_out %d",*/
+		/*fastq->remaining, fastq->mzs.avail_in, fastq->mzs.avail_out);*/
+
+	// EOF is reached when output buffer cannot be filled any more from file
+	// (it's possible having avail_in < 10 but still inflating data...)
+	if (fastq->mzs.avail_out > 0)
+	    fastq->eof = 1;
+
+	// update guess : extrapolate inflated size of current file (exact
+	// modulo 2^32 if it consists of a single gzip member), or set it to
+	// the number of bytes inflated when the end of the file is reached
+	fsize = fastq->range || fastq->exact ? NULL :
+	    fastq->sizes + fastq->fname_i - 1;
+	cpos = ftell(fastq->fd) - fastq->mzs.avail_in;
+	if (fsize != NULL && !fsize->exact && (cpos > 0 || fastq->eof))
+	{
+	    if (fastq->eof)
+		usize = fastq->fpos + n - fastq->fpos0;
+	    else
+		usize = gz_usize(fsize->isize, (size_t) ((double) fsize->compressed *
+			    (fastq->fpos + n - fastq->fpos0) / cpos));
+	    pthread_mutex_lock(&sc->fastq_mutex);
+	    sc->fastq_size_estimated += usize - fsize->inflated;
+	    pthread_mutex_unlock(&sc->fastq_mutex);
+	    fsize->inflated = usize;
+	    fsize->exact = fastq->eof;
+	}
+
+	// index is complete when file was read to the end
+	if (fastq->eof && fastq->gzi != NULL)
+	{
+	    gzindex_store(fastq->gzi, fastq->fpos + n - fastq->fpos0);
+	    fastq->gzi = NULL;
+	}
+    }
+    else
+    {
+	// read uncompressed data
+	//TODO? mmap instead of read : efficiency vs compatability
+	n += fread((void *) (buf + leftovers), 1, buf_size - leftovers, fastq->fd);
+
+	if (ferror(fastq->fd) != 0) {
+	    sc->exception = PyExc_IOError;
+	    strncpy(sc->errstr, "error while reading from file in fastq_read", ERRSTR_LENGTH);
+
+	    pthread_mutex_unlock(&fastq->mutex);
+	    profile_stop("fastq_read");
+	    return -1;
+	}
+
+	if (feof(fastq->fd) != 0)
+	    fastq->eof = 1;
+    }
+
+    if (n == 0) {
+	// DBG("fastq_read [%li] : reached end of file", thread_self());
+	pthread_mutex_unlock(&fastq->mutex);
+	profile_stop("fastq_read");
+	return leftovers + n;
+    }
+
+    // DBG("updating filepos %ld -> %ld", fastq->fpos, fastq->fpos + n);
+    fastq->fpos += n;
+    if (!fastq->range)
+    {
+	pthread_mutex_lock(&sc->fastq_mutex);
+	sc->fastq_parsed += n;
+	pthread_mutex_unlock(&sc->fastq_mutex);
+    }
+
+    if (fastq->eof == 0)
+    {
+	// save partial record at end to bufer
+	fastq->buf_size = fastq_rewind(buf, leftovers + n);
+
+	if (fastq->buf_size == -1) {
+	    sc->exception = PyExc_RuntimeError;
+	    snprintf(sc->errstr, ERRSTR_LENGTH,
+		    "could find beginning of record; read %ld bytes up to %ld",
+		    n, ftell(fastq->fd));
+
+	    pthread_mutex_unlock(&fastq->mutex);
+	    profile_stop("fastq_read");
+	    return -1;
+	}
+	if (fastq->buf_size > 0) {
+	    fastq->buf = (char *) malloc(fastq->buf_size);
+	    if (fastq->buf == NULL)
+	    {
+		sc->exception = PyExc_MemoryError;
+		PyErr_SetString(PyExc_MemoryError, "cannot allocate new fastq->buf");
+		profile_stop("fastq_read");
+		return -1;
+	    }
+	    memcpy((void *) fastq->buf, buf + leftovers + n - fastq->buf_size,
+		    fastq->buf_size);
+	}
+
+	if (fastq->gzi != NULL)
+	    gzindex_records(fastq->gzi, fastq->fpos - fastq->buf_size - fastq->fpos0);
+    }
+
+    /*DBG("fastq_read [%li] :%s read %ld %ld|%ld|%ld return %ld fpos %ld",*/
+	    /*thread_self(),*/
+	    /*fastq->eof ? " EOF" : "",*/
+	    /*n, // what was read*/
+	    /*leftovers, n - fastq->buf_size, fastq->buf_size, // three parts*/
+	    /*leftovers + n - fastq->buf_size, // what is returned*/
+	    /*fastq->fpos);*/
+
+    pthread_mutex_unlock(&fastq->mutex);
+    profile_stop("fastq_read");
+    return leftovers + n - fastq->buf_size;
+}
+
+void fastq_close(struct fastq_file *fastq)
+{
+    fclose(fastq->fd);
+    if (fastq->compressed)
+	mz_inflateEnd(&fastq->mzs);
+    if (fastq->buf_size)
+	free((void *) fastq->buf);
+    if (fastq->inbuf != NULL)
+	free((void *) fastq->inbuf);
+    gzindex_free(fastq->gzi); // incomplete
+    free(fastq->sizes);
+    pthread_mutex_destroy(&fastq->mutex);
+    free(fastq);
+}
+
+/* map .fastq files {{{2 */
+
+/*
+ * uncompressed .fastq files are mapped into memory and split into ranges
+ * that are scanned in place by every thread
+ */
+
+/**
+ * @param length set to size of file
+ * @param random set if only parts of the file will be read (subsampling)
+ * @return pointer to read-only mapping of file or NULL if the file could
+ *     not be mapped (or is empty)
+ */
+
+const char *map_file(const char *fname, size_t *length, int random)
+{
+#ifdef _WIN32
+    return NULL;
+#else
+    struct stat st;
+    void *data;
+    int fd;
+
+    fd = open(fname, O_RDONLY);
+    if (fd < 0)
+	return NULL;
+    if (fstat(fd, &st) != 0 || st.st_size == 0)
+    {
+	close(fd);
+	return NULL;
+    }
+    data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED)
+	return NULL;
+#if defined(MADV_SEQUENTIAL) && defined(MADV_RANDOM)
+    // when subsampling, only selected blocks are read (see scan_ranges())
+    madvise(data, st.st_size, random ? MADV_RANDOM : MADV_SEQUENTIAL);
+#endif
+
+    *length = st.st_size;
+    return (const char *) data;
+#endif
+}
+
+void unmap_file(const char *data, size_t length)
+{
+#ifndef _WIN32
+    munmap((void *) data, length);
+#endif
+}
+
+/**
+ * asks the kernel to read part of a mapped file ahead (the mapping is not
+ * read ahead when subsampling, see map_file())
+ *
+ * @param data pointer returned by map_file()
+ * @param offset first byte of part
+ * @param length number of bytes in part (must not exceed file)
+ */
+
+void map_willneed(const char *data, size_t offset, size_t length)
+{
+#if !defined(_WIN32) && defined(MADV_WILLNEED)
+    size_t pagesize = (size_t) sysconf(_SC_PAGESIZE);
+
+    length += offset % pagesize;
+    offset -= offset % pagesize;
+    madvise((void *) (data + offset), length, MADV_WILLNEED);
+#endif
+}
+
+/**
+ * @return number of ranges a mapped file of given size is split into
+ */
+
+int map_nranges(size_t length, int nthreads)
+{
+    size_t n;
+
+    n = MAX((size_t) nthreads, (length + MAP_RANGE_SIZE - 1) / MAP_RANGE_SIZE);
+
+    return (int) MIN(n, length);
+}
+
+/* chunk ring {{{2 */
+
+/*
+ * reader threads fill chunks with records (reading and inflating without
+ * holding up the scanning threads) and hand them over to the scanning
+ * threads; every file of a scan (e.g. both files of a paired set) has its
+ * own reader, so that the files are inflated concurrently; the number of
+ * chunks is fixed and the readers wait for empty chunks if the scanning
+ * threads fall behind
+ */
+
+void ring_free(struct ring *ring)
+{
+    int i;
+
+    if (ring->chunks != NULL)
+	for(i=0; i<ring->n; i++)
+	    free(ring->chunks[i].buf);
+    free(ring->chunks);
+    free(ring->empty);
+    free(ring->full);
+    pthread_mutex_destroy(&ring->mutex);
+    pthread_cond_destroy(&ring->filled);
+    pthread_cond_destroy(&ring->emptied);
+}
+
+/**
+ * @param n number of chunks to allocate
+ * @param readers number of reader threads (see ring_reader_done)
+ * @param sc scanner whose stall statistics are updated
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int ring_init(struct ring *ring, int n, int readers, struct scanner *sc)
+{
+    int i;
+
+    memset(ring, 0, sizeof(struct ring));
+    ring->sc = sc;
+    ring->readers = readers;
+    pthread_mutex_init(&ring->mutex, NULL);
+    pthread_cond_init(&ring->filled, NULL);
+    pthread_cond_init(&ring->emptied, NULL);
+
+    ring->chunks = (struct chunk *) calloc(n, sizeof(struct chunk));
+    ring->empty = (int *) malloc(sizeof(int) * n);
+    ring->full = (int *) malloc(sizeof(int) * n);
+    if (ring->chunks == NULL || ring->empty == NULL || ring->full == NULL)
+    {
+	ring_free(ring);
+	return -1;
+    }
+    ring->n = n;
+
+    for(i=0; i<n; i++)
+    {
+	ring->chunks[i].buf = (char *) malloc(SCANBUFSIZE);
+	if (ring->chunks[i].buf == NULL)
+	{
+	    ring_free(ring);
+	    return -1;
+	}
+	ring->empty[ring->nempty++] = i;
+    }
+
+    return 0;
+}
+
+/**
+ * waits for an empty chunk (time is added to reader_stall of scanner)
+ *
+ * @return chunk or NULL if scanning was aborted
+ */
+
+struct chunk *ring_get_empty(struct ring *ring)
+{
+    struct chunk *chunk = NULL;
+    double t0;
+
+    pthread_mutex_lock(&ring->mutex);
+    if (ring->nempty == 0 && !ring->done)
+    {
+	t0 = now();
+	while(ring->nempty == 0 && !ring->done)
+	    pthread_cond_wait(&ring->emptied, &ring->mutex);
+	ring->sc->reader_stall += now() - t0;
+    }
+    if (!ring->done)
+	chunk = ring->chunks + ring->empty[--ring->nempty];
+    pthread_mutex_unlock(&ring->mutex);
+
+    return chunk;
+}
+
+void ring_put_full(struct ring *ring, struct chunk *chunk)
+{
+    pthread_mutex_lock(&ring->mutex);
+    ring->full[(ring->head + ring->nfull++) % ring->n] = chunk - ring->chunks;
+    pthread_cond_signal(&ring->filled);
+    pthread_mutex_unlock(&ring->mutex);
+}
+
+/**
+ * waits for a filled chunk (time is added to worker_stall of scanner)
+ *
+ * @return chunk or NULL if all chunks were scanned (or scanning aborted)
+ */
+
+struct chunk *ring_get_full(struct ring *ring)
+{
+    struct chunk *chunk = NULL;
+    double t0;
+
+    pthread_mutex_lock(&ring->mutex);
+    if (ring->nfull == 0 && !ring->done)
+    {
+	t0 = now();
+	while(ring->nfull == 0 && !ring->done)
+	    pthread_cond_wait(&ring->filled, &ring->mutex);
+	ring->sc->worker_stall += now() - t0;
+    }
+    if (ring->nfull > 0)
+    {
+	chunk = ring->chunks + ring->full[ring->head];
+	ring->head = (ring->head + 1) % ring->n;
+	ring->nfull--;
+    }
+    pthread_mutex_unlock(&ring->mutex);
+
+    return chunk;
+}
+
+void ring_put_empty(struct ring *ring, struct chunk *chunk)
+{
+    pthread_mutex_lock(&ring->mutex);
+    ring->empty[ring->nempty++] = chunk - ring->chunks;
+    pthread_cond_signal(&ring->emptied);
+    pthread_mutex_unlock(&ring->mutex);
+}
+
+/**
+ * called by scanning threads when they finish (or when scanning is
+ * aborted); wakes up all waiting threads
+ */
+
+void ring_done(struct ring *ring)
+{
+    pthread_mutex_lock(&ring->mutex);
+    ring->done = 1;
+    pthread_cond_broadcast(&ring->filled);
+    pthread_cond_broadcast(&ring->emptied);
+    pthread_mutex_unlock(&ring->mutex);
+}
+
+/**
+ * called by every reader when its file was read; calls ring_done() when
+ * the last reader finished
+ */
+
+void ring_reader_done(struct ring *ring)
+{
+    int readers;
+
+    pthread_mutex_lock(&ring->mutex);
+    readers = --ring->readers;
+    pthread_mutex_unlock(&ring->mutex);
+
+    if (readers == 0)
+	ring_done(ring);
+}
+
+/* packed bases {{{2 */
+
+/*
+ * bases are packed into 64bit words (2 bits per base) with a separate
+ * mask for all other characters; mismatches of up to 32 bases are then
+ * counted with a single XOR/popcount. positions masked in both sequences
+ * are compared character by character (e.g. 'N' equals 'N' but not '.')
+ */
+
+#define LANES 0x5555555555555555ULL
+
+// 32 bases starting at pos
+#define WINDOW(words, pos) (((pos)&31) == 0 ? (words)[(pos)>>5] : \
+	((words)[(pos)>>5] >> (((pos)&31)*2)) | \
+	((words)[((pos)>>5)+1] << (64-((pos)&31)*2)))
+
+void packed_free(struct packed *p)
+{
+    free(p->bases);
+    free(p->mask);
+    p->bases = p->mask = NULL;
+    p->size = 0;
+}
+
+/**
+ * packs bases into p (reusing memory already allocated)
+ *
+ * @param raw characters to pack; pointer is stored in p
+ * @param n number of characters
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int pack(struct packed *p, const char *raw, int n)
+{
+    unsigned long long *bases, *mask, b, m;
+    int i, j, w, c, words;
+
+    words = n/32 + 2; // WINDOW() reads one word past the end
+    if (words > p->size)
+    {
+	bases = (unsigned long long *) realloc(p->bases, sizeof(unsigned long long) * words);
+	if (bases == NULL)
+	    return -1;
+	p->bases = bases;
+	mask = (unsigned long long *) realloc(p->mask, sizeof(unsigned long long) * words);
+	if (mask == NULL)
+	    return -1;
+	p->mask = mask;
+	p->size = words;
+    }
+
+    // (c>>1)&3 is different for each of ACGT
+    p->raw = raw;
+    for(w=0, i=0; w<words; w++)
+    {
+	for(j=0, b=0, m=0; j<32 && i<n; j++, i++)
+	{
+	    c = (unsigned char) raw[i];
+	    b |= (unsigned long long) ((c >> 1) & 3) << (2*j);
+	    if (c != 'A' && c != 'C' && c != 'G' && c != 'T')
+		m |= 1ULL << (2*j);
+	}
+	p->bases[w] = b;
+	p->mask[w] = m;
+    }
+
+    return 0;
+}
+
+/**
+ * @return number of mismatches between a[i..i+n-1] and b[j..j+n-1] (stops
+ *     counting after more than maxerrors mismatches)
+ */
+
+int mismatches(const struct packed *a, int i, const struct packed *b, int j, int n,
+	int maxerrors)
+{
+    unsigned long long x, ma, mb, both, lanes;
+    int e, m;
+
+    for(e=0; n>0 && e<=maxerrors; i+=m, j+=m, n-=m)
+    {
+	m = MIN(n, 32);
+	lanes = m == 32 ? LANES : LANES & ((1ULL << (2*m)) - 1);
+
+	x = WINDOW(a->bases, i) ^ WINDOW(b->bases, j);
+	x = (x | (x >> 1)) & lanes;
+	ma = WINDOW(a->mask, i) & lanes;
+	mb = WINDOW(b->mask, j) & lanes;
+
+	e += popcount64((x & ~(ma | mb)) | (ma ^ mb));
+
+	for(both = ma & mb; both; both &= both - 1)
+	    if (a->raw[i + ctz64(both)/2] != b->raw[j + ctz64(both)/2])
+		e++;
+    }
+
+    return e;
+}
+
+/* seed index {{{2 */
+
+/*
+ * instead of aligning every read with every sequence at every offset, all
+ * k-mers of the sequences are hashed into an index once per findseqs() call;
+ * a read then only has to be aligned on the diagonals where one of its own
+ * k-mers hits the index
+ *
+ * the seed length k is chosen such that every alignment that is considered
+ * (at least minoverlap bases for partial overlaps, and at least minlength
+ * bases when a read contains a sequence or vice versa) can be split into
+ * maxerrors+1 disjoint k-mers -- one of which has to match exactly if the
+ * alignment has at most maxerrors mismatches (pigeonhole principle). the
+ * seeded scan therefore reports exactly the same hits as the brute force
+ * scan, which is still used for reads/sequences shorter than minlength
+ */
+
+#define SEED_KMIN 4
+#define SEED_KMAX 16
+#define SEED_BASE 0x100000001B3ULL
+#define SEED_MIX 0x9E3779B97F4A7C15ULL
+
+unsigned long long seed_hash(const char *s, int k)
+{
+    unsigned long long h;
+    int j;
+
+    for(j=0, h=0; j<k; j++)
+	h = h*SEED_BASE + (unsigned char) s[j];
+
+    return h;
+}
+
+void automaton_free(struct automaton *ac)
+{
+    if (ac == NULL)
+	return;
+    free(ac->delta);
+    free(ac->fail);
+    free(ac->depth);
+    free(ac->out);
+    free(ac->dict);
+    free(ac->next);
+    free(ac->lo);
+    free(ac->hi);
+    free(ac->sorted);
+    free(ac);
+}
+
+/**
+ * builds Aho-Corasick automaton of all (non empty) sequences
+ *
+ * @param seqlist NULL terminated list of sequences
+ * @param seqlengths lengths of sequences in seqlist
+ * @return automaton or NULL if memory could not be allocated
+ */
+
+struct automaton *automaton_build(char **seqlist, int *seqlengths)
+{
+    struct automaton *ac;
+    int n, nn, seqi, i, c, u, v, f, w, sp, rank, *stack, *cursor;
+    long total;
+
+    ac = (struct automaton *) calloc(1, sizeof(struct automaton));
+    if (ac == NULL)
+	return NULL;
+    ac->seqlengths = seqlengths;
+
+    // characters that do not occur in any sequence share class 0
+    for(n=0, total=1, ac->width=1; seqlist[n]; n++)
+	for(i=0, total+=seqlengths[n]; i<seqlengths[n]; i++)
+	    if (ac->cls[(unsigned char) seqlist[n][i]] == 0)
+		ac->cls[(unsigned char) seqlist[n][i]] = ac->width++;
+    w = ac->width;
+
+    ac->delta = (int *) malloc(sizeof(int) * total * w);
+    ac->fail = (int *) malloc(sizeof(int) * total);
+    ac->depth = (int *) malloc(sizeof(int) * total);
+    ac->out = (int *) malloc(sizeof(int) * total);
+    ac->dict = (int *) malloc(sizeof(int) * total);
+    ac->lo = (int *) malloc(sizeof(int) * total);
+    ac->hi = (int *) malloc(sizeof(int) * total);
+    ac->next = (int *) malloc(sizeof(int) * MAX(n, 1));
+    ac->sorted = (int *) malloc(sizeof(int) * MAX(n, 1));
+    stack = (int *) malloc(sizeof(int) * 2 * total);
+    if (ac->delta == NULL || ac->fail == NULL || ac->depth == NULL ||
+	    ac->out == NULL || ac->dict == NULL || ac->lo == NULL ||
+	    ac->hi == NULL || ac->next == NULL || ac->sorted == NULL ||
+	    stack == NULL)
+    {
+	free(stack);
+	automaton_free(ac);
+	return NULL;
+    }
+    cursor = stack + total;
+
+    // build trie
+    for(i=0; i<total*w; i++)
+	ac->delta[i] = -1;
+    ac->depth[0] = 0;
+    ac->out[0] = -1;
+    for(seqi=0, nn=1; seqi<n; seqi++)
+    {
+	ac->next[seqi] = -1;
+	if (seqlengths[seqi] == 0)
+	    continue;
+
+	for(i=0, u=0; i<seqlengths[seqi]; i++)
+	{
+	    c = ac->cls[(unsigned char) seqlist[seqi][i]];
+	    if (ac->delta[u*w + c] < 0)
+	    {
+		ac->delta[u*w + c] = nn;
+		ac->depth[nn] = ac->depth[u] + 1;
+		ac->out[nn] = -1;
+		nn++;
+	    }
+	    u = ac->delta[u*w + c];
+	}
+	ac->next[seqi] = ac->out[u];
+	ac->out[u] = seqi;
+    }
+
+    // sequences starting with the string of a node are sorted[lo..hi-1]
+    // (depth first traversal of trie, children have larger node numbers)
+    rank = 0;
+    sp = 1;
+    stack[0] = 0;
+    cursor[0] = 1;
+    ac->lo[0] = 0;
+    while(sp > 0)
+    {
+	u = stack[sp-1];
+	c = cursor[sp-1]++;
+	if (c >= w)
+	{
+	    ac->hi[u] = rank;
+	    sp--;
+	    continue;
+	}
+	v = ac->delta[u*w + c];
+	if (v <= u)
+	    continue;
+	ac->lo[v] = rank;
+	for(seqi=ac->out[v]; seqi!=-1; seqi=ac->next[seqi])
+	    ac->sorted[rank++] = seqi;
+	stack[sp] = v;
+	cursor[sp] = 1;
+	sp++;
+    }
+
+    // fail links and complete transitions (breadth first)
+    ac->fail[0] = 0;
+    ac->dict[0] = -1;
+    for(c=0, sp=0; c<w; c++)
+    {
+	v = ac->delta[c];
+	if (v > 0)
+	{
+	    ac->fail[v] = 0;
+	    ac->dict[v] = -1;
+	    stack[sp++] = v;
+	}
+	else
+	    ac->delta[c] = 0;
+    }
+    for(i=0; i<sp; i++)
+    {
+	u = stack[i];
+	for(c=0; c<w; c++)
+	{
+	    v = ac->delta[u*w + c];
+	    f = ac->delta[ac->fail[u]*w + c];
+	    if (v > u)
+	    {
+		ac->fail[v] = f;
+		ac->dict[v] = ac->out[f] != -1 ? f : ac->dict[f];
+		stack[sp++] = v;
+	    }
+	    else
+		ac->delta[u*w + c] = f;
+	}
+    }
+
+    free(stack);
+    return ac;
+}
+
+void seqindex_free(struct seqindex *idx)
+{
+    int seqi;
+
+    if (idx == NULL)
+	return;
+    free(idx->buckets);
+    free(idx->seeds);
+    automaton_free(idx->ac);
+    if (idx->packed != NULL)
+	for(seqi=0; seqi<idx->nseqs; seqi++)
+	    packed_free(idx->packed + seqi);
+    free(idx->packed);
+    free(idx->indexed);
+    free(idx);
+}
+
+/**
+ * builds index of all k-mers in seqlist
+ *
+ * uses maxerrors and minoverlap to determine seed length
+ *
+ * @param seqlist NULL terminated list of sequences
+ * @param seqlengths lengths of sequences in seqlist
+ * @param maxerrors maximum number of mismatches of alignments
+ * @param minoverlap minimum number of bases of partial overlaps
+ * @return index or NULL if memory could not be allocated
+ */
+
+struct seqindex *seqindex_build(char **seqlist, int *seqlengths,
+	int maxerrors, int minoverlap)
+{
+    struct seqindex *idx;
+    int n, seqi, pos, k, bits;
+    long nseeds, nbuckets, i;
+    unsigned long long h, m;
+
+    idx = (struct seqindex *) calloc(1, sizeof(struct seqindex));
+    if (idx == NULL)
+	return NULL;
+    idx->maxerrors = maxerrors;
+    idx->minoverlap = minoverlap;
+
+    for(n=0; seqlist[n]; n++);
+    idx->nseqs = n;
+    idx->indexed = (char *) calloc(n + 1, 1);
+    idx->packed = (struct packed *) calloc(n + 1, sizeof(struct packed));
+    if (idx->indexed == NULL || idx->packed == NULL) {
+	seqindex_free(idx);
+	return NULL;
+    }
+    for(seqi=0; seqi<n; seqi++)
+	if (pack(idx->packed + seqi, seqlist[seqi], seqlengths[seqi]) != 0) {
+	    seqindex_free(idx);
+	    return NULL;
+	}
+
+    k = MIN(SEED_KMAX, minoverlap / (maxerrors + 1));
+    if (k < SEED_KMIN)
+	return idx; // idx->k == 0 : scan brute force
+
+    idx->k = k;
+    idx->minlength = k * (maxerrors + 1);
+    for(i=0, idx->bk=1; i<k-1; i++)
+	idx->bk *= SEED_BASE;
+
+    nseeds = 0;
+    for(seqi=0; seqi<n; seqi++)
+	if (seqlengths[seqi] >= idx->minlength) {
+	    idx->indexed[seqi] = 1;
+	    nseeds += seqlengths[seqi] - k + 1;
+	}
+
+    for(bits=10; (1L<<bits) < 2*nseeds; bits++);
+    nbuckets = 1L << bits;
+    idx->shift = 64 - bits;
+
+    idx->buckets = (long *) calloc(nbuckets + 1, sizeof(long));
+    idx->seeds = (struct seed *) malloc(sizeof(struct seed) * MAX(nseeds, 1));
+    if (idx->buckets == NULL || idx->seeds == NULL) {
+	seqindex_free(idx);
+	return NULL;
+    }
+
+    // count seeds per bucket, then fill buckets back to front
+    for(seqi=0; seqi<n; seqi++)
+	if (idx->indexed[seqi])
+	    for(pos=0; pos<=seqlengths[seqi]-k; pos++) {
+		h = seed_hash(seqlist[seqi] + pos, k);
+		idx->buckets[(h*SEED_MIX) >> idx->shift]++;
+	    }
+    for(i=1; i<=nbuckets; i++)
+	idx->buckets[i] += idx->buckets[i-1];
+    for(seqi=n-1; seqi>=0; seqi--)
+	if (idx->indexed[seqi])
+	    for(pos=seqlengths[seqi]-k; pos>=0; pos--) {
+		m = seed_hash(seqlist[seqi] + pos, k) * SEED_MIX;
+		i = --idx->buckets[m >> idx->shift];
+		idx->seeds[i].check = (unsigned int) (m >> 16);
+		idx->seeds[i].seqi = seqi;
+		idx->seeds[i].pos = pos;
+	    }
+
+    // exact matching : sequences within reads and overlaps with the end of
+    // reads are found with an automaton, all other alignments must contain
+    // the first k-mer of the read
+    if (maxerrors == 0)
+    {
+	idx->ac = automaton_build(seqlist, seqlengths);
+	if (idx->ac == NULL)
+	{
+	    seqindex_free(idx);
+	    return NULL;
+	}
+	for(seqi=0; seqi<n; seqi++)
+	    idx->indexed[seqi] = seqlengths[seqi] > 0;
+    }
+
+    return idx;
+}
+
+int diagonal_cmp(const void *a, const void *b)
+{
+    const struct diagonal *x = (const struct diagonal *) a;
+    const struct diagonal *y = (const struct diagonal *) b;
+
+    if (x->seqi != y->seqi)
+	return x->seqi < y->seqi ? -1 : 1;
+    if (x->d != y->d)
+	return x->d < y->d ? -1 : 1;
+    return 0;
+}
+
+int add_candidate(struct candidates *cands, int seqi, int d)
+{
+    struct diagonal *items;
+
+    if (cands->n == cands->size)
+    {
+	items = (struct diagonal *) realloc(cands->items,
+		sizeof(struct diagonal) * (cands->size + 1024));
+	if (items == NULL)
+	    return -1;
+	cands->items = items;
+	cands->size += 1024;
+    }
+    cands->items[cands->n].seqi = seqi;
+    cands->items[cands->n].d = d;
+    cands->n++;
+
+    return 0;
+}
+
+/**
+ * adds diagonals of all seeds matching k-mer starting at read[q]
+ *
+ * @param h seed_hash() of k-mer
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int seed_lookup(struct seqindex *idx, struct candidates *cands, unsigned long long h, int q)
+{
+    unsigned long long m;
+    unsigned int check;
+    long i, j;
+
+    m = h * SEED_MIX;
+    check = (unsigned int) (m >> 16);
+    i = idx->buckets[m >> idx->shift];
+    j = idx->buckets[(m >> idx->shift) + 1];
+
+    for(; i<j; i++)
+	if (idx->seeds[i].check == check)
+	    if (add_candidate(cands, idx->seeds[i].seqi, q - idx->seeds[i].pos) != 0)
+		return -1;
+
+    return 0;
+}
+
+/**
+ * adds diagonals of exact matches : one pass of the automaton over the read
+ * finds all sequences within the read, the fail links of the last state
+ * are all suffixes of the read that overlap the beginning of sequences;
+ * overlaps with the beginning of the read and reads within sequences are
+ * found via the first k-mer of the read
+ *
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int automaton_lookup(struct seqindex *idx, struct candidates *cands, const char *read, int rl)
+{
+    struct automaton *ac = idx->ac;
+    int minoverlap = idx->minoverlap;
+    int q, u, t, seqi, l, r;
+
+    for(q=0, u=0; q<rl; q++)
+    {
+	u = ac->delta[u*ac->width + ac->cls[(unsigned char) read[q]]];
+	for(t=ac->out[u]!=-1 ? u : ac->dict[u]; t!=-1; t=ac->dict[t])
+	    for(seqi=ac->out[t]; seqi!=-1; seqi=ac->next[seqi])
+		if (add_candidate(cands, seqi, q + 1 - ac->depth[t]) != 0)
+		    return -1;
+    }
+
+    // depth decreases along fail links
+    for(t=u; t>0 && ac->depth[t]>=minoverlap; t=ac->fail[t])
+    {
+	l = ac->depth[t];
+	if (l >= rl)
+	    continue;
+	for(r=ac->lo[t]; r<ac->hi[t]; r++)
+	{
+	    seqi = ac->sorted[r];
+	    if (ac->seqlengths[seqi] > l)
+		if (add_candidate(cands, seqi, rl - l) != 0)
+		    return -1;
+	}
+    }
+
+    return seed_lookup(idx, cands, seed_hash(read, idx->k), 0);
+}
+
+/**
+ * looks up all k-mers of a read in the index (or runs the automaton if
+ * the index was built for exact matching)
+ *
+ * @param idx index as returned by seqindex_build
+ * @param cands is filled with all diagonals hit by the read, sorted by
+ *     sequence and diagonal (without duplicates)
+ * @param read first base of read
+ * @param rl length of read; must be at least idx->minlength
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int seqindex_lookup(struct seqindex *idx, struct candidates *cands, const char *read, int rl)
+{
+    int q, k;
+    long i, j;
+    unsigned long long h;
+
+    k = idx->k;
+    cands->n = 0;
+
+    if (idx->ac != NULL)
+    {
+	if (automaton_lookup(idx, cands, read, rl) != 0)
+	    return -1;
+    }
+    else
+	for(q=0, h=seed_hash(read, k); q<=rl-k; q++)
+	{
+	    if (q > 0)
+		h = (h - (unsigned char) read[q-1] * idx->bk) * SEED_BASE
+		    + (unsigned char) read[q+k-1];
+
+	    if (seed_lookup(idx, cands, h, q) != 0)
+		return -1;
+	}
+
+    if (cands->n == 0)
+	return 0;
+
+    qsort(cands->items, cands->n, sizeof(struct diagonal), diagonal_cmp);
+    for(i=1, j=0; i<cands->n; i++)
+	if (diagonal_cmp(cands->items + i, cands->items + j) != 0)
+	    cands->items[++j] = cands->items[i];
+    cands->n = j + 1;
+
+    return 0;
+}
+
+/* matching reads {{{2 */
+
+/**
+ * aligns read with sequence at every possible offset
+ *
+ * @return 0 on success, -1 if memory for hits could not be allocated
+ */
+
+int match_brute(struct scanargs *args, struct packed *read, struct hits *hits,
+	int seqi, char *startread, int rl, long long fpos)
+{
+    struct packed *packed;
+    int maxerrors = args->index->maxerrors, minoverlap = args->index->minoverlap;
+    int i, seql;
+
+    packed = args->index->packed + seqi;
+    seql= args->seqlengths[seqi];
+
+    if (rl>minoverlap && seql>minoverlap)
+    {
+	// (tail of) read overlaps beginning of sequence
+	// (rl-i<=seql-1) not to count bordercase here and in "read withing seq"
+	for(i=rl-minoverlap; i>0 && rl-i<=seql-1; i--)
+	    if (mismatches(read, i, packed, 0, rl-i, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, -i, rl-i, rl,
+				startread + i) != 0)
+		    return -1;
+
+	// (start of) read overlaps end of sequence
+	for(i=seql-minoverlap; i>0 && seql-i<=rl; i--)
+	    if (mismatches(packed, i, read, 0, seql-i, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, i, seql-i, rl,
+				startread) != 0)
+		    return -1;
+    }
+
+    if (rl>seql)
+    {
+	// sequence within read
+	for(i=0; i<=rl-seql; i++)
+	    if (mismatches(read, i, packed, 0, seql, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, -i, seql, rl,
+				startread + i) != 0)
+		    return -1;
+    }
+    else
+    {
+	// read within sequence
+	for(i=0; i<=seql-rl; i++)
+	    if (mismatches(packed, i, read, 0, rl, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, i, rl, rl,
+				startread) != 0)
+		    return -1;
+    }
+
+    return 0;
+}
+
+/**
+ * aligns read with sequence only on the specified diagonals; the
+ * alignments are checked with the same conditions and in the same
+ * order as in match_brute()
+ *
+ * @param ds diagonals of this sequence, sorted by increasing d
+ * @param n number of diagonals in ds
+ * @return 0 on success, -1 if memory for hits could not be allocated
+ */
+
+int match_diagonals(struct scanargs *args, struct packed *read, struct hits *hits,
+	int seqi, struct diagonal *ds, long n, char *startread, int rl, long long fpos)
+{
+    struct packed *packed;
+    int maxerrors = args->index->maxerrors, minoverlap = args->index->minoverlap;
+    int i, seql;
+    long j;
+
+    packed = args->index->packed + seqi;
+    seql= args->seqlengths[seqi];
+
+    if (rl>minoverlap && seql>minoverlap)
+    {
+	// (tail of) read overlaps beginning of sequence : d=i>0 descending
+	for(j=n-1; j>=0 && ds[j].d>0; j--)
+	{
+	    i = ds[j].d;
+	    if (i>rl-minoverlap || rl-i>seql-1)
+		continue;
+	    if (mismatches(read, i, packed, 0, rl-i, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, -i, rl-i, rl,
+				startread + i) != 0)
+		    return -1;
+	}
+
+	// (start of) read overlaps end of sequence : d=-i<0, i descending
+	for(j=0; j<n && ds[j].d<0; j++)
+	{
+	    i = -ds[j].d;
+	    if (i>seql-minoverlap || seql-i>rl)
+		continue;
+	    if (mismatches(packed, i, read, 0, seql-i, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, i, seql-i, rl,
+				startread) != 0)
+		    return -1;
+	}
+    }
+
+    if (rl>seql)
+    {
+	// sequence within read : d=i>=0 ascending
+	for(j=0; j<n; j++)
+	{
+	    i = ds[j].d;
+	    if (i<0 || i>rl-seql)
+		continue;
+	    if (mismatches(read, i, packed, 0, seql, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, -i, seql, rl,
+				startread + i) != 0)
+		    return -1;
+	}
+    }
+    else
+    {
+	// read within sequence : d=-i<=0, i ascending
+	for(j=n-1; j>=0; j--)
+	{
+	    i = -ds[j].d;
+	    if (i<0 || i>seql-rl)
+		continue;
+	    if (mismatches(packed, i, read, 0, rl, maxerrors) <= maxerrors)
+		if (add_hit(hits, seqi, fpos, i, rl, rl,
+				startread) != 0)
+		    return -1;
+	}
+    }
+
+    return 0;
+}
+
+/**
+ * finds all sequences in a (quality trimmed) read
+ *
+ * reads that are long enough are looked up in the seed index and only
+ * aligned with the sequences/diagonals found there; short reads and
+ * sequences that were not indexed are aligned brute force; sequences that
+ * were retired (see retire_saturated()) are skipped
+ *
+ * @param ws per thread buffers
+ * @param fpos file position of read
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+
+int match_read(struct scanargs *args, struct workspace *ws,
+	char *startread, int rl, long long fpos)
+{
+    struct seqindex *idx = args->index;
+    struct candidates *cands = &ws->cands;
+    int seqi, seeded;
+    long j, n;
+
+    if (pack(&ws->read, startread, rl) != 0)
+	return -1;
+
+    seeded = idx->k > 0 && rl >= idx->minlength;
+    if (seeded && seqindex_lookup(idx, cands, startread, rl) != 0)
+	return -1;
+
+    for(seqi=0, j=0; args->seqlist[seqi]!=NULL; seqi++)
+    {
+	if (seeded && idx->indexed[seqi])
+	{
+	    for(n=0; j+n<cands->n && cands->items[j+n].seqi==seqi; n++);
+	    if (n > 0 && !load_relaxed(args->sc->seqretired[seqi]) && match_diagonals(args, &ws->read,
+			&ws->hits, seqi, cands->items + j, n, startread, rl, fpos) != 0)
+		return -1;
+	    j += n;
+	}
+	else if (!load_relaxed(args->sc->seqretired[seqi]) &&
+		match_brute(args, &ws->read, &ws->hits, seqi, startread, rl, fpos) != 0)
+	    return -1;
+    }
+
+    return 0;
+}
+
+/* subsampling records {{{2 */
+
+/**
+ * decides whether records starting at the given file position are scanned
+ * when subsampling (see config())
+ *
+ * the file is divided in blocks of SAMPLE_BLOCK_SIZE bytes and every block
+ * is selected with probability sample, depending only on its number and
+ * sample_seed : the same records are selected independently of the number
+ * of threads, the size of chunks and whether the file is compressed
+ *
+ * @param fpos file position of first byte of record
+ * @return 1 if record is to be scanned, 0 otherwise
+ */
+
+int sample_fpos(struct scanner *sc, long long fpos)
+{
+    unsigned long long x;
+
+    if (sc->sample >= 1)
+	return 1;
+
+    // splitmix64
+    x = (unsigned long long) (fpos / SAMPLE_BLOCK_SIZE) +
+	(unsigned long long) sc->sample_seed * 0x9e3779b97f4a7c15ULL;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    x ^= x >> 31;
+
+    return (x >> 11) * (1. / 9007199254740992.) < sc->sample;
+}
+
+/* read_chunks {{{2 */
+
+/**
+ * fills chunks of the ring with records from one of the .fastq files until
+ * the end of file is reached
+ *
+ * sets exception, errstr of scanner if exception occured
+ */
+
+void read_chunks(struct reader *reader)
+{
+    struct scanargs *args = reader->args;
+    struct scanner *sc = args->sc;
+    struct chunk *chunk;
+
+    while(sc->exception == NULL && sc->stop == 0 &&
+	    (chunk = ring_get_empty(args->ring)) != NULL)
+    {
+	chunk->bl = fastq_read(reader->fastq, chunk->buf, SCANBUFSIZE, &chunk->fpos);
+	if (chunk->bl == 0 || chunk->bl == (size_t) -1)
+	{
+	    ring_put_empty(args->ring, chunk);
+	    break;
+	}
+	ring_put_full(args->ring, chunk);
+    }
+
+    ring_reader_done(args->ring);
+}
+
+/* scan_filepart {{{2 */
+
+void workspace_free(struct workspace *ws)
+{
+    free(ws->cands.items);
+    packed_free(&ws->read);
+    hits_free(&ws->hits);
+}
+
+/**
+ * scans all records in buf
+ *
+ * sets exception, errstr of scanner if exception occured
+ *
+ * @param ws per thread buffers (hits are added to ws->hits)
+ * @param buf must start with a record
+ * @param bl number of bytes in buf
+ * @param fpos file position of first byte in buf
+ * @param end records starting at or after this file position are not
+ *     scanned; use LLONG_MAX to scan all records in buf
+ * @return 0 if all records were scanned, 1 if a record was found that
+ *     starts at or after end, -1 in case of error
+ */
+
+int scan_chunk(struct scanargs *args, struct workspace *ws,
+	char *buf, size_t bl, long long fpos, long long end)
+{
+    struct scanner *sc = args->sc;
+    char *ptr, *rstart, *rnext, *startread, *plus, *startlongest, *startscore, *qtr;
+    long recordi;
+    int lines, rl, sampled;
+    long buf_recs, buf_sampled, buf_tooshort;
+    size_t buf_bytes;
+
+    recordi = -1;
+
+    // rnext[0] == '@' (1st byte of next record)
+    rnext = buf;
+
+    // loop over reads in buf {{{3
+    buf_recs = buf_sampled = buf_tooshort = 0;
+    buf_bytes = 0;
+    while(rnext - buf < bl)
+    {
+	rstart = rnext;
+
+	// record belongs to next part of file
+	if (fpos + (rstart-buf) >= end)
+	{
+	    ws->stats->records_parsed += buf_recs;
+	    ws->stats->records_sampled += buf_sampled;
+	    ws->stats->sampled_bytes += buf_bytes;
+	    count_hits(sc, &ws->hits, ws->stats);
+	    batches_put(&ws->hits, 0);
+	    return 1;
+	}
+
+	sampled = sample_fpos(sc, fpos + (rstart-buf));
+
+	if (sc->domore && sampled)
+	    analyse_record(sc, ws->stats, rstart, bl-(rstart-buf));
+
+	// "parse" record
+	for(ptr=rstart,lines=0,rl=-1,startread=NULL,startscore=NULL,plus=NULL;
+		lines<4 && ptr-buf<bl;
+		ptr++)
+	    if (*ptr == '\n')
+	    {
+		lines++;
+		if (lines == 1)
+		    startread = ptr+1;
+		if (lines == 2)
+		    plus = ptr+1;
+		if (lines == 3)
+		    startscore = ptr+1;
+	    }
+
+	// don't process partial records
+	if (lines<4)
+	    break;
+
+	// .fastq file format sanity checks
+	if (*rstart != '@') {
+	    sc->exception = fastq_exception;
+	    snprintf(sc->errstr, ERRSTR_LENGTH, "record must start with '@' (and not '%c') "
+		    "fpos=%lld", *rstart, fpos + (rstart-buf));
+	    return -1;
+	}
+	if (*plus != '+') {
+	    sc->exception = fastq_exception;
+	    snprintf(sc->errstr, ERRSTR_LENGTH, "3rd line of record must start with '+' fpos=%lld",
+		    fpos + (plus-buf));
+	    return -1;
+	}
+
+	rnext = ptr;
+	buf_recs++;
+
+	if (!sampled)
+	    continue;
+
+	buf_sampled++;
+	buf_bytes += rnext - rstart;
+
+	// find longest read with good enough quality
+	for(ptr=startscore, qtr=startscore, startlongest=startscore, rl=0;
+		ptr==startscore || *(ptr-1)!='\n';
+		ptr++)
+	    if (*ptr>=sc->Amin) { // '\n' as well as '\r' are <Amin
+		if (!qtr) qtr = ptr;
+	    } else {
+		if (qtr) {
+		    if ((int) (ptr-qtr) > rl) {
+			rl = (int) (ptr-qtr);
+			startlongest = qtr;
+		    }
+		    qtr = NULL;
+		}
+	    }
+	add_rl(ws->stats, rl);
+	startread += startlongest-startscore;
+
+	// dump_record(rstart, startread, rl);
+
+	/*
+	   if (rl==0) {
+	   char tmpbuf[1024], *tmpptr;
+	   memset((void *) tmpbuf, 0, sizeof(tmpbuf));
+	   for(tmpptr=startscore; *tmpptr!='\n'; tmpptr++)
+	   tmpbuf[tmpptr-startscore] = *tmpptr;
+	   DBG("thread=%ld start=%ld length=%ld", thread_self(), args->start, args->length);
+	   DBG("rl=%d fpos=%ld rstart=%p buf=%p startread=%p startscore=%p ptr=%p qtr=%p",
+	   rl, fpos, rstart, buf, startread, startscore, ptr, qtr);
+
+	   DBG("score=%s", tmpbuf);
+	   }
+	   */
+
+	/*
+	   DBG("parsed : lines=%i startread=%i+%i rl=%i", lines, (int) (startread-buf), (int) (startlongest-startread), (int) rl);
+	   startread[rl] = 0;
+	   DBG("  %s", startread);
+	   startlongest[rl] = 0;
+	   DBG("  %s", startlongest);
+	   */
+
+	recordi += 1;
+	// DBG("record %li rl=%i fpos(rstart)=%li (thread %li)",
+	//    recordi, rl, fpos+(rstart-buf), thread_self());
+
+	if (rl<sc->minreadlength) {
+	    buf_tooshort++;
+	    continue;
+	}
+
+	// DBG("trying record %li (thread %li)", recordi, thread_self());
+	// find sequences
+	if (match_read(args, ws, startread, rl, fpos+(startread-buf)) != 0)
+	{
+	    sc->exception = PyExc_MemoryError;
+	    strncpy(sc->errstr, "cannot allocate memory for results", ERRSTR_LENGTH);
+	    return -1;
+	}
+
+	// findseqs_iter() : don't wait for the end of large (mapped) chunks
+	if (ws->hits.batches != NULL &&
+		ws->hits.nbatch >= ws->hits.batches->batchsize)
+	{
+	    count_hits(sc, &ws->hits, ws->stats);
+	    batches_put(&ws->hits, 0);
+	}
+	// retire sequences before the end of large (mapped) chunks
+	else if (sc->maxcoverage > 0 && (recordi & 1023) == 0)
+	{
+	    count_hits(sc, &ws->hits, ws->stats);
+	    if (sc->stop)
+		break;
+	}
+
+    }
+    // end : loop over reads in buf }}}3
+    ws->stats->records_parsed += buf_recs;
+    ws->stats->records_sampled += buf_sampled;
+    ws->stats->sampled_bytes += buf_bytes;
+    count_hits(sc, &ws->hits, ws->stats);
+    batches_put(&ws->hits, 0);
+
+    return 0;
+}
+
+/**
+ * scans chunks of .fastq file as they are filled by read_chunks()
+ *
+ * sets exception, errstr of scanner if exception occured
+ *
+ * @param ws per thread buffers (hits are merged after thread finished)
+ */
+
+void scan_filepart(struct workspace *ws)
+{
+    struct scanargs *args = ws->args;
+    struct scanner *sc = args->sc;
+    struct chunk *chunk;
+
+    // scan file chunk by chunk {{{3
+    while(sc->exception == NULL && sc->stop == 0
+	    && (chunk = ring_get_full(args->ring)) != NULL)
+    {
+	profile_start("scan buf");
+	// DBG("read %li bytes (thread %li)", chunk->bl, thread_self());
+	if (scan_chunk(args, ws, chunk->buf, chunk->bl, chunk->fpos,
+		    LLONG_MAX) < 0)
+	    break;
+	ring_put_empty(args->ring, chunk);
+	profile_stop("scan buf");
+    }
+    // end : scan file chunk by chunk }}}3
+
+    // exception, errstr set by read_chunks() in case of error
+    ring_done(args->ring);
+    batches_done(&ws->hits);
+}
+
+/* scan_ranges {{{2 */
+
+/**
+ * scans the records of a mapped range in place; when subsampling, blocks
+ * that are not selected by sample_fpos() are skipped without reading them
+ *
+ * sets exception, errstr of scanner if exception occured
+ */
+
+void scan_mapped(struct scanargs *args, struct workspace *ws,
+	struct range *range)
+{
+    struct scanner *sc = args->sc;
+    long long lo, hi;
+    size_t skip;
+    long offset;
+
+    // records that start after range->start (or at the beginning of the
+    // file) up to and including range->end; with sample<1 block by block
+    for(lo = range->start; lo <= range->end && sc->exception == NULL && sc->stop == 0;
+	    lo = hi)
+    {
+	hi = range->end + 1;
+	if (sc->sample < 1)
+	    hi = MIN(hi, (lo / SAMPLE_BLOCK_SIZE + 1) * SAMPLE_BLOCK_SIZE);
+	if (!sample_fpos(sc, lo))
+	    continue;
+
+	skip = lo - range->base;
+	if (sc->sample < 1)
+	    // block and the end of its last record
+	    map_willneed(range->data, skip,
+		    MIN(2 * SAMPLE_BLOCK_SIZE, range->length - skip));
+	offset = skip == 0 ? 0 : fastq_resync(range->data + skip,
+		range->length - skip,
+		lo != range->start && range->data[skip - 1] == '\n');
+	if (offset < 0)
+	    break;
+	if (scan_chunk(args, ws, (char *) range->data + skip + offset,
+		    range->length - skip - offset, lo + offset, hi) < 0)
+	    break;
+    }
+}
+
+/**
+ * inflates and scans ranges of indexed .gz files (every thread resumes
+ * inflating at a different checkpoint) and scans ranges of mapped .fastq
+ * files in place until all ranges are scanned
+ *
+ * ranges of BGZF and mapped files start at arbitrary positions : such
+ * a range contains all records that start after a newline within the
+ * range (the first range of a file starts with its first record)
+ *
+ * sets exception, errstr of scanner if exception occured
+ *
+ * @param ws per thread buffers (hits are merged after thread finished)
+ */
+
+void scan_ranges(struct workspace *ws)
+{
+    struct scanargs *args = ws->args;
+    struct scanner *sc = args->sc;
+    struct range *range;
+    struct fastq_file *fastq;
+    char *buf;
+    size_t bl, skip;
+    long long fpos, end, lo, hi;
+    long offset;
+    int ret, resync, linestart;
+
+    buf = (char *) malloc(SCANBUFSIZE);
+    if (buf == NULL)
+    {
+	sc->exception = PyExc_MemoryError;
+	strncpy(sc->errstr, "cannot allocate memory for scanning", ERRSTR_LENGTH);
+	batches_done(&ws->hits);
+	return;
+    }
+
+    while(sc->exception == NULL && sc->stop == 0)
+    {
+	pthread_mutex_lock(&sc->range_mutex);
+	range = args->nextrange < args->nranges ? args->ranges + args->nextrange++ : NULL;
+	pthread_mutex_unlock(&sc->range_mutex);
+	if (range == NULL)
+	    break;
+	if (range->start >= range->end)
+	    continue;
+
+	if (range->data != NULL)
+	{
+	    // no copying, no locking
+	    profile_start("scan buf");
+	    scan_mapped(args, ws, range);
+	    ws->stats->parsed += range->end - range->start;
+	    profile_stop("scan buf");
+	    continue;
+	}
+
+	fastq = fastq_open_range(sc, range);
+	if (fastq == NULL)
+	    break;
+
+	// inflate from checkpoint; scan records from range->start to range->end
+	ret = 0;
+	resync = range->resync && range->start != range->base;
+	linestart = 0;
+	end = range->resync ? range->end + 1 : range->end;
+	while(ret == 0 && sc->exception == NULL && sc->stop == 0)
+	{
+	    profile_start("scan buf");
+	    bl = fastq_read(fastq, buf, SCANBUFSIZE, &fpos);
+	    if (bl == 0 || bl == (size_t) -1)
+	    {
+		profile_stop("scan buf");
+		break;
+	    }
+	    if (fpos + (long long) bl <= range->start)
+	    {
+		profile_stop("scan buf");
+		continue;
+	    }
+
+	    lo = MAX(fpos, range->start);
+	    hi = MIN(fpos + (long long) bl, range->end);
+	    if (hi > lo)
+		ws->stats->parsed += hi - lo;
+
+	    skip = lo - fpos;
+	    if (resync)
+	    {
+		offset = fastq_resync(buf + skip, bl - skip, linestart);
+		if (offset < 0)
 		{
-		    fastq->remaining -= ftell(fastq->fd) - pos;
-		    // reset stream
-		    mz_inflateEnd(&fastq->mzs);
-		    mz_inflateInit2(&fastq->mzs, -MZ_DEFAULT_WINDOW_BITS);
-		    // reset input
-		    fastq->mzs.avail_in = 0;
+		    // buf ends with a complete record
+		    ret = fpos + (long long) bl >= end;
+		    linestart = 1;
+		    profile_stop("scan buf");
+		    continue;
 		}
+		skip += offset;
+		resync = 0;
 	    }
+	    ret = scan_chunk(args, ws, buf + skip, bl - skip, fpos + skip,
+		    end);
+	    profile_stop("scan buf");
+	}
 
-	    // continue reading as long as there is space in output buffer
-	    // AND input is available (less than 10 bytes may remain in input
-	    // buffer without being processed by miniz)
-	} while(fastq->remaining + fastq->mzs.avail_in > 10 &&
-		fastq->mzs.avail_out > 0);
+	fastq_close(fastq);
+    }
+
+    free(buf);
+    batches_done(&ws->hits);
+}
+
+
+/* module functions {{{1 */
+
+/* Scanner.stats {{{2 */
+
+    static PyObject *
+scanner_stats(Scanner *self, PyObject *args)
+{
+    struct scanner *sc = &self->sc;
+    int i, j;
+    PyObject *rls, *sbhs, *shs;
+    float progress;
+    double sampled;
+    struct threadstats *ts;
+    long rls_longest, records_parsed, records_sampled, rls_buf[MAX_READLENGTH];
+    long seqbasehits, seqhits;
+    size_t parsed, sampled_bytes;
+
+    // sum up statistics of all scanning threads
+    memset((void *) rls_buf, 0, sizeof(rls_buf));
+    rls_longest = -1;
+    records_parsed = records_sampled = 0;
+    parsed = sc->fastq_parsed;
+    sampled_bytes = 0;
+    for(ts=sc->threadstats; ts<sc->threadstats+sc->nthreadstats; ts++)
+    {
+	for(i=0; i<=ts->rls_longest && i<MAX_READLENGTH; i++)
+	    rls_buf[i] += ts->rls_buf[i];
+	rls_longest = MAX(rls_longest, ts->rls_longest);
+	records_parsed += ts->records_parsed;
+	records_sampled += ts->records_sampled;
+	parsed += ts->parsed;
+	sampled_bytes += ts->sampled_bytes;
+    }
+
+    rls = PyTuple_New(rls_longest+1);
+    for(i=0; i<=rls_longest; i++) {
+	// longer reads are only counted in rls_longest
+	PyTuple_SetItem(rls, i, PyInt_FromLong(i<MAX_READLENGTH ? rls_buf[i] : 0));
+	//DBG("rl=%d %ldx", i, rls_buf[i]);
+    }
+
+    sbhs = PyTuple_New(sc->nseqs);
+    shs = PyTuple_New(sc->nseqs);
+    for(i=0; i<sc->nseqs; i++)
+    {
+	for(j=0, seqbasehits=seqhits=0; j<sc->nthreadstats; j++)
+	{
+	    seqbasehits += sc->threadstats[j].seqbasehits[i];
+	    seqhits += sc->threadstats[j].seqhits[i];
+	}
+	PyTuple_SetItem(sbhs, i, PyInt_FromLong(seqbasehits));
+	PyTuple_SetItem(shs, i, PyInt_FromLong(seqhits));
+    }
+
+    // DBG("scanner_stats : parsed=%li total=%li", parsed, total);
 
-	/*DBG("after while: remaining %ld mzs.avail_in %d mzs.avail_out %d",*/
-		/*fastq->remaining, fastq->mzs.avail_in, fastq->mzs.avail_out);*/
+    progress = 0;
+    if (sc->fastq_size_estimated > 0)
+	progress = ((float) MIN(parsed, sc->fastq_size_estimated)) / sc->fastq_size_estimated;
 
-	// EOF is reached when output buffer cannot be filled any more from file
-	// (it's possible having avail_in < 10 but still inflating data...)
-	if (fastq->mzs.avail_out > 0)
-	    fastq->eof = 1;
+    // fraction of the parsed bytes that were in sampled records
+    sampled = 1;
+    if (sc->sample < 1)
+	sampled = parsed > 0 ?
+	    MIN(1, (double) sampled_bytes / parsed) : 0;
 
-	// update guess
-	fastq_size_estimated = (size_t) (
-		(float) fastq->size * (fastq->fpos + n) / (fastq->ftell0 + ftell(fastq->fd)));
-    }
-    else
-    {
-	// read uncompressed data
-	//TODO? mmap instead of read : efficiency vs compatability
-	n += fread((void *) (buf + leftovers), 1, buf_size - leftovers, fastq->fd);
+    return Py_BuildValue("{sOsfsOsOsOsOsOsOsOsdsdsisd}",
+	    "readlengths", rls,
+	    "progress", progress,
+	    "nseqbasehits", sbhs,
+	    "nseqhits", shs,
+	    "parsed", PyInt_FromLong(parsed),
+	    "total", PyInt_FromLong(sc->fastq_size_estimated),
+	    "sigints", PyInt_FromLong(sigints - sc->sigints_base),
+	    "records_parsed", PyInt_FromLong(records_parsed),
+	    "records_sampled", PyInt_FromLong(records_sampled),
+	    "reader_stall", sc->reader_stall,
+	    "worker_stall", sc->worker_stall,
+	    "nretired", sc->nretired,
+	    "sampled", sampled
+	    );
+}
 
-	if (ferror(fastq->fd) != 0) {
-	    exception = PyExc_IOError;
-	    strncpy(errstr, "error while reading from file in fastq_read", ERRSTR_LENGTH);
+/* Scanner.findseqs {{{2 */
 
-	    pthread_mutex_unlock(&fastq_read_mutex);
-	    profile_stop("fastq_read");
-	    return -1;
-	}
+void unmap_ranges(struct scanargs *args)
+{
+    int i;
 
-	if (feof(fastq->fd) != 0)
-	    fastq->eof = 1;
+    for(i=0; i<args->nranges; i++)
+    {
+	if (args->ranges[i].data != NULL &&
+		args->ranges[i].start == args->ranges[i].base)
+	    unmap_file(args->ranges[i].data, args->ranges[i].length);
+	if (args->ranges[i].gzi != NULL)
+	    gzindex_release(args->ranges[i].gzi);
     }
+}
 
-    if (n == 0) {
-	// DBG("fastq_read [%li] : reached end of file", thread_self());
-	pthread_mutex_unlock(&fastq_read_mutex);
-	profile_stop("fastq_read");
-	return leftovers + n;
+/**
+ * if all files are either .fastq files, .gz files that were indexed during
+ * a previous scan, or BGZF files : sets fastq_size_estimated of scanner to the
+ * exact size and args->ranges (.fastq files are mapped into memory;
+ * .gz files are only inflated in ranges if more than one thread is used)
+ *
+ * @return 0 on success (also if files cannot be scanned in ranges),
+ *     -1 if memory could not be allocated
+ */
+
+int prepare_ranges(struct scanargs *args, const char **fnames)
+{
+    struct gzindex *gzi;
+    struct stat st;
+    const char *data;
+    size_t length, total;
+    long long base;
+    int i, j, n, m, nalloc, compressed;
+
+    for(i=0, n=0, total=0, compressed=0; fnames[i]; i++)
+    {
+	if (strcmp(fnames[i] + strlen(fnames[i]) - 3, ".gz") != 0)
+	{
+	    if (stat(fnames[i], &st) != 0)
+		return 0;
+	    n += map_nranges(st.st_size, args->sc->nthreads);
+	    total += st.st_size;
+	    continue;
+	}
+	if ((gzi = gzindex_get(fnames[i])) == NULL)
+	    return 0;
+	n += gzi->n;
+	total += gzi->total;
+	compressed = 1;
+	gzindex_release(gzi);
     }
 
-    // DBG("updating filepos %ld -> %ld", fastq->fpos, fastq->fpos + n);
-    fastq->fpos += n;
-    fastq_parsed += n;
+    // no need to guess
+    args->sc->fastq_size_estimated = total;
+    for(i=0; i<args->nfastqs; i++)
+	args->fastqs[i]->exact = 1;
 
-    if (fastq->eof == 0)
-    {
-	// save partial record at end to bufer
-	fastq->buf_size = fastq_rewind(buf, leftovers + n);
+    if ((args->sc->nthreads < 2 && compressed) || n == 0)
+	return 0;
 
-	if (fastq->buf_size == -1) {
-	    exception = PyExc_RuntimeError;
-	    snprintf(errstr, ERRSTR_LENGTH,
-		    "could find beginning of record; read %ld bytes up to %ld",
-		    n, ftell(fastq->fd));
+    args->ranges = (struct range *) calloc(n, sizeof(struct range));
+    if (args->ranges == NULL)
+	return -1;
+    nalloc = n;
 
-	    pthread_mutex_unlock(&fastq_read_mutex);
-	    profile_stop("fastq_read");
-	    return -1;
-	}
-	if (fastq->buf_size > 0) {
-	    fastq->buf = (char *) malloc(fastq->buf_size);
-	    if (fastq->buf == NULL)
+    for(i=0, n=0; fnames[i]; i++)
+    {
+	base = (long long) i << FILE_POS_BITS;
+	if (strcmp(fnames[i] + strlen(fnames[i]) - 3, ".gz") != 0)
+	{
+	    if (stat(fnames[i], &st) != 0)
+		break;
+	    if (st.st_size == 0)
+		continue;
+	    data = map_file(fnames[i], &length, args->sc->sample < 1);
+	    if (data == NULL)
+		break;
+	    m = map_nranges(length, args->sc->nthreads);
+	    if (n + m > nalloc)
 	    {
-		exception = PyExc_MemoryError;
-		PyErr_SetString(PyExc_MemoryError, "cannot allocate new fastq->buf");
-		profile_stop("fastq_read");
-		return -1;
+		unmap_file(data, length);
+		break;
 	    }
-	    memcpy((void *) fastq->buf, buf + leftovers + n - fastq->buf_size,
-		    fastq->buf_size);
+	    for(j=0; j<m; j++, n++)
+	    {
+		args->ranges[n].fnames[0] = fnames[i];
+		args->ranges[n].base = base;
+		args->ranges[n].start = base + length * j / m;
+		args->ranges[n].end = base + length * (j+1) / m;
+		args->ranges[n].resync = 1;
+		args->ranges[n].data = data;
+		args->ranges[n].length = length;
+		args->nranges = n + 1;
+	    }
+	    continue;
+	}
+
+	gzi = gzindex_find(fnames[i]);
+	if (gzi == NULL)
+	    break;
+	if (n + gzi->n > nalloc)
+	{
+	    gzindex_release(gzi);
+	    break;
+	}
+	for(j=0; j<gzi->n; j++, n++)
+	{
+	    args->ranges[n].fnames[0] = fnames[i];
+	    args->ranges[n].gzi = j == 0 ? gzi : NULL;
+	    args->ranges[n].cp = gzi->cps + j;
+	    args->ranges[n].base = base;
+	    args->ranges[n].start = base + gzi->cps[j].start;
+	    args->ranges[n].end = base + (j+1 < gzi->n ? gzi->cps[j+1].start : gzi->total);
+	    args->ranges[n].resync = gzi->bgzf;
+	    args->nranges = n + 1;
 	}
     }
 
-    /*DBG("fastq_read [%li] :%s read %ld %ld|%ld|%ld return %ld fpos %ld",*/
-	    /*thread_self(),*/
-	    /*fastq->eof ? " EOF" : "",*/
-	    /*n, // what was read*/
-	    /*leftovers, n - fastq->buf_size, fastq->buf_size, // three parts*/
-	    /*leftovers + n - fastq->buf_size, // what is returned*/
-	    /*fastq->fpos);*/
+    if (fnames[i] != NULL)
+    {
+	// files changed : read sequentially instead
+	unmap_ranges(args);
+	free(args->ranges);
+	args->ranges = NULL;
+	args->nranges = 0;
+    }
 
-    pthread_mutex_unlock(&fastq_read_mutex);
-    profile_stop("fastq_read");
-    return leftovers + n - fastq->buf_size;
+    return 0;
 }
 
-void fastq_close(struct fastq_file *fastq)
+/**
+ * frees everything allocated by scan_start() (threads must be joined)
+ */
+
+void scan_free(struct scan *scan)
 {
-    fclose(fastq->fd);
-    if (fastq->buf_size)
-	free((void *) fastq->buf);
-    if (fastq->inbuf != NULL)
-	free((void *) fastq->inbuf);
-    free(fastq);
+    int i;
+
+    free(scan->threads);
+    if (scan->ring_ok)
+	ring_free(&scan->ring);
+    if (scan->args.ranges != NULL)
+	unmap_ranges(&scan->args);
+    free(scan->args.ranges);
+    if (scan->workspaces != NULL)
+	for(i=0; i<scan->nworkspaces; i++)
+	    workspace_free(scan->workspaces + i);
+    free(scan->workspaces);
+    batches_free(scan->batches);
+    seqindex_free(scan->args.index);
+    for(i=0; i<scan->args.nfastqs; i++)
+	fastq_close(scan->args.fastqs[i]);
+    free(scan->args.fastqs);
+    free(scan->readers);
+    free(scan->args.seqlist);
+    free(scan->args.seqlengths);
+    free(scan->args.templates);
+    covmap_free(scan->args.cov);
+    free(scan->singles);
+    for(i=0; i<scan->nstreams; i++)
+	if (scan->streams[i] != NULL)
+	    fclose(scan->streams[i]);
+    free(scan->streams);
+    free(scan->fnames);
+    memset(scan, 0, sizeof(struct scan));
 }
 
-/* scan_filepart {{{2 */
+/**
+ * sets scan->fnames[i] (and scan->streams[i] if fname_obj is a file
+ * descriptor, which is then closed when scanning finishes)
+ *
+ * @return 0 on success, -1 on error (python exception set)
+ */
+
+int scan_fname(struct scan *scan, int i, PyObject *fname_obj)
+{
+    if (PyInt_Check(fname_obj))
+    {
+	scan->fnames[i] = "<stream>";
+	scan->streams[i] = fdopen((int) PyInt_AsLong(fname_obj), "rb");
+	if (scan->streams[i] == NULL)
+	{
+	    PyErr_SetFromErrno(PyExc_IOError);
+	    return -1;
+	}
+	return 0;
+    }
+
+    scan->fnames[i] = PyString_AsString(fname_obj);
+    return scan->fnames[i] == NULL ? -1 : 0;
+}
 
 /**
- * scans .fastq file one BUFSIZE at a time
+ * parses arguments of findseqs(), prepares scanning and starts threads
  *
- * sets globals exception, errstr if exception occured
+ * @param sc scanner whose configuration is used and that receives the
+ *     statistics and errors of the scanning threads
+ * @param scan zeroed struct that will be filled
+ * @param maxbatches if >0 then hits are handed over in batches (see
+ *     findseqs_iter()), at most maxbatches at once
+ * @return 0 on success, -1 on error (python exception set, everything
+ *     freed); threads must be joined with scan_join() on success
  */
 
-void scan_filepart(struct scanargs *args)
+int scan_start(struct scanner *sc, struct scan *scan, PyObject *fname_obj,
+	PyObject *seqlist_obj, PyObject *cov_obj, PyObject *templates_obj,
+	long batchsize, int maxbatches)
 {
-    char *buf, *ptr, *rstart, *rnext, *startread, *plus, *startlongest, *startscore, *seq, *qtr;
-    size_t bl;
-    size_t fpos;
-    long recordi;
-    int i, j, e, lines, seqi, seql, rl;
-    ll_item *tail;
-    long buf_recs, buf_tooshort;
+    struct scanargs *args = &scan->args;
+    PyObject *str;
+    long t;
+    int i, j, n, threadi, err, nreaders;
 
-    buf = (char *) malloc(SCANBUFSIZE);
-    if (buf == NULL)
+    args->sc = sc;
+
+    // argument parsing {{{3
+
+    if (PyString_Check(fname_obj) || PyInt_Check(fname_obj)) {
+	n = 1;
+	scan->fnames = (const char **) malloc(sizeof(char *) * 2);
+	scan->streams = (FILE **) calloc(1, sizeof(FILE *));
+	if (scan->fnames == NULL || scan->streams == NULL) {
+	    scan_free(scan);
+	    PyErr_NoMemory();
+	    return -1;
+	}
+	scan->nstreams = n;
+	if (scan_fname(scan, 0, fname_obj) != 0) {
+	    scan_free(scan);
+	    return -1;
+	}
+
+    } else if (PySequence_Check(fname_obj)) {
+	n = PySequence_Size(fname_obj);
+	scan->fnames = (const char **) malloc(sizeof(char *) * (n + 1));
+	scan->streams = (FILE **) calloc(n + 1, sizeof(FILE *));
+	if (scan->fnames == NULL || scan->streams == NULL) {
+	    scan_free(scan);
+	    PyErr_NoMemory();
+	    return -1;
+	}
+	scan->nstreams = n;
+	for(i = 0; i < n; i++)
+	{
+	    str = PySequence_GetItem(fname_obj, i);
+	    err = str == NULL || scan_fname(scan, i, str) != 0;
+	    Py_XDECREF(str);
+	    if (err) {
+		scan_free(scan);
+		return -1;
+	    }
+	}
+
+    } else {
+	PyErr_SetString(PyExc_TypeError, "fname must be [sequence of] string[s]");
+	return -1;
+    }
+    scan->fnames[n] = NULL;
+
+    if (!PySequence_Check(seqlist_obj))
     {
-	exception = PyExc_MemoryError;
-	strncpy(errstr, "cannot allocate memory for scanning", ERRSTR_LENGTH);
-	return;
+	PyErr_SetString(PyExc_TypeError, "seqlist must be sequence of strings");
+	scan_free(scan);
+	return -1;
     }
 
-    tail = args->root; // set to NULL if add_ll can't allocate memory
-    recordi = -1;
+    args->seqlist = (char **) malloc((PySequence_Size(seqlist_obj)+1) * sizeof(char *));
+    args->seqlengths = (int *) malloc(PySequence_Size(seqlist_obj) * sizeof(int *));
+    if (args->seqlist == NULL || args->seqlengths == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
 
-    // read file buf by buf {{{3
-    while((bl = fastq_read(args->fastq, buf, SCANBUFSIZE, &fpos)) > 0
-	    && exception == NULL && stop == 0)
+    for(i=0; i<PySequence_Size(seqlist_obj); i++) 
     {
-	profile_start("scan buf");
+	str = PySequence_GetItem(seqlist_obj, i);
+	args->seqlist[i] = PyString_AsString(str);
+	if (args->seqlist[i] == NULL)
+	{
+	    PyErr_SetString(PyExc_TypeError, "seqlist must be list of strings");
+	    scan_free(scan);
+	    return -1;
+	}
+	args->seqlengths[i] = (int) PyString_Size(str);
+    }
+    args->seqlist[i] = NULL;
+
+    if (cov_obj != Py_None)
+    {
+	args->cov = covmap_new(cov_obj, args->seqlengths, i);
+	if (args->cov == NULL)
+	{
+	    scan_free(scan);
+	    return -1;
+	}
+    }
 
-	// rnext[0] == '@' (1st byte of next record)
-	rnext = buf;
+    // sequences of the same template are retired together (by default
+    // the sequences counted into the same coverage)
+    args->templates = (int *) malloc(sizeof(int) * (i + 1));
+    if (args->templates == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    for(j=0; j<i; j++)
+	args->templates[j] = args->cov != NULL ? args->cov->covi[j] : j;
+    if (templates_obj != Py_None)
+    {
+	if (!PySequence_Check(templates_obj) || PySequence_Size(templates_obj) != i)
+	{
+	    PyErr_SetString(PyExc_TypeError,
+		    "templates must be sequence of template_nr per sequence");
+	    scan_free(scan);
+	    return -1;
+	}
+	for(j=0; j<i; j++)
+	{
+	    str = PySequence_GetItem(templates_obj, j);
+	    t = str == NULL ? -1 : PyInt_AsLong(str);
+	    Py_XDECREF(str);
+	    if (t == -1 && PyErr_Occurred())
+	    {
+		scan_free(scan);
+		return -1;
+	    }
+	    if (t < 0 || t >= i)
+	    {
+		PyErr_Format(PyExc_ValueError,
+			"template_nr %ld out of range [0, %d)", t, i);
+		scan_free(scan);
+		return -1;
+	    }
+	    args->templates[j] = (int) t;
+	}
+    }
 
-	// DBG("read %li bytes (thread %li)", bl, thread_self());
+    // prepare sequence quest {{{3
+
+    // every file is read by its own reader thread (file positions are
+    // disambiguated by the file index in the upper bits)
+    for(n=0; scan->fnames[n]; n++);
+    scan->singles = (const char **) malloc(sizeof(char *) * 2 * n);
+    args->fastqs = (struct fastq_file **) calloc(n, sizeof(struct fastq_file *));
+    scan->readers = (struct reader *) malloc(sizeof(struct reader) * n);
+    if (scan->singles == NULL || args->fastqs == NULL || scan->readers == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
 
-	// loop over reads in buf {{{4
-	buf_recs = buf_tooshort = 0;
-	while(rnext - buf < bl)
+    sc->fastq_parsed = sc->fastq_size_estimated = 0;
+    for(i=0; i<n; i++)
+    {
+	scan->singles[2*i] = scan->fnames[i];
+	scan->singles[2*i + 1] = NULL;
+	// (reading the header of a stream may block until it is written by
+	// another python thread)
+	Py_BEGIN_ALLOW_THREADS
+	args->fastqs[i] = fastq_open(sc, scan->singles + 2*i,
+		(long long) i << FILE_POS_BITS, scan->streams[i]);
+	Py_END_ALLOW_THREADS
+	scan->streams[i] = NULL;
+	if (args->fastqs[i] == NULL)
 	{
-	    rstart = rnext;
+	    PyErr_SetString(sc->exception, sc->errstr);
+	    sc->exception = NULL;
+	    scan_free(scan);
+	    return -1;
+	}
+	args->nfastqs++;
+	scan->readers[i].args = args;
+	scan->readers[i].fastq = args->fastqs[i];
+    }
 
-	    if (domore)
-		analyse_record(rstart, bl-(rstart-buf));
+    // every scanning thread collects hits in its own workspace
+    scan->nworkspaces = sc->nthreads;
+    scan->workspaces = (struct workspace *) calloc(sc->nthreads, sizeof(struct workspace));
+    if (scan->workspaces == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    if (maxbatches > 0)
+    {
+	scan->batches = batches_new(maxbatches, batchsize, sc->nthreads);
+	if (scan->batches == NULL)
+	{
+	    scan_free(scan);
+	    PyErr_NoMemory();
+	    return -1;
+	}
+    }
+    for(i=0; i<sc->nthreads; i++)
+    {
+	scan->workspaces[i].args = args;
+	scan->workspaces[i].hits.cov = args->cov;
+	scan->workspaces[i].hits.batches = scan->batches;
+    }
 
-	    // "parse" record
-	    for(ptr=rstart,lines=0,rl=-1,startread=NULL,startscore=NULL,plus=NULL;
-		    lines<4 && ptr-buf<bl;
-		    ptr++)
-		if (*ptr == '\n')
-		{
-		    lines++;
-		    if (lines == 1)
-			startread = ptr+1;
-		    if (lines == 2)
-			plus = ptr+1;
-		    if (lines == 3)
-			startscore = ptr+1;
-		}
+    args->index = seqindex_build(args->seqlist, args->seqlengths,
+	    sc->maxerrors, sc->minoverlap);
+    if (args->index == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    lo_log_msg(LOG_DEBUG, "seed index : k=%d minlength=%d",
+	    args->index->k, args->index->minlength);
+
+    // .gz files that were scanned before and BGZF files can be inflated
+    // in parallel (streams are only read sequentially)
+    for(i=0; i<n && args->fastqs[i]->streaming == 0; i++);
+    err = 0;
+    if (i == n)
+    {
+	// (walking the blocks of large BGZF files takes a while)
+	Py_BEGIN_ALLOW_THREADS
+	err = prepare_ranges(args, scan->fnames);
+	Py_END_ALLOW_THREADS
+    }
+    if (err != 0)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    if (args->ranges != NULL)
+	lo_log_msg(LOG_DEBUG, "scanning %d parts of file(s) in parallel",
+		args->nranges);
 
-	    // don't process partial records
-	    if (lines<4)
-		break;
+    // two chunks per scanning thread : one being scanned, one waiting
+    nreaders = args->ranges == NULL ? args->nfastqs : 0;
+    if (ring_init(&scan->ring, 2*sc->nthreads + nreaders, nreaders, sc) != 0)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    scan->ring_ok = 1;
+    args->ring = &scan->ring;
 
-	    // .fastq file format sanity checks
-	    if (*rstart != '@') {
-		exception = fastq_exception;
-		snprintf(errstr, ERRSTR_LENGTH, "record must start with '@' (and not '%c') "
-			"fpos=%ld", *rstart, fpos + (rstart-buf));
-		return;
-	    }
-	    if (*plus != '+') {
-		exception = fastq_exception;
-		snprintf(errstr, ERRSTR_LENGTH, "3rd line of record must start with '+' fpos=%ld",
-			fpos + (plus-buf));
-		return;
-	    }
+    if (init_stats(sc, args->seqlist, args->templates, sc->nthreads) != 0)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
+    for(i=0; i<sc->nthreads; i++)
+	scan->workspaces[i].stats = sc->threadstats + i;
 
-	    buf_recs++;
-
-	    rnext = ptr;
-
-	    // find longest read with good enough quality
-	    for(ptr=startscore, qtr=startscore, rl=0;
-		    ptr==startscore || *(ptr-1)!='\n';
-		    ptr++)
-		if (*ptr>=Amin) { // '\n' as well as '\r' are <Amin
-		    if (!qtr) qtr = ptr;
-		} else {
-		    if (qtr) {
-			if ((int) (ptr-qtr) > rl) {
-			    rl = (int) (ptr-qtr);
-			    startlongest = qtr;
-			}
-			qtr = NULL;
-		    }
-		}
-	    add_rl(rl);
-	    startread += startlongest-startscore;
+    profiles_n = 0;
 
-	    // dump_record(rstart, startread, rl);
+    // start threads {{{3
 
-	    /*
-	       if (rl==0) {
-	       char tmpbuf[1024], *tmpptr;
-	       memset((void *) tmpbuf, 0, sizeof(tmpbuf));
-	       for(tmpptr=startscore; *tmpptr!='\n'; tmpptr++)
-	       tmpbuf[tmpptr-startscore] = *tmpptr;
-	       DBG("thread=%ld start=%ld length=%ld", thread_self(), args->start, args->length);
-	       DBG("rl=%d fpos=%ld rstart=%p buf=%p startread=%p startscore=%p ptr=%p qtr=%p",
-	       rl, fpos, rstart, buf, startread, startscore, ptr, qtr);
-
-	       DBG("score=%s", tmpbuf);
-	       }
-	       */
+    // the first threads read one file each, all others scan (or all
+    // threads read and scan their own ranges of indexed .gz files)
+    scan->threads = (pthread_t *) malloc(sizeof(pthread_t) * (sc->nthreads + nreaders));
+    if (scan->threads == NULL)
+    {
+	scan_free(scan);
+	PyErr_NoMemory();
+	return -1;
+    }
 
-	    /*
-	       DBG("parsed : lines=%i startread=%i+%i rl=%i", lines, (int) (startread-buf), (int) (startlongest-startread), (int) rl);
-	       startread[rl] = 0;
-	       DBG("  %s", startread);
-	       startlongest[rl] = 0;
-	       DBG("  %s", startlongest);
-	       */
+    for(threadi=0; threadi<sc->nthreads+nreaders; threadi++)
+    {
 
-	    recordi += 1;
-	    // DBG("record %li rl=%i fpos(rstart)=%li (thread %li)",
-	    //    recordi, rl, fpos+(rstart-buf), thread_self());
+	if (args->ranges != NULL)
+	    err = pthread_create(scan->threads+threadi, NULL,
+		    (void *(*)(void *)) scan_ranges,
+		    (void *) (scan->workspaces + threadi));
+	else if (threadi < nreaders)
+	    err = pthread_create(scan->threads+threadi, NULL,
+		    (void *(*)(void *)) read_chunks,
+		    (void *) (scan->readers + threadi));
+	else
+	    err = pthread_create(scan->threads+threadi, NULL,
+		    (void *(*)(void *)) scan_filepart,
+		    (void *) (scan->workspaces + threadi - nreaders));
 
-	    if (rl<minreadlength) {
-		buf_tooshort++;
-		continue;
-	    }
+	if (err != 0)
+	{
+	    sc->stop++;
+	    ring_done(&scan->ring);
+	    if (scan->batches != NULL)
+		batches_close(scan->batches);
+	    Py_BEGIN_ALLOW_THREADS
+	    for(i=0; i<threadi; i++)
+		pthread_join(scan->threads[i], NULL);
+	    Py_END_ALLOW_THREADS
+	    sc->exception = NULL;
+	    PyErr_SetString(PyExc_RuntimeError, "pthread_create failed");
+	    scan_free(scan);
+	    return -1;
+	}
 
-	    // DBG("trying record %li (thread %li)", recordi, thread_self());
-	    // find sequences
-	    for(seqi=0; args->seqlist[seqi]!=NULL && tail != NULL; seqi++)
-	    {
-		seq = args->seqlist[seqi];
-		seql= args->seqlengths[seqi];
+	// DBG("created thread #%d (%li)", threadi, pthread2long(threads[threadi]));
+    }
+    scan->nstarted = threadi;
 
-		if (rl>minoverlap && seql>minoverlap)
-		{
-		    // (tail of) read overlaps beginning of sequence
-		    // (rl-i<=seql-1) not to count bordercase here and in "read withing seq"
-		    for(i=rl-minoverlap; i>0 && rl-i<=seql-1; i--)
-		    {
-			for(j=0,e=0; i+j<rl && e<=maxerrors; j++)
-			    if (startread[i+j] != seq[j])
-				e++;
-			if (e > maxerrors)
-			    continue;
-			// DBG("adding read where tail overlaps i=%i", i);
-			tail = add_hit(tail, seqi, fpos+(startread-buf), -i, rl-i, rl,
-				args->pyhitseqs, startread + i);
-			if (tail == NULL) break;
-		    }
+    return 0;
+}
 
-		    // (start of) read overlaps end of sequence
-		    for(i=seql-minoverlap; i>0 && seql-i<=rl; i--)
-		    {
-			for(j=0,e=0; i+j<seql && e<=maxerrors; j++)
-			    if (seq[i+j] != startread[j])
-				e++;
-			if (e > maxerrors)
-			    continue;
-			// DBG("adding read where start overlaps i=%i", i);
-			tail = add_hit(tail, seqi, fpos+(startread-buf), i, seql-i, rl,
-				args->pyhitseqs, startread);
-			if (tail == NULL) break;
-		    }
-		}
+/**
+ * waits for all threads started by scan_start() (call without holding the
+ * global interpreter lock)
+ */
 
-		if (rl>seql)
-		{
-		    // sequence within read
-		    for(i=0; i<=rl-seql; i++)
-		    {
-			for(j=0,e=0; j<seql && e<=maxerrors; j++)
-			    if (startread[i+j] != seq[j])
-				e++;
-			if (e > maxerrors)
-			    continue;
-			// DBG("adding sequence within read i=%i ", i);
-			tail = add_hit(tail, seqi, fpos+(startread-buf), -i, seql, rl,
-				args->pyhitseqs, startread + i);
-			if (tail == NULL) break;
-		    }
-		}
-		else
-		{
-		    // read within sequence
-		    for(i=0; i<=seql-rl; i++)
-		    {
-			for(j=0,e=0; j<rl && e<=maxerrors; j++)
-			    if (seq[i+j] != startread[j])
-				e++;
-			if (e > maxerrors)
-			    continue;
-			// DBG("adding read within sequence i=%i ", i);
-			tail = add_hit(tail, seqi, fpos+(startread-buf), i, rl, rl,
-				args->pyhitseqs, startread);
-		    }
-		}
-	    }
+void scan_join(struct scan *scan)
+{
+    int threadi;
 
-	    if (tail == NULL)
-	    {
-		free(buf);
-		exception = PyExc_MemoryError;
-		strncpy(errstr, "cannot allocate memory for results", ERRSTR_LENGTH);
-		return;
-	    }
+    for(threadi=0; threadi<scan->nstarted; threadi++)
+	pthread_join(scan->threads[threadi], NULL);
+    scan->nstarted = 0;
+}
 
-	}
-	// end : loop over reads in buf }}}4
-	add_records_parsed(buf_recs);
+/**
+ * frees scan (after scan_join()) and sets python exception if an error
+ * occured during scanning
+ *
+ * @return 0 if no error occured, -1 otherwise
+ */
 
-	//DBG("parsed %li -> %li (parsed=%li) recs=%i tooshort=%i",
-	//        pos-(rstart-buf), pos, parsed, buf_recs, buf_tooshort);
-	profile_stop("scan buf");
-    }
-    // end : read file buf by buf }}}3
+int scan_finish(struct scan *scan)
+{
+    struct scanner *sc = scan->args.sc;
 
-    // exception, errstr set if bl == -1
-    free(buf);
-}
+    scan_free(scan);
 
+    lo_log_msg_print();
 
-/* module functions {{{1 */
+    profile_dump();
+
+    if (sc->exception != NULL) {
+	// returning ret=NULL with generate "exception" additonal info "errstr"
+	PyErr_SetString(sc->exception, sc->errstr);
+	sc->exception = NULL;
+	return -1;
+    }
 
-/* engine.stats {{{2 */
+    return 0;
+}
 
     static PyObject *
-engine_stats(PyObject *self, PyObject *args)
+scanner_findseqs(Scanner *self, PyObject *findseqs_args, PyObject *kwargs)
 {
+    static char *kwlist[] = {"fname", "sequences", "columnar", "coverages",
+	"templates", NULL};
+    struct scanner *sc = &self->sc;
+    int columnar = 0;
+    PyObject *fname_obj, *seqlist_obj, *cov_obj, *templates_obj, *ret, *hits,
+	     *hitseqs, *pystats;
+    struct scan scan;
+    struct hits **allhits;
     int i;
-    PyObject *rls, *sbhs, *shs;
-    float progress;
 
-    if (!PyArg_ParseTuple(args, ""))
+    // (protected by the global interpreter lock)
+    if (sc->running != 0)
+    {
+	PyErr_SetString(PyExc_RuntimeError, "findseqs() already running!");
+	return NULL;
+    }
+    cov_obj = templates_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(findseqs_args, kwargs, "OO|iOO", kwlist,
+		&fname_obj, &seqlist_obj, &columnar, &cov_obj, &templates_obj))
 	return NULL;
 
-    rls = PyTuple_New(rls_longest+1);
-    for(i=0; i<=rls_longest; i++) {
-	PyTuple_SetItem(rls, i, PyInt_FromLong(rls_buf[i]));
-	//DBG("rl=%d %ldx", i, rls_buf[i]);
+    sc->running++;
+    sc->stop = 0;
+    sc->sigints_base = sigints;
+
+    memset(&scan, 0, sizeof(struct scan));
+    if (scan_start(sc, &scan, fname_obj, seqlist_obj, cov_obj, templates_obj,
+		0, 0) != 0)
+    {
+	sc->running--;
+	return NULL;
     }
 
-    sbhs = PyTuple_New(nseqs);
-    for(i=0; i<nseqs; i++)
-	PyTuple_SetItem(sbhs, i, PyInt_FromLong(seqbasehits[i]));
+    Py_BEGIN_ALLOW_THREADS
+    scan_join(&scan);
+    Py_END_ALLOW_THREADS
 
-    shs = PyTuple_New(nseqs);
-    for(i=0; i<nseqs; i++)
-	PyTuple_SetItem(shs, i, PyInt_FromLong(seqhits[i]));
+    ret = NULL; // will indicate error if not set
 
-    // DBG("engine_stats : parsed=%li total=%li", parsed, total);
+    if (sc->exception == NULL)
+    {
+	// convert return value (merging hits of all threads)
+
+	allhits = (struct hits **) malloc(sizeof(struct hits *) * scan.nworkspaces);
+	if (allhits != NULL)
+	    for(i=0; i<scan.nworkspaces; i++)
+		allhits[i] = &scan.workspaces[i].hits;
+	if (allhits == NULL || (scan.args.cov != NULL ?
+		    merge_coverages(allhits, scan.nworkspaces, scan.args.cov, 0, &hits) :
+		    merge_hits(allhits, scan.nworkspaces, columnar, &hits, &hitseqs)) != 0)
+	{
+	    sc->exception = PyExc_MemoryError;
+	    strncpy(sc->errstr, "cannot allocate memory for results", ERRSTR_LENGTH);
+	}
+	else if (scan.args.cov != NULL)
+	{
+	    pystats = scanner_stats(self, NULL);
+	    ret = Py_BuildValue("{sOsO}",
+		    "coverages", hits,
+		    "stats", pystats);
+	    Py_XDECREF(hits);
+	    Py_XDECREF(pystats);
+	}
+	else
+	{
+	    pystats = scanner_stats(self, NULL);
+	    ret = Py_BuildValue("{sOsOsO}",
+		    "hits", hits,
+		    "stats", pystats,
+		    "hitseqs", hitseqs);
+	    Py_XDECREF(hits);
+	    Py_XDECREF(pystats);
+	    Py_XDECREF(hitseqs);
+	}
+	free(allhits);
+    }
 
-    progress = 0;
-    if (fastq_size_estimated > 0)
-	progress = ((float) MIN(fastq_parsed, fastq_size_estimated)) / fastq_size_estimated;
+    if (scan_finish(&scan) != 0)
+    {
+	Py_XDECREF(ret);
+	ret = NULL;
+    }
 
-    return Py_BuildValue("{sOsfsOsOsOsOsOsO}",
-	    "readlengths", rls,
-	    "progress", progress,
-	    "nseqbasehits", sbhs,
-	    "nseqhits", shs,
-	    "parsed", PyInt_FromLong(fastq_parsed),
-	    "total", PyInt_FromLong(fastq_size_estimated),
-	    "sigints", PyInt_FromLong(sigints),
-	    "records_parsed", PyInt_FromLong(records_parsed)
-	    );
+    sc->running--;
+    return ret;
 }
 
-/* engine.findseqs {{{2 */
+/* Scanner.findseqs_iter {{{2 */
 
-    static PyObject *
-engine_findseqs(PyObject *self, PyObject *findseqs_args)
+/*
+ * iterator returned by findseqs_iter() : the scanning threads keep running
+ * while the python thread consumes the batches of hits they hand over
+ */
+
+typedef struct {
+    PyObject_HEAD
+    Scanner *scanner; // referenced while iterating
+    struct scan scan;
+    int scanning; // threads not yet joined
+    int columnar;
+    int merge; // keep batches for merged()
+    struct hits *kept; // batches already handed over (if merge is set)
+    int nkept, keptsize;
+    PyObject *fname_obj, *seqlist_obj; // referenced by scan
+} FindseqsIter;
+
+/**
+ * joins threads and frees scan
+ *
+ * @return 0 if no error occured, -1 otherwise (python exception set)
+ */
+
+int findseqs_iter_finish(FindseqsIter *it)
 {
-    const char **fnames;
-    PyObject *fname_obj, *seqlist_obj, *str, *ret, *hits, *pystats;
-    int i, threadi, err;
-    ll_item *item;
-    pthread_t *threads;
-    struct scanargs args;
+    int ret;
 
-    if (running != 0) //FIXME threadsafe
-    {
-	PyErr_SetString(PyExc_RuntimeError, "findseqs() already running!");
-	return NULL;
-    }
-    running++;
-    stop = 0;
-    sigints = 0;
+    Py_BEGIN_ALLOW_THREADS
+    scan_join(&it->scan);
+    Py_END_ALLOW_THREADS
 
-    // argument parsing {{{3
+    ret = scan_finish(&it->scan);
+    it->scanning = 0;
+    it->scanner->sc.running--;
 
-    if (!PyArg_ParseTuple(findseqs_args, "OO", &fname_obj, &seqlist_obj)) {
-	running--;
-	return NULL;
-    }
+    return ret;
+}
 
-    if (PyString_Check(fname_obj)) {
-	fnames = (const char **) malloc(sizeof(char *) * 2);
-	if (fnames == NULL) {
-	    running--;
-	    return PyErr_NoMemory();
-	}
-	fnames[0] = PyString_AsString(fname_obj);
-	fnames[1] = NULL;
+    static void
+findseqs_iter_dealloc(FindseqsIter *it)
+{
+    if (it->scanning)
+    {
+	// iteration abandoned : stop scanning threads
+	it->scanner->sc.stop++;
+	batches_close(it->scan.batches);
+	ring_done(&it->scan.ring);
+	if (findseqs_iter_finish(it) != 0)
+	    PyErr_Clear();
+    }
+    while(it->nkept > 0)
+	hits_free(it->kept + --it->nkept);
+    free(it->kept);
+    Py_XDECREF(it->fname_obj);
+    Py_XDECREF(it->seqlist_obj);
+    Py_XDECREF(it->scanner);
+    PyObject_Del(it);
+}
 
-    } else if (PySequence_Check(fname_obj)) {
-	fnames = (const char **) malloc(sizeof(char *) *
-		(PySequence_Size(fname_obj) + 1));
-	if (fnames == NULL) {
-	    running--;
-	    return PyErr_NoMemory();
-	}
-	for(i = 0; i < PySequence_Size(fname_obj); i++)
-	    fnames[i] = PyString_AsString(PySequence_GetItem(fname_obj, i));
-	fnames[i] = NULL;
+    static PyObject *
+findseqs_iter_next(FindseqsIter *it)
+{
+    struct hits batch, *batchp = &batch, *kept;
+    PyObject *hits, *hitseqs, *ret;
+    int got;
 
-    } else {
-	PyErr_SetString(PyExc_TypeError, "fname must be [sequence of] string[s]");
-	running--;
+    if (!it->scanning)
 	return NULL;
-    }
 
-    if (!PySequence_Check(seqlist_obj))
+    Py_BEGIN_ALLOW_THREADS
+    got = batches_get(it->scan.batches, &batch);
+    Py_END_ALLOW_THREADS
+
+    if (!got)
     {
-	PyErr_SetString(PyExc_TypeError, "seqlist must be sequence of strings");
-	free(fnames);
-	running--;
+	// all threads finished : StopIteration or exception
+	findseqs_iter_finish(it);
 	return NULL;
     }
 
-    args.seqlist = (char **) malloc((PySequence_Size(seqlist_obj)+1) * sizeof(char *));
-    if (args.seqlist == NULL) {
-	free(fnames);
-	running--;
-	return PyErr_NoMemory();
+    ret = NULL;
+    if (it->scan.args.cov != NULL)
+    {
+	if (merge_coverages(&batchp, 1, it->scan.args.cov, 1, &hits) == 0)
+	{
+	    ret = Py_BuildValue("{sO}", "coverages", hits);
+	    Py_DECREF(hits);
+	}
     }
-    args.seqlengths = (int *) malloc(PySequence_Size(seqlist_obj) * sizeof(int *));
-    if (args.seqlengths == NULL)
+    else if (merge_hits(&batchp, 1, it->columnar, &hits, &hitseqs) == 0)
     {
-	free(args.seqlist);
-	free(fnames);
-	running--;
-	return PyErr_NoMemory();
+	ret = Py_BuildValue("{sOsO}", "hits", hits, "hitseqs", hitseqs);
+	Py_DECREF(hits);
+	Py_DECREF(hitseqs);
     }
 
-    for(i=0; i<PySequence_Size(seqlist_obj); i++) 
+    if (ret != NULL && it->merge)
     {
-	str = PySequence_GetItem(seqlist_obj, i);
-	args.seqlist[i] = PyString_AsString(str);
-	if (args.seqlist[i] == NULL)
+	// batch is merged with all others in merged()
+	if (it->nkept == it->keptsize)
 	{
-	    free(args.seqlengths);
-	    free(args.seqlist);
-	    PyErr_SetString(PyExc_TypeError, "seqlist must be list of strings");
-	    free(fnames);
-	    running--;
-	    return NULL;
+	    kept = (struct hits *) realloc(it->kept,
+		    sizeof(struct hits) * (2 * it->keptsize + 16));
+	    if (kept == NULL)
+	    {
+		Py_DECREF(ret);
+		ret = NULL;
+	    }
+	    else
+	    {
+		it->kept = kept;
+		it->keptsize = 2 * it->keptsize + 16;
+	    }
 	}
-	args.seqlengths[i] = (int) PyString_Size(str);
+	if (ret != NULL)
+	    it->kept[it->nkept++] = batch;
+	else
+	    hits_free(&batch);
     }
-    args.seqlist[i] = NULL;
+    else
+	hits_free(&batch);
 
+    if (ret == NULL && !PyErr_Occurred())
+	PyErr_NoMemory();
 
-    // prepare sequence quest {{{3
+    return ret;
+}
+
+    static PyObject *
+findseqs_iter_merged(FindseqsIter *it, PyObject *args)
+{
+    struct hits **allhits;
+    PyObject *hits, *hitseqs, *ret;
+    int i;
 
-    args.fastq = fastq_open(fnames);
-    if (args.fastq == NULL)
+    if (!it->merge)
+    {
+	PyErr_SetString(PyExc_ValueError, "merged() needs findseqs_iter(merge=True) "
+		"and can only be called once");
+	return NULL;
+    }
+    if (it->scanning)
     {
-	PyErr_SetString(exception, errstr);
-	free(args.seqlengths);
-	free(args.seqlist);
-	free(fnames);
-	running--;
+	PyErr_SetString(PyExc_RuntimeError, "merged() called before the last batch");
 	return NULL;
     }
 
-    args.root = (ll_item *) malloc(sizeof(ll_item));
-    if (args.root == NULL)
+    ret = NULL;
+    allhits = (struct hits **) malloc(sizeof(struct hits *) * (it->nkept + 1));
+    if (allhits != NULL)
     {
-	fastq_close(args.fastq);
-	free(args.seqlist);
-	free(args.seqlengths);
-	free(fnames);
-	running--;
-	return PyErr_NoMemory();
+	for(i=0; i<it->nkept; i++)
+	    allhits[i] = it->kept + i;
+	if (merge_hits(allhits, it->nkept, it->columnar, &hits, &hitseqs) == 0)
+	{
+	    ret = Py_BuildValue("{sOsO}", "hits", hits, "hitseqs", hitseqs);
+	    Py_DECREF(hits);
+	    Py_DECREF(hitseqs);
+	}
+	free(allhits);
     }
-    args.root->fpos = -1L;
-    args.root->next = NULL;
 
-    args.pyhitseqs = PyList_New(0);
+    it->merge = 0;
+    while(it->nkept > 0)
+	hits_free(it->kept + --it->nkept);
+    free(it->kept);
+    it->kept = NULL;
+    it->keptsize = 0;
 
-    init_stats(args.seqlist);
+    if (ret == NULL && !PyErr_Occurred())
+	PyErr_NoMemory();
 
-    profiles_n = 0;
+    return ret;
+}
 
-    // start threads {{{3
+static PyTypeObject FindseqsIterType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "kvarq.engine.FindseqsIter", /*tp_name*/
+    sizeof(FindseqsIter),      /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor) findseqs_iter_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "iterator over batches of hits found by findseqs_iter()", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    PyObject_SelfIter,         /* tp_iter */
+    (iternextfunc) findseqs_iter_next, /* tp_iternext */
+    0,                         /* tp_methods (set in initengine) */
+};
 
-    threads = (pthread_t *) malloc(sizeof(pthread_t) *nthreads);
+    static PyObject *
+scanner_findseqs_iter(Scanner *self, PyObject *findseqs_args, PyObject *kwargs)
+{
+    static char *kwlist[] = {"fname", "sequences", "columnar", "coverages",
+	"templates", "batchsize", "maxbatches", "merge", NULL};
+    struct scanner *sc = &self->sc;
+    int columnar = 0, maxbatches = 0, merge = 0;
+    long batchsize = 10000;
+    PyObject *fname_obj, *seqlist_obj, *cov_obj, *templates_obj;
+    FindseqsIter *it;
+
+    // (protected by the global interpreter lock)
+    if (sc->running != 0)
+    {
+	PyErr_SetString(PyExc_RuntimeError, "findseqs() already running!");
+	return NULL;
+    }
+    cov_obj = templates_obj = Py_None;
 
-    Py_BEGIN_ALLOW_THREADS
+    if (!PyArg_ParseTupleAndKeywords(findseqs_args, kwargs, "OO|iOOlii", kwlist,
+		&fname_obj, &seqlist_obj, &columnar, &cov_obj, &templates_obj,
+		&batchsize, &maxbatches, &merge))
+	return NULL;
+    if (merge && cov_obj != Py_None)
+    {
+	PyErr_SetString(PyExc_ValueError, "merge cannot be used with coverages");
+	return NULL;
+    }
+    if (maxbatches <= 0)
+	maxbatches = 2 * sc->nthreads;
 
-    for(threadi=0; threadi<nthreads; threadi++)
+    it = PyObject_New(FindseqsIter, &FindseqsIterType);
+    if (it == NULL)
+	return NULL;
+    memset(&it->scan, 0, sizeof(struct scan));
+    it->scanning = 0;
+    it->columnar = columnar;
+    it->merge = merge;
+    it->kept = NULL;
+    it->nkept = it->keptsize = 0;
+    Py_INCREF(self);
+    it->scanner = self;
+    Py_INCREF(fname_obj);
+    it->fname_obj = fname_obj;
+    Py_INCREF(seqlist_obj);
+    it->seqlist_obj = seqlist_obj;
+
+    sc->running++;
+    sc->stop = 0;
+    sc->sigints_base = sigints;
+
+    if (scan_start(sc, &it->scan, fname_obj, seqlist_obj, cov_obj,
+		templates_obj, MAX(1, batchsize), maxbatches) != 0)
     {
+	sc->running--;
+	Py_DECREF(it);
+	return NULL;
+    }
+    it->scanning = 1;
 
-	err = pthread_create(threads+threadi, NULL, 
-		(void *(*)(void *)) scan_filepart,
-		(void *) &args);
+    return (PyObject *) it;
+}
 
-	if (err != 0)
-	{
-	    stop++;
-	    for(i=0; i<threadi; i++)
-		pthread_join(threads[i], NULL);
-	    exception = PyExc_RuntimeError;
-	    strncpy(errstr, "pthread_create failed", ERRSTR_LENGTH);
-	    threadi = -1;
-	    break;
-	}
+/* Scanner.stop {{{2 */
 
-	// DBG("created thread #%d (%li)", threadi, pthread2long(threads[threadi]));
-    }
+    static PyObject *
+scanner_stop(Scanner *self, PyObject *args)
+{
+    lo_log_msg(LOG_DEBUG, "engine stopped");
 
-    ret = NULL; // will indicate error if not set
+    self->sc.stop++;
 
-    // end threads, get results {{{3
+    Py_RETURN_NONE;
+}
 
-    if (threadi != -1)
-	for(threadi=0; threadi<nthreads; threadi++)
-	    pthread_join(threads[threadi], NULL);
+/* Scanner.get_config {{{2 */
 
-    Py_END_ALLOW_THREADS
+    static PyObject *
+scanner_get_config(Scanner *self, PyObject *args)
+{
+    struct scanner *sc = &self->sc;
+
+    return Py_BuildValue("{sisisisiscscsisdsisi}", 
+	    "maxerrors", sc->maxerrors,
+	    "minoverlap", sc->minoverlap,
+	    "minreadlength", sc->minreadlength,
+	    "nthreads", sc->nthreads,
+	    "Amin", sc->Amin,
+	    "Azero", sc->Azero,
+	    "maxcoverage", sc->maxcoverage,
+	    "sample", sc->sample,
+	    "seed", sc->sample_seed,
+	    "gzindex", sc->gzindex);
+}
 
-    if (threadi != -1)
+/* Scanner.config {{{2 */
+
+    static PyObject *
+scanner_config(Scanner *self, PyObject *args, PyObject *kw)
+{
+    static char *kwl[] = { "maxerrors", "minoverlap", "minreadlength", "nthreads", "Amin", "Azero", "maxcoverage", "sample", "seed", "gzindex", NULL };
+    struct scanner *sc = &self->sc;
+    double sample;
+
+    if (sc->running != 0)
     {
+	PyErr_SetString(PyExc_RuntimeError, "cannot configure while findseqs() is running");
+	return NULL;
+    }
 
-	if (exception == NULL)
-	{
-	    // convert return value
+    sample = sc->sample;
+    if (!PyArg_ParseTupleAndKeywords(args, kw, 
+		"|iiiiccidii", kwl, &sc->maxerrors, &sc->minoverlap, &sc->minreadlength, &sc->nthreads, &sc->Amin, &sc->Azero, &sc->maxcoverage, &sample, &sc->sample_seed, &sc->gzindex))
+	return NULL;
+    if (!(sample > 0 && sample <= 1))
+    {
+	PyErr_SetString(PyExc_ValueError, "sample must be > 0 and <= 1");
+	return NULL;
+    }
+    sc->sample = sample;
 
-	    for(i=0,item=args.root->next; item!=NULL; i++)
-		item = item->next;
+    Py_RETURN_NONE;
+}
 
-	    hits = PyTuple_New(i);
-	    for(i=0,item=args.root->next; item!=NULL; i++,item=item->next)
-		PyTuple_SetItem(hits, i,
-			PyObject_CallObject(hittuple, 
-			    Py_BuildValue("(iliii)", 
-				item->seqi,
-				item->fpos,
-				item->spos,
-				item->length,
-				item->readlength)
-			    )
-			);
+/* Scanner type {{{2 */
 
-	    pystats = engine_stats(self, Py_BuildValue("()"));
-	    ret = Py_BuildValue("{sOsOsO}",
-		    "hits", hits,
-		    "stats", pystats,
-		    "hitseqs", args.pyhitseqs);
-	    Py_XDECREF(hits);
-	    Py_XDECREF(pystats);
-	    Py_XDECREF(args.pyhitseqs);
-	}
-    }
+    static PyObject *
+scanner_new(PyTypeObject *type, PyObject *args, PyObject *kw)
+{
+    Scanner *self;
+    struct scanner *sc;
 
-    // clean up {{{3
+    self = (Scanner *) type->tp_alloc(type, 0);
+    if (self == NULL)
+	return NULL;
+    sc = &self->sc;
+
+    sc->maxerrors = 0;
+    sc->minoverlap = 20;
+    sc->minreadlength = 10;
+    sc->nthreads = 1;
+    sc->maxcoverage = 0;
+    sc->sample = 1;
+    sc->sample_seed = 0;
+    sc->gzindex = 0;
+    sc->Amin = '!';
+    sc->Azero = '!';
+    sc->sigints_base = sigints;
+    pthread_mutex_init(&sc->hits_mutex, NULL);
+    pthread_mutex_init(&sc->range_mutex, NULL);
+    pthread_mutex_init(&sc->fastq_mutex, NULL);
+
+    return (PyObject *) self;
+}
 
-    free(threads);
-    free_ll(args.root);
-    fastq_close(args.fastq);
-    free(args.seqlist);
-    free(args.seqlengths);
+    static int
+scanner_init(Scanner *self, PyObject *args, PyObject *kw)
+{
+    PyObject *ret;
 
-    lo_log_msg_print();
+    ret = scanner_config(self, args, kw);
+    if (ret == NULL)
+	return -1;
+    Py_DECREF(ret);
 
-    if (exception != NULL) {
-	// returning ret=NULL with generate "exception" additonal info "errstr"
-	PyErr_SetString(exception, errstr);
-	exception = NULL;
-    }
+    return 0;
+}
 
+    static void
+scanner_dealloc(Scanner *self)
+{
+    struct scanner *sc = &self->sc;
+
+    free_stats(sc);
+    free_templates(sc);
+    pthread_mutex_destroy(&sc->hits_mutex);
+    pthread_mutex_destroy(&sc->range_mutex);
+    pthread_mutex_destroy(&sc->fastq_mutex);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+/* engine.test {{{2 */
+
+    static PyObject *
+engine_test(PyObject *self, PyObject *args)
+{
     profile_dump();
 
-    running--;
-    return ret;
+    Py_RETURN_NONE;
 }
 
-/* engine.stop {{{2 */
+/* engine.inflated_size {{{2 */
 
     static PyObject *
-engine_stop(PyObject *self, PyObject *args)
+engine_inflated_size(PyObject *self, PyObject *args)
 {
-    if (!PyArg_ParseTuple(args, ""))
+    const char *fname;
+    struct gzindex *gzi;
+    FILE *fd;
+    size_t size;
+
+    if (!PyArg_ParseTuple(args, "s", &fname))
 	return NULL;
 
-    lo_log_msg(LOG_DEBUG, "engine stopped");
+    // (indexes BGZF files, see bgzf_index)
+    Py_BEGIN_ALLOW_THREADS
+    if ((gzi = gzindex_get(fname)) != NULL)
+    {
+	size = gzi->total;
+	gzindex_release(gzi);
+	fd = NULL;
+    }
+    else if ((fd = fopen(fname, "rb")) != NULL)
+    {
+	fseek(fd, 0, SEEK_END);
+	size = ftell(fd);
+	size = gz_estimate(fd, size, gz_isize(fd));
+	fclose(fd);
+    }
+    Py_END_ALLOW_THREADS
 
-    stop++;
+    if (gzi == NULL && fd == NULL)
+	return PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *) fname);
 
-    Py_RETURN_NONE;
+    return PyInt_FromSize_t(size);
 }
 
-/* engine.get_config {{{2 */
+/* module functions {{{2 */
+
+// same as the methods of the Scanner engine.default_scanner
 
     static PyObject *
-engine_get_config(PyObject *self, PyObject *args)
+engine_config(PyObject *self, PyObject *args, PyObject *kw)
 {
-    return Py_BuildValue("{sisisisiscsc}", 
-	    "maxerrors", maxerrors,
-	    "minoverlap", minoverlap,
-	    "minreadlength", minreadlength,
-	    "nthreads", nthreads,
-	    "Amin", Amin,
-	    "Azero", Azero);
+    return scanner_config(default_scanner, args, kw);
 }
 
-/* engine.config {{{2 */
-
     static PyObject *
-engine_config(PyObject *self, PyObject *args, PyObject *kw)
+engine_get_config(PyObject *self, PyObject *args)
 {
-    static char *kwl[] = { "maxerrors", "minoverlap", "minreadlength", "nthreads", "Amin", "Azero", NULL };
-
-    if (!PyArg_ParseTupleAndKeywords(args, kw, 
-		"|iiiicc", kwl, &maxerrors, &minoverlap, &minreadlength, &nthreads, &Amin, &Azero))
-	return NULL;
+    return scanner_get_config(default_scanner, args);
+}
 
-    Py_RETURN_NONE;
+    static PyObject *
+engine_findseqs(PyObject *self, PyObject *args, PyObject *kw)
+{
+    return scanner_findseqs(default_scanner, args, kw);
 }
 
-/* engine.test {{{2 */
+    static PyObject *
+engine_findseqs_iter(PyObject *self, PyObject *args, PyObject *kw)
+{
+    return scanner_findseqs_iter(default_scanner, args, kw);
+}
 
     static PyObject *
-engine_test(PyObject *self, PyObject *args)
+engine_stop(PyObject *self, PyObject *args)
 {
-    profile_dump();
+    return scanner_stop(default_scanner, args);
+}
 
-    Py_RETURN_NONE;
+    static PyObject *
+engine_stats(PyObject *self, PyObject *args)
+{
+    return scanner_stats(default_scanner, args);
 }
 
 
 /* initialization {{{1 */
 
+/* docstrings {{{2 */
+
+#define CONFIG_DOC \
+	"config(**kwargs) -- configure the engine.\n" \
+	"arguments:\n" \
+	"'maxerrors : maximum number of base mismatches in sequence alignment\n" \
+	"'minoverlap : minimum number of base overlap for beginning/end hits\n" \
+	"'minreadlength : ignore reads shorter than this\n" \
+	"'nthreads : number of threads to use for scanning\n" \
+	"'Amin : nucleotides with quality ASCII value lower than this are discarded\n" \
+	"'Azero : ASCII value that corresponds to Q=0 (depends on FastQ format)\n" \
+	"'maxcoverage : sequences are no longer matched once the mean coverage of\n" \
+	"    their template (hit bases of all its sequences / sequence length)\n" \
+	"    reaches this value; scanning stops when all templates reached it\n" \
+	"    (0 : scan entire file; see 'templates' of findseqs())\n" \
+	"'sample : fraction of the records to scan (1 : scan all records); the\n" \
+	"    file is divided into blocks of 64kb and whole blocks are selected,\n" \
+	"    blocks of uncompressed files that are not selected are not read\n" \
+	"'seed : selects a different (reproducible) subsample\n" \
+	"'gzindex : index .gz files while reading them so that they can be\n" \
+	"    inflated in parallel when they are scanned again by the same\n" \
+	"    process (the indexes are kept in memory; BGZF files are always\n" \
+	"    indexed without inflating them)\n"
+
+#define GET_CONFIG_DOC \
+	"get_config() -- get the current config as dictionary.\n"
+
+#define FINDSEQS_DOC \
+	"findseqs(fname, sequences, columnar=False, coverages=None, templates=None) -- finds occurences of base sequences in fastq files.\n" \
+	"arguments:\n" \
+	"'fname' : filename of fastq file or sequence of filenames of fastq files\n" \
+	"    (that are read concurrently, see kvarq.engine.Hit for file_pos);\n" \
+	"    instead of a filename, a file descriptor (int) of a pipe or any\n" \
+	"    other file can be specified : it is read sequentially (gzip\n" \
+	"    compressed data is recognized by its magic bytes) and closed\n" \
+	"    when the scan ends\n" \
+	"'sequences' : list of sequences to look for\n" \
+	"'columnar' : return hits as arrays instead of tuples (see below)\n" \
+	"'coverages' : sequence of (coverage_nr, on_plus_strand) for every\n" \
+	"    sequence; if set, bases of hits are counted instead (see below)\n" \
+	"'templates' : sequence of template_nr for every sequence : sequences\n" \
+	"    of the same template are retired together once their hits reach\n" \
+	"    maxcoverage (see config()); defaults to the coverage_nr if\n" \
+	"    coverages is set, otherwise every sequence is its own template\n\n" \
+	"returns a dictionary with:\n" \
+	"'hits' : tuple of kvarq.engine.Hit (sorted by file_pos)\n" \
+	"'stats' : is the same dict as returned by a call to stats()\n" \
+	"'hitseqs' : list of base sequences corresponding to 'hits'\n\n" \
+	"if columnar is set then 'hits' is a dictionary that contains an\n" \
+	"array.array for every field of kvarq.engine.Hit and 'hitseqs' is\n" \
+	"a tuple (data, offsets) : hitseqs[i] == data[offsets[i]:offsets[i+1]]\n\n" \
+	"if coverages is set then 'hits' and 'hitseqs' are replaced by\n" \
+	"'coverages' : list of array.array (one per coverage_nr) that contain\n" \
+	"    five counts (A, C, G, T, N) for every position on the + strand;\n" \
+	"    sequences on the - strand are counted reverse complemented and\n" \
+	"    other characters than ACGT are counted as N\n"
+
+#define FINDSEQS_ITER_DOC \
+	"findseqs_iter(fname, sequences, columnar=False, coverages=None, templates=None, batchsize=10000, maxbatches=0, merge=False)\n" \
+	"-- same as findseqs() but returns an iterator over batches of results\n" \
+	"while the file is still being scanned.\n" \
+	"arguments (see findseqs() for the others):\n" \
+	"'batchsize' : minimum number of hits per batch (except last batches)\n" \
+	"'maxbatches' : scanning threads wait if that many batches are not yet\n" \
+	"    consumed (default is two per thread)\n" \
+	"'merge' : keep the hits of all batches so that they can be retrieved\n" \
+	"    sorted by file_pos with merged() after the last batch (cannot be\n" \
+	"    used with coverages)\n\n" \
+	"every batch is a dictionary with 'hits' and 'hitseqs' (sorted by\n" \
+	"file_pos within the batch but not across batches) or, if coverages is\n" \
+	"set, with 'coverages' : a dictionary of base counts that were added\n" \
+	"since the previous batch, indexed by coverage_nr; statistics can be\n" \
+	"retrieved with stats() after the last batch\n"
+
+#define FINDSEQS_ITER_MERGED_DOC \
+	"merged() -- hits of all batches (only if findseqs_iter() was called\n" \
+	"with merge=True), can be called once after the last batch.\n" \
+	"returns a dictionary with 'hits' and 'hitseqs' in the same format as\n" \
+	"findseqs() : all hits sorted by file_pos\n"
+
+#define INFLATED_SIZE_DOC \
+	"inflated_size(fname) -- size of the inflated data of a .gz file.\n" \
+	"the size is exact for BGZF files and files that were indexed (see\n" \
+	"config()); otherwise the first 256kb are inflated and the size is\n" \
+	"extrapolated : the ISIZE of the gzip trailer (i.e. the size modulo\n" \
+	"2^32) plus the multiple of 2^32 that is nearest to the extrapolated\n" \
+	"size, which is exact for files with a single gzip member, or the\n" \
+	"extrapolated size if the other size is less than half of it (as for\n" \
+	"files with several members, where ISIZE is the size of the last\n" \
+	"member only); the engine starts with the same estimate when it scans\n" \
+	"a .gz file and refines it while inflating the file\n"
+
+#define STOP_DOC \
+	"stop() -- stops the scanning process.\n"
+
+#define STATS_DOC \
+	"stats() -- get statistics during scanning process.\n" \
+	"returns a dict containing:\n" \
+	"'readlengths' : tuple of number of occurences when accessed by read length\n" \
+	"'progress' : current progress of findseqs() ranging 0..1\n" \
+	"'sigints' : how many <CTRL-C> were caught since beginning of scan\n" \
+	"'nseqbasehits' : sum(hit_length), indexed by sequence as given to findseqs()\n" \
+	"'nseqhits' : number of hits, indexed by sequence as given to findseqs()\n" \
+	"'records_parsed' : total number of records parsed (when subsampling,\n" \
+	"    blocks of uncompressed files that are not selected are skipped\n" \
+	"    without parsing them, see config())\n" \
+	"'records_sampled' : number of records scanned (same as records_parsed\n" \
+	"    unless subsampling)\n" \
+	"'parsed' : number of (inflated) bytes parsed\n" \
+	"'total' : (estimated) number of inflated bytes of all files, or 0 if\n" \
+	"    unknown (reading from file descriptors); exact once all files were\n" \
+	"    read to the end (see inflated_size())\n" \
+	"'reader_stall' : seconds the reader thread waited for scanning threads\n" \
+	"'worker_stall' : seconds the scanning threads (together) waited for\n" \
+	"    the reader thread\n" \
+	"'nretired' : number of templates that reached maxcoverage (see config())\n" \
+	"'sampled' : fraction of the parsed data that was scanned (see config())\n"
+
 /* PyMethodDef {{{2 */
 
 static PyMethodDef methods[] = {
     {"test",  engine_test, METH_VARARGS,
 	"test() -- perform some test.\n"},
     {"config",  (PyCFunction)engine_config, METH_VARARGS | METH_KEYWORDS,
-	"config(**kwargs) -- configure the engine.\n"
-	"arguments:\n"
-	"'maxerrors : maximum number of base mismatches in sequence alignment\n"
-	"'minoverlap : minimum number of base overlap for beginning/end hits\n"
-	"'minreadlength : ignore reads shorter than this\n"
-	"'nthreads : number of threads to use for scanning\n"
-	"'Amin : nucleotides with quality ASCII value lower than this are discarded\n"
-	"'Azero : ASCII value that corresponds to Q=0 (depends on FastQ format)\n"},
-    {"get_config", engine_get_config, METH_VARARGS,
-	"get_config() -- get the current config as dictionary.\n"},
-    {"findseqs", engine_findseqs, METH_VARARGS,
-	"findseqs(fname, sequences) -- finds occurences of base sequences in fastq files.\n"
-	"arguments:\n"
-	"'fname' : filename of fastq file or sequence of filenames of fastq files\n"
-	"'sequences' : list of sequences to look for\n\n"
-	"returns a dictionary with:\n"
-	"'hits' : tuple of kvarq.engine.Hit\n"
-	"'stats' : is the same dict as returned by a call to stats()\n"
-	"'hitseqs' : tuple of base sequences corresponding to 'hits'\n"},
-    {"stop",  engine_stop, METH_VARARGS,
-	"stop() -- stops the scanning process.\n"},
-    {"stats", engine_stats, METH_VARARGS,
-	"stats() -- get statistics during scanning process.\n"
-	"returns a dict containing:\n"
-	"'readlengths' : tuple of number of occurences when accessed by read length\n"
-	"'progress' : current progress of findseqs() ranging 0..1\n"
-	"'sigints' : how many <CTRL-C> were caught since beginning of scan\n"
-	"'nseqbasehits' : sum(hit_length), indexed by sequence as given to findseqs()\n"
-	"'nseqhits' : number of hits, indexed by sequence as given to findseqs()\n"
-	"'records_parsed' : total number of records parsed\n"},
+	CONFIG_DOC},
+    {"get_config", engine_get_config, METH_NOARGS,
+	GET_CONFIG_DOC},
+    {"findseqs", (PyCFunction)engine_findseqs, METH_VARARGS | METH_KEYWORDS,
+	FINDSEQS_DOC},
+    {"findseqs_iter", (PyCFunction)engine_findseqs_iter, METH_VARARGS | METH_KEYWORDS,
+	FINDSEQS_ITER_DOC},
+    {"stop",  engine_stop, METH_NOARGS,
+	STOP_DOC},
+    {"stats", engine_stats, METH_NOARGS,
+	STATS_DOC},
+    {"inflated_size", engine_inflated_size, METH_VARARGS,
+	INFLATED_SIZE_DOC},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+static PyMethodDef scanner_methods[] = {
+    {"config",  (PyCFunction)scanner_config, METH_VARARGS | METH_KEYWORDS,
+	CONFIG_DOC},
+    {"get_config", (PyCFunction)scanner_get_config, METH_NOARGS,
+	GET_CONFIG_DOC},
+    {"findseqs", (PyCFunction)scanner_findseqs, METH_VARARGS | METH_KEYWORDS,
+	FINDSEQS_DOC},
+    {"findseqs_iter", (PyCFunction)scanner_findseqs_iter, METH_VARARGS | METH_KEYWORDS,
+	FINDSEQS_ITER_DOC},
+    {"stop",  (PyCFunction)scanner_stop, METH_NOARGS,
+	STOP_DOC},
+    {"stats", (PyCFunction)scanner_stats, METH_NOARGS,
+	STATS_DOC},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
+static PyMethodDef findseqs_iter_methods[] = {
+    {"merged", (PyCFunction)findseqs_iter_merged, METH_NOARGS,
+	FINDSEQS_ITER_MERGED_DOC},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+/* Scanner type {{{2 */
+
+static PyTypeObject ScannerType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "kvarq.engine.Scanner",    /*tp_name*/
+    sizeof(Scanner),           /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor) scanner_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+    "Scanner(**kwargs) -- scanning engine with its own configuration (see\n"
+    "config() for kwargs), statistics and stop flag; different scanners can\n"
+    "scan concurrently from different python threads. the module functions\n"
+    "use the scanner engine.default_scanner\n", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    scanner_methods,           /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc) scanner_init,   /* tp_init */
+    0,                         /* tp_alloc */
+    scanner_new,               /* tp_new */
+};
+
 
 /* init module {{{2 */
 
@@ -1570,6 +5800,12 @@ initengine(void)
 
     (void) Py_InitModule("engine", methods);
 
+    FindseqsIterType.tp_methods = findseqs_iter_methods;
+    if (PyType_Ready(&FindseqsIterType) < 0)
+	return;
+    if (PyType_Ready(&ScannerType) < 0)
+	return;
+
     // create object kvarq.engine.Hit
 
     mod = PyImport_ImportModule("collections");
@@ -1586,19 +5822,33 @@ initengine(void)
 		    "readlength")));
     PyObject_SetAttrString(hittuple,"__doc__",PyString_FromString(
 		"seq_nr : refers to the list of sequences in call to engine.findseqs\n"
-		"file_pos : beginning of read (within decompressed data)\n"
+		"file_pos : beginning of read (within decompressed data); when\n"
+		"    several files are scanned, the index of the file is added\n"
+		"    in the bits above FILE_POS_BITS (file_pos >> FILE_POS_BITS)\n"
 		"seq_pos : places the beginning of the read relative to the beginning of the sequence (<0 if read overlaps only with beginning of sequence or read contains whole sequence; >0 if read overlaps only with end of sequence or read is contained within sequence)\n"
 		"length : gives the number of overlapping basepairs\n"
 		"readlength : length of the (quality trimmed) read containing the hit\n"
 		));
     Py_DECREF(obj);
     engine_mod = PyImport_ImportModule("kvarq.engine");
+
+    mod = PyImport_ImportModule("array");
+    arraytype = PyObject_GetAttrString(mod, "array");
+    Py_DECREF(mod);
     PyObject_SetAttrString(engine_mod, "Hit", hittuple);
+    obj = PyInt_FromLong(FILE_POS_BITS);
+    PyObject_SetAttrString(engine_mod, "FILE_POS_BITS", obj);
+    Py_DECREF(obj);
 
     mod = PyImport_ImportModule("kvarq.fastq");
     fastq_exception = PyObject_GetAttrString(mod, "FastqFileFormatException");
     Py_DECREF(mod);
-    exception = NULL;
+
+    // module functions use this scanner
+    Py_INCREF(&ScannerType);
+    PyObject_SetAttrString(engine_mod, "Scanner", (PyObject *) &ScannerType);
+    default_scanner = (Scanner *) PyObject_CallObject((PyObject *) &ScannerType, NULL);
+    PyObject_SetAttrString(engine_mod, "default_scanner", (PyObject *) default_scanner);
 
     // initialize logging
 
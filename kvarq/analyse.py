@@ -12,17 +12,172 @@ from kvarq.util import TextHist
 from kvarq.fastq import Fastq
 from kvarq.legacy import convert_legacy_data
 from kvarq.config import default_config
+from kvarq import resultfile
 
-import json, codecs
 import time
-import os.path
+import threading
+import os, os.path
+import marshal
+import hashlib
+import tempfile
 from distutils.version import StrictVersion
 from collections import Counter, OrderedDict
+from itertools import izip, imap, groupby, repeat, compress, count
+from array import array
 import re
 import sys
+import string
+import operator
+import bisect
+import functools
 
 
-class Coverage:
+class Hits(object):
+    '''
+    Hits as returned by :py:func:`kvarq.engine.findseqs` with
+    ``columnar=True`` : every field of :py:class:`kvarq.engine.Hit` is
+    stored in an :py:class:`array.array` that is accessible as an attribute
+    of the same name (e.g. ``hits.file_pos``; 64 bit integers are stored in
+    a list on platforms without such arrays, see
+    :py:func:`kvarq.resultfile.column`)
+
+    Behaves like a sequence of :py:class:`kvarq.engine.Hit` that are only
+    created when accessed.
+    '''
+
+    types = OrderedDict(resultfile.HIT_COLUMNS)
+
+    def __init__(self, columns=None):
+        '''
+        :param columns: dictionary of :py:class:`array.array` indexed by
+            field name (an empty instance is created if not specified)
+        '''
+        for field, t in self.types.items():
+            setattr(self, field, resultfile.column(t) if columns is None
+                    else columns[field])
+
+    @classmethod
+    def from_rows(cls, rows):
+        ''' :param rows: sequence of :py:class:`kvarq.engine.Hit` (or lists
+            of the same values, as found in ``.json`` files) '''
+        hits = cls()
+        columns = zip(*rows) or [()] * len(cls.types)
+        for field, values in zip(cls.types, columns):
+            getattr(hits, field).extend(values)
+        return hits
+
+    def columns(self):
+        ''' :returns: list of arrays (in the order of the fields of
+            :py:class:`kvarq.engine.Hit`) '''
+        return [getattr(self, field) for field in self.types]
+
+    def rows(self):
+        ''' :returns: list of tuples (as found in ``.json`` files) '''
+        return zip(*self.columns())
+
+    def __len__(self):
+        return len(self.seq_nr)
+
+    def __getitem__(self, i):
+        return engine.Hit(*[column[i] for column in self.columns()])
+
+    def __iter__(self):
+        return imap(engine.Hit, *self.columns())
+
+
+class HitSeqs(object):
+    '''
+    Hit sequences as returned by :py:func:`kvarq.engine.findseqs` with
+    ``columnar=True`` : all sequences are stored in one string.
+
+    Behaves like a sequence of strings.
+    '''
+
+    def __init__(self, data='', offsets=None):
+        '''
+        :param data: string containing all sequences
+        :param offsets: :py:class:`array.array` of ``len(self)+1`` offsets
+            into ``data`` (see :py:func:`kvarq.resultfile.column`)
+        '''
+        self.data = data
+        self.offsets = resultfile.column('i8', [0]) if offsets is None else offsets
+
+    @classmethod
+    def from_list(cls, seqs):
+        offsets = resultfile.column('i8', [0])
+        for seq in seqs:
+            offsets.append(offsets[-1] + len(seq))
+        return cls(''.join(seqs), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('hit sequence index out of range')
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        data = self.data
+        for start, stop in izip(self.offsets, self.offsets[1:]):
+            yield data[start:stop]
+
+
+# indexes of bases in rows of Coverage.counts
+BASES = 'ACGTN'
+# translates bases into their index in BASES (other characters are counted
+# as N, the same way as kvarq.engine.findseqs does)
+BASE_IDXS = ''.join([chr(BASES.index(chr(i)) if chr(i) in BASES else 4)
+        for i in range(256)])
+COMPLEMENTS = string.maketrans('ACGTN', 'TGCAN')
+NONZERO = re.compile(r'[^\x00]')
+# strings are compared in slices of that many bytes (see mismatches)
+MISMATCHES_SLICE = 64*1024
+
+def mismatches(a, b):
+    ''' :returns: sorted list of indexes where the strings ``a`` and ``b`` of
+        same length differ; the strings are compared as (hexadecimal encoded)
+        integers, so that long strings are compared in one go (slice by
+        slice, so that only copies of one slice are made at a time) '''
+    ret = []
+    for start in xrange(0, len(a), MISMATCHES_SLICE):
+        a_i = a[start:start + MISMATCHES_SLICE]
+        b_i = b[start:start + MISMATCHES_SLICE]
+        if a_i == b_i:
+            continue
+        x = int(a_i.encode('hex'), 16) ^ int(b_i.encode('hex'), 16)
+        diff = ('%0*x' % (2 * len(a_i), x)).decode('hex')
+        ret.extend([start + m.start() for m in NONZERO.finditer(diff)])
+    return ret
+
+class FrozenDict(dict):
+    ''' dictionary that raises ``TypeError`` when it is modified '''
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def cached(method):
+    ''' caches the return value of a :py:class:`Coverage` method (per
+        arguments) until the counts of the coverage change '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in self._cache:
+            self._cache[key] = method(self, *args, **kwargs)
+        return self._cache[key]
+    return wrapper
+
+
+class Coverage(object):
     '''
     This class applies :py:class:`kvarq.engine.Hit` to a
     :py:class:`kvarq.genes.Sequence`, keeping track of matching and non
@@ -37,19 +192,36 @@ class Coverage:
     ``coverage.stop=11`` with ``coverage.coverage[10]`` corresponding to base
     pair 1000 on the genome
 
-    The attribute :py:attr:`mutations` is a dictionary that translates
-    base index to a string with all alternate bases found at that position
+    The bases are counted in the :py:class:`array.array` :py:attr:`counts`
+    that contains five counts (``A``, ``C``, ``G``, ``T``, ``N``) for every
+    position on the ``+`` strand (the same layout as the coverages returned
+    by :py:func:`kvarq.engine.findseqs`).  The attribute :py:attr:`coverage`
+    is the depth at every position and the attribute :py:attr:`mutations`
+    is a dictionary that translates base index to a string with all
+    alternate bases found at that position; both are computed from the
+    counts and are read-only (modifying them raises ``TypeError``), but
+    can be replaced as a whole by assigning new values to the attributes.
+
+    Statistics such as :py:meth:`minf` or :py:meth:`mean` are computed for
+    all positions at once and cached until the counts change.
     '''
 
-    def __init__(self, plus_seq):
+    def __init__(self, plus_seq, minus_seq=None):
         '''
         :param plus_seq: a :py:class:`kvarq.genes.Sequence` on the ``+`` strand
             to which hits will be mapped
+        :param minus_seq: ``plus_seq.reverse()`` if already computed
         '''
         self.plus_seq = plus_seq
-        self.minus_seq = plus_seq.reverse()
-        self.coverage = [0] * len(plus_seq)
-        self.mutations = {}
+        self.minus_seq = minus_seq or plus_seq.reverse()
+        self._counts = array('i', [0]) * (5 * len(plus_seq))
+        # index of original base for every position
+        self.refs = array('B', plus_seq.bases.translate(BASE_IDXS))
+        # matching bases of hits are first counted as +1 at the first and -1
+        # after the last position (see .counts)
+        self._matches = None
+        # results of methods decorated with @cached
+        self._cache = {}
         #TODO rename to left, right
         self.start = plus_seq.left
         self.stop = len(plus_seq) - plus_seq.right
@@ -62,28 +234,175 @@ class Coverage:
 
         applies a hit to the sequence
         '''
-        if on_plus_strand:
-            seq = self.plus_seq
-        else:
-            seq = self.minus_seq
+        self.apply_bases(hit.seq_pos, hit.length, hitseq, on_plus_strand)
+
+    def apply_bases(self, seq_pos, length, hitseq, on_plus_strand):
+        '''
+        same as :py:meth:`apply_hit` with the values of ``Hit.seq_pos``
+        and ``Hit.length`` passed directly
+        '''
+        self.apply_many([seq_pos], [length], [hitseq], on_plus_strand)
 
-        start = max(0, hit.seq_pos)
-        stop = start+hit.length
+    def apply_many(self, seq_poss, lengths, hitseqs, on_plus_strand):
+        '''
+        same as :py:meth:`apply_bases` for many hits on the same strand
+
+        :param seq_poss: sequence of ``Hit.seq_pos``
+        :param lengths: sequence of ``Hit.length``
+        :param hitseqs: sequence of strings of bases found in the ``.fastq``
+            file
+        '''
+        self._cache = {}
+        starts = list(imap(max, repeat(0), seq_poss))
+        hitseqs = list(imap(operator.getslice, hitseqs, repeat(0), lengths))
+        lengths = map(len, hitseqs)
+        hitseq = ''.join(hitseqs)
+
+        if self._matches is None:
+            self._matches = array('i', [0]) * (len(self.plus_seq) + 1)
+        matches = self._matches
+        counts = self._counts
+        refs = self.refs
+        plus = self.plus_seq.bases
+        n = len(plus)
+
+        if not on_plus_strand:
+            # map all hits onto + strand at once : hits are then found in
+            # reverse order
+            hitseq = hitseq.translate(COMPLEMENTS)[::-1]
+            starts = map(operator.sub, repeat(n, len(starts)),
+                    imap(operator.add, starts, lengths))[::-1]
+            lengths.reverse()
+        stops = map(operator.add, starts, lengths)
+
+        offsets = []
+        offset = 0
+        for start, stop in izip(starts, stops):
+            matches[start] += 1
+            matches[stop] -= 1
+            offsets.append(offset)
+            offset += stop - start
+
+        # compare all hits with the reference at once
+        bases = ''.join(imap(operator.getslice, repeat(plus), starts, stops))
+        for i in mismatches(hitseq, bases):
+            k = bisect.bisect_right(offsets, i) - 1
+            c_i = starts[k] + i - offsets[k]
+            counts[5 * c_i + refs[c_i]] -= 1
+            counts[5 * c_i + ord(BASE_IDXS[ord(hitseq[i])])] += 1
+
+    def apply_counts(self, counts):
+        '''
+        :param counts: sequence of five base counts (``A``, ``C``, ``G``,
+            ``T``, ``N``) for every position on the ``+`` strand as returned
+            by :py:func:`kvarq.engine.findseqs` with ``coverages`` set
 
-        for i, j in enumerate(range(start, stop)):
-            c_j = seq.plus_idx(j)
-            c_b = seq.plus_base(hitseq[i])
-            self.coverage[c_j] += 1
-            if hitseq[i] != seq[j]:
-                self.mutations[c_j] = self.mutations.get(c_j, '') + c_b
+        adds the counted bases to the sequence (same result as applying all
+        the hits the bases were counted from)
+        '''
+        self._cache = {}
+        self._counts = array('i', imap(operator.add, self._counts, counts))
+
+    @property
+    def counts(self):
+        ''' five base counts for every position (see :py:class:`Coverage`) '''
+        if self._matches is not None:
+            counts = self._counts
+            depth = 0
+            for c_j, (ref, delta) in enumerate(izip(self.refs, self._matches)):
+                depth += delta
+                if depth:
+                    counts[5 * c_j + ref] += depth
+            self._matches = None
+        return self._counts
+
+    def set_counts(self, coverage, mutations):
+        '''
+        sets :py:attr:`counts` from depths and alternate bases
+
+        :param coverage: depth for every position
+        :param mutations: dictionary of alternate bases (see
+            :py:class:`Coverage`)
+        '''
+        self._matches = None
+        self._cache = {}
+        counts = self._counts = array('i', [0]) * (5 * len(self.plus_seq))
+        for c_j, (ref, depth) in enumerate(izip(self.refs, coverage)):
+            counts[5 * c_j + ref] = depth
+        for c_j, bases in mutations.items():
+            ref = self.refs[c_j]
+            for b in bases:
+                b = ord(BASE_IDXS[ord(b)])
+                if b != ref:
+                    counts[5 * c_j + b] += 1
+                    counts[5 * c_j + ref] -= 1
+
+    def _columns(self):
+        ''' :returns: list of the counts of every base (``A``, ``C``, ...) '''
+        counts = self.counts
+        return [counts[b::5] for b in range(len(BASES))]
+
+    @cached
+    def _depths(self):
+        return array('i', imap(sum, izip(*self._columns())))
+
+    @cached
+    def _refcounts(self):
+        ''' :returns: count of original base at every position '''
+        return map(self.counts.__getitem__,
+                imap(operator.add, xrange(0, 5 * len(self), 5), self.refs))
+
+    @cached
+    def _dominant(self):
+        ''' :returns: fraction of most prevalent base at every position '''
+        return map(operator.truediv, imap(max, izip(*self._columns())),
+                imap(max, repeat(1), self._depths()))
+
+    @cached
+    def _mutations(self):
+        counts = self.counts
+        mutations = {}
+        for c_j in compress(count(), imap(operator.ne,
+                self._depths(), self._refcounts())):
+            ref = self.refs[c_j]
+            mutations[c_j] = ''.join([BASES[b] * n
+                    for b, n in enumerate(counts[5 * c_j:5 * c_j + 5])
+                    if n and b != ref])
+        return mutations
+
+    def _range(self, include_margins):
+        if include_margins:
+            return 0, len(self)
+        return self.start, self.stop
+
+    @property
+    @cached
+    def coverage(self):
+        ''' tuple of depth at every position '''
+        return tuple(self._depths())
+
+    @coverage.setter
+    def coverage(self, coverage):
+        self.set_counts(coverage, self.mutations)
+
+    @property
+    @cached
+    def mutations(self):
+        ''' :py:class:`FrozenDict` of alternate bases (see
+            :py:class:`Coverage`) '''
+        return FrozenDict(self._mutations())
+
+    @mutations.setter
+    def mutations(self, mutations):
+        self.set_counts(self.coverage, mutations)
 
     def bases_at(self, idx):
         ''' :returns: dictionary of ``{'A': n, ...}`` at specified position
             (including original base) '''
-        m = self.mutations.get(idx, '')
-        ret = { self.plus_seq[idx]: self.coverage[idx]-len(m) }
-        for b in set(m):
-            ret[b] = m.count(b)
+        row = self.counts[5 * idx:5 * idx + 5]
+        ref = self.refs[idx]
+        ret = dict([(BASES[b], n) for b, n in enumerate(row) if n and b != ref])
+        ret[self.plus_seq[idx]] = row[ref]
         return ret
 
     def fractions_at(self, idx):
@@ -95,20 +414,14 @@ class Coverage:
                 (b, n/float(max(1, total))) for b, n in bases.items()
             ], key=lambda x:-x[1]))
 
+    @cached
     def minf(self, include_margins=False):
         ''' :param include_margins: whether to check in the margins as well
             :returns: minimum fraction of most dominant base '''
+        start, stop = self._range(include_margins)
+        return min(self._dominant()[start:stop])
 
-        if include_margins:
-            start = 0
-            stop = len(self)
-        else:
-            start = self.start
-            stop = self.stop
-
-        return min([self.fractions_at(pos).values()[0]
-                for pos in range(start, stop)])
-
+    @cached
     def mixed(self, fmin=0.9, include_margins=False):
         ''' whether coverage seems to be mixed
 
@@ -121,32 +434,33 @@ class Coverage:
         cminf = self.minf(include_margins=include_margins)
         return cminf > 0 and cminf< fmin
 
+    @cached
     def mean(self, include_margins=True):
         '''
         :param include_margins: whether to include the two flanks
         :returns: the average depth of coverage (optionally including the flanks)
         '''
-        if include_margins:
-            return sum(self.coverage)/float(len(self.coverage))
-        else:
-            return sum(self.coverage[self.start:self.stop])/float(self.stop-self.start)
+        start, stop = self._range(include_margins)
+        return sum(self._depths()[start:stop])/float(stop-start)
 
+    @cached
     def std(self, include_margins=True):
         '''
         :param include_margins: whether to include the two flanks
-        :returns: the average depth of coverage (optionally including the flanks)
+        :returns: the standard deviation of the depth of coverage (optionally
+            including the flanks)
         '''
-        m = self.mean()
-        if include_margins:
-            xs = self.coverage
-        else:
-            xs = self.coverage[self.start:self.stop+1]
-        return (sum([(x-m)**2 for x in self.coverage])/len(self.coverage))**.5
-
+        start, stop = self._range(include_margins)
+        xs = self._depths()[start:stop]
+        n = len(xs)
+        s = sum(xs)
+        # exact integer arithmetic up to the final division
+        return ((n*sum(imap(operator.mul, xs, xs)) - s*s)/float(n*n))**.5
+
+    @cached
     def seqmean(self):
         ''' :returns: mean coverage of sequence, *not* counting mutations '''
-        seq = [self.coverage[i] - len(self.mutations.get(i, ''))
-                for i in range(self.start, self.stop)]
+        seq = self._refcounts()[self.start:self.stop]
         return sum(seq)/float(len(seq))
 
     def __str__(self):
@@ -158,32 +472,125 @@ class Coverage:
         '''
         :returns: a stringified and human-readable representation of
             ``.coverage`` and ``.mutations`` '''
-        cov = '-'.join([str(c) for c in self.coverage])
-        mut = '-'.join(['%d[%s]'%(idx, ''.join(sorted(self.mutations[idx])))
-                for idx in sorted(self.mutations.keys())])
-        return cov + ' ' + mut
+        return resultfile.serialize_coverage(self.coverage, self.mutations)
 
     def deserialize(self, serialized_coverage):
         ''' :param serialized_coverage: string as returned from ``.serialize()``
 
             recreates ``.coverage`` and ``.mutations`` as specified by serialized
             string '''
-        c_s, space, m_s = serialized_coverage.partition(' ')
-        self.coverage = [int(x) for x in c_s.split('-')]
-        if m_s:
-            self.mutations = dict([(int(x[:x.index('[')]), x[x.index('[')+1:x.index(']')])
-                    for x in m_s.split('-')])
-        else:
-            self.mutations = {}
+        self.set_counts(*resultfile.parse_coverage(serialized_coverage))
 
     def __len__(self):
         ''' :returns: length of ``.coverage`` '''
-        return self.coverage.__len__()
+        return len(self.plus_seq)
 
     def __getitem__(self, idx):
         ''' :returns: depth of coverage at specified position '''
-        return self.coverage.__getitem__(idx)
+        return self._depths()[idx]
+
+
+
+class LazyCoverages(OrderedDict):
+    '''
+    :py:class:`collections.OrderedDict` of :py:class:`Coverage` where some
+    of the coverages are only created when they are first accessed (see
+    :py:meth:`set_lazy`)
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.factories = {}
+        super(LazyCoverages, self).__init__(*args, **kwargs)
+
+    def set_lazy(self, key, factory):
+        ''' :param factory: function without arguments that returns the
+            value of ``key`` when it is first accessed '''
+        super(LazyCoverages, self).__setitem__(key, None)
+        self.factories[key] = factory
+
+    def __getitem__(self, key):
+        if key in self.factories:
+            super(LazyCoverages, self).__setitem__(key, self.factories[key]())
+            del self.factories[key]
+        return super(LazyCoverages, self).__getitem__(key)
 
+    def __setitem__(self, key, value):
+        self.factories.pop(key, None)
+        super(LazyCoverages, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.factories.pop(key, None)
+        super(LazyCoverages, self).__delitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
+# see kvarq.resultfile.serialize_coverage
+SERIALIZED_COVERAGE = re.compile(r'^\d+(-\d+)*( (\d+\[[A-Z]*\](-\d+\[[A-Z]*\])*)?)?$')
+
+def check_coverage(name, serialized_coverage):
+    '''
+    checks the format of a coverage without decoding the depths (see
+    :py:func:`decode_coverage`)
+
+    :param serialized_coverage: coverage as found in the data returned by
+        :py:meth:`Analyser.encode`
+    :returns: number of positions of the coverage
+    :raises DataInconcistencyException: if the coverage is malformed
+    '''
+    try:
+        if isinstance(serialized_coverage, basestring):
+            if not SERIALIZED_COVERAGE.match(serialized_coverage):
+                raise ValueError('cannot parse "%s"' % serialized_coverage[:40])
+            c_s, space, m_s = serialized_coverage.partition(' ')
+            length = c_s.count('-') + 1
+            positions = [int(x[:x.index('[')]) for x in m_s.split('-') if x]
+        else:
+            depths, mutations = serialized_coverage
+            length = len(depths)
+            positions = mutations.keys()
+            if not all([isinstance(bases, basestring)
+                    for bases in mutations.values()]):
+                raise ValueError('mutations must be strings of bases')
+        if not length:
+            raise ValueError('no positions')
+        if positions and not 0 <= min(positions) <= max(positions) < length:
+            raise ValueError('mutation outside of %d positions' % length)
+    except (ValueError, TypeError, AttributeError), e:
+        raise DataInconcistencyException('invalid coverage "%s" : %s' % (name, e))
+    return length
+
+def decode_coverage(template, spacing, serialized_coverage, length=None):
+    '''
+    :param template: :py:class:`kvarq.genes.Template` of the coverage
+    :param spacing: flank length used for templates read from the genome
+    :param serialized_coverage: coverage as found in the data returned by
+        :py:meth:`Analyser.encode`
+    :param length: number of positions as returned by
+        :py:func:`check_coverage`
+    :returns: new :py:class:`Coverage`
+    :raises DataInconcistencyException: if the coverage does not have the
+        same length as the sequence of the template
+    '''
+    if isinstance(template, genes.DynamicTemplate):
+        seq = template.seq(spacing=spacing)
+    else:
+        seq = template.seq()
+
+    if length is not None and length != len(seq):
+        raise DataInconcistencyException('coverage "%s" has %d positions, '
+                'but the sequence of the template has %d' % (
+                    template, length, len(seq)))
+
+    coverage = Coverage(seq)
+    if isinstance(serialized_coverage, basestring):
+        coverage.deserialize(serialized_coverage)
+    else:
+        coverage.set_counts(*serialized_coverage)
+    return coverage
 
 
 class DecodingException(Exception):
@@ -204,7 +611,171 @@ class DataInconcistencyException(DecodingException):
     ''' issued when :py:class:`Analyser` cannot be decode()d due to some
         inconsistency in the decoded data '''
 
-class Analyser:
+class TemplateSet:
+
+    '''
+    The sequences of all tests of some testsuites, prepared once to scan
+    many ``.fastq`` files with the same testsuites (see
+    :py:meth:`Analyser.scan` and :py:mod:`kvarq.batch`)
+
+    The prepared sequences can be cached in a directory : reading the
+    templates from the reference genomes and computing the reverse
+    complements is then skipped as long as the testsuites (names, versions
+    and templates), ``spacing``, the reference genome files and the KvarQ
+    version do not change.  Only the ``cache_size`` most recently used
+    cache files are kept in the directory.
+    '''
+
+    cache_size = 8
+
+    def __init__(self, testsuites, spacing=default_config['spacing'],
+            do_reverse=True, cachedir=None):
+        '''
+        :param testsuites: dictionary of instances of
+            :py:class:`kvarq.genes.Testsuite`
+        :param spacing: how many bases are added on either side to the
+            sequence from templates that are read from a reference genome
+        :param do_reverse: whether to scan for the reverse complements
+            as well
+        :param cachedir: directory where prepared sequences are cached
+            (``None`` disables caching)
+        '''
+        self.testsuites = testsuites
+        self.spacing = spacing
+        self.do_reverse = do_reverse
+
+        # (plus_seq, minus_seq) indexed by str(Test)
+        self.sequences = None
+        if cachedir:
+            cachefile = os.path.join(cachedir,
+                    'templates-%s.marshal' % self.cache_key())
+            names = OrderedDict.fromkeys([str(test.template)
+                    for testsuite in testsuites.values()
+                    for test in testsuite.tests]).keys()
+            self.sequences = self.load_cache(cachefile, names)
+
+        if self.sequences is None:
+            self.sequences = OrderedDict()
+            for name, testsuite in testsuites.items():
+                for test in testsuite.tests:
+                    if isinstance(test.template, genes.DynamicTemplate):
+                        seq = test.template.seq(spacing=spacing)
+                    else:
+                        seq = test.template.seq()
+
+                    self.sequences[str(test.template)] = (seq, seq.reverse())
+
+            if cachedir:
+                self.save_cache(cachefile)
+
+        # arguments for engine.findseqs()
+        self.seqs = [plus.bases for plus, minus in self.sequences.values()]
+        if do_reverse:
+            self.seqs += [minus.bases for plus, minus in self.sequences.values()]
+        n = len(self.sequences)
+        self.mapping = [(i % n, i < n) for i in range(len(self.seqs))]
+
+    def coverages(self):
+        '''
+        :returns: an :py:class:`collections.OrderdDict` of new
+            :py:class:`.Coverage` indexed by ``str(Test)``
+        '''
+        return OrderedDict([(name, Coverage(plus, minus))
+                for name, (plus, minus) in self.sequences.items()])
+
+    def cache_key(self):
+        '''
+        :returns: hash of everything the prepared sequences depend on :
+            name, version and templates of every testsuite, ``spacing``
+            and path, size and modification time of the reference genomes
+        '''
+        key = [VERSION, marshal.version, self.spacing]
+        genomes = set()
+        for name in sorted(self.testsuites):
+            testsuite = self.testsuites[name]
+            key.append((name, testsuite.version))
+            for test in testsuite.tests:
+                key.append((str(test.template),
+                        getattr(test.template, 'bases', None)))
+                genome = getattr(test.template, 'genome', None)
+                if genome is not None:
+                    genomes.add(os.path.abspath(genome.path))
+        for path in sorted(genomes):
+            st = os.stat(path)
+            key.append((path, st.st_size, st.st_mtime))
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def load_cache(self, fname, names=None):
+        '''
+        :param names: expected names of the templates (in the same order)
+        :returns: sequences read from cache file ``fname`` (or ``None``
+            if there is no such file, it cannot be read or it does not
+            contain the expected templates)
+        '''
+        if not os.path.exists(fname):
+            return None
+        # (any file that cannot be decoded is ignored and overwritten)
+        try:
+            data = marshal.load(file(fname, 'rb'))
+            sequences = OrderedDict()
+            for name, bases, left, right, pos, minus_bases in data:
+                sequences[name] = (
+                        genes.Sequence(bases, left, right, pos=pos),
+                        genes.Sequence(minus_bases, left, right, pos=pos,
+                            plus_strand=False))
+            if names is not None and sequences.keys() != names:
+                raise ValueError('templates do not match testsuites')
+        except Exception, e:
+            lo.warning('cannot read template cache %s : %s' % (fname, e))
+            return None
+
+        try:
+            # (mark as recently used, see .prune_cache())
+            os.utime(fname, None)
+        except OSError:
+            pass
+        lo.debug('read %d templates from cache %s' % (len(sequences), fname))
+        return sequences
+
+    def save_cache(self, fname):
+        ''' saves ``.sequences`` to cache file ``fname`` (errors are
+            logged but otherwise ignored) '''
+        data = [(name, plus.bases, plus.left, plus.right, plus.pos, minus.bases)
+                for name, (plus, minus) in self.sequences.items()]
+        try:
+            dirname = os.path.dirname(fname)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            # written to temporary file and then renamed : other processes
+            # never read partial cache files
+            fd, tmpname = tempfile.mkstemp(dir=dirname)
+            f = os.fdopen(fd, 'wb')
+            marshal.dump(data, f)
+            f.close()
+            os.rename(tmpname, fname)
+        except (IOError, OSError), e:
+            lo.warning('cannot write template cache %s : %s' % (fname, e))
+            return
+        self.prune_cache(os.path.dirname(fname))
+
+    def prune_cache(self, cachedir):
+        ''' removes all but the ``cache_size`` most recently used cache
+            files from ``cachedir`` (e.g. files of previous KvarQ versions
+            or of testsuites that were modified) '''
+        try:
+            fnames = [os.path.join(cachedir, fname)
+                    for fname in os.listdir(cachedir)
+                    if fname.startswith('templates-')
+                    and fname.endswith('.marshal')]
+            fnames.sort(key=os.path.getmtime, reverse=True)
+            for fname in fnames[self.cache_size:]:
+                lo.debug('removing template cache %s' % fname)
+                os.remove(fname)
+        except OSError, e:
+            lo.warning('cannot prune template cache %s : %s' % (cachedir, e))
+
+
+class Analyser(object):
 
     '''
     Main class for analyzing raw genome data. the ``.fastq`` file is first
@@ -245,13 +816,21 @@ class Analyser:
         self.fastq_records_approx = None
         self.spacing = default_config['spacing']
 
-        # direct results from scanning
-        self.hits = None 
+        # direct results from scanning (.hits and .hitseqs are decoded when
+        # first accessed after .decode)
+        self._encoded = {}
+        self.hits = None
+        self.hitseqs = None
         self.stats = None
         self.scantime = 0
+        # fraction of the file that was scanned (see engine.config(sample=))
+        self.sampled = 1.
 
         # list of coverages will be generated upeon scanning/decoding
         self.coverages = None
+        # held while .coverages are updated during scanning (other threads
+        # must hold it too when reading the coverages before scan returns)
+        self.lock = threading.Lock()
 
         # final results
         self.results = None
@@ -268,18 +847,7 @@ class Analyser:
             length specified by ``spacing``
         '''
 
-        coverages = OrderedDict()
-
-        for name, testsuite in testsuites.items():
-            for test in testsuite.tests:
-                if isinstance(test.template, genes.DynamicTemplate):
-                    seq = test.template.seq(spacing=self.spacing)
-                else:
-                    seq = test.template.seq()
-
-                coverages[str(test.template)] = Coverage(seq)
-
-        return coverages
+        return TemplateSet(testsuites, spacing=self.spacing).coverages()
 
     def coverage_at(self, i):
         '''
@@ -325,16 +893,26 @@ class Analyser:
         else:
             return self.coverages[str(thing)]
 
-    def scan(self, fastq, testsuites, do_reverse=True):
+    def scan(self, fastq, testsuites, do_reverse=True, hits=True,
+            templates=None, scanner=None):
         '''
         :param fastq: :py:class:`kvarq.fastq.Fastq` file to scan
         :param testsuites: dictionary of instances of
             :py:class:`kvarq.genes.Testsuite`
-
-        initiates a :py:func:`kvarq.engine.findseqs` and fills the attributes
-        ``.hits``, ``.stats`` and ``.coverages``
-
-        note that the call to :py:func:`kvarq.engine.findseqs` can raise a
+        :param hits: whether to keep the hits; if set to ``False`` then the
+            engine counts the bases of the hits directly into the coverages
+            and ``.hits`` remain ``None``
+        :param templates: a :py:class:`TemplateSet` prepared beforehand
+            (``testsuites``, ``do_reverse`` and ``.spacing`` are then taken
+            from it)
+        :param scanner: the :py:class:`kvarq.engine.Scanner` to use
+            (defaults to ``engine.default_scanner``)
+
+        initiates a :py:func:`kvarq.engine.findseqs_iter` and fills the
+        attributes ``.hits``, ``.stats`` and ``.coverages`` (the coverages
+        are updated while the scanning is still in progress)
+
+        note that the call to :py:func:`kvarq.engine.findseqs_iter` can raise a
         :py:class:`kvarq.engine.FastqFileFormatException`
         '''
 
@@ -344,25 +922,72 @@ class Analyser:
         self.fastq_readlength = fastq.readlength
         self.fastq_records_approx = fastq.records_approx
 
-        self.testsuites = testsuites
-        self.coverages = self.load_coverages(testsuites, spacing=self.spacing)
-
-        self.config = engine.get_config()
+        if templates is None:
+            templates = TemplateSet(testsuites, spacing=self.spacing,
+                    do_reverse=do_reverse)
+        self.testsuites = templates.testsuites
+        self.spacing = templates.spacing
+        self.coverages = templates.coverages()
 
-        seqs = [coverage.plus_seq.bases for coverage in self.coverages.values()]
-        if do_reverse:
-            seqs += [coverage.minus_seq.bases for coverage in self.coverages.values()]
+        if scanner is None:
+            scanner = engine.default_scanner
+        self.config = scanner.get_config()
 
-        # do the scanning
+        # do the scanning; coverages are updated while the engine keeps
+        # scanning in its own threads
         t0 = time.time()
-        ret = engine.findseqs(self.fastq.filenames(), seqs)
-        lo.debug('found %d hits' % len(ret['hits']))
-        self.stats = ret['stats']
-        self.hits = ret['hits']
-        self.hitseqs = ret['hitseqs']
+        if hits:
+            # (the engine merges the hits of all batches after the last one)
+            batches = scanner.findseqs_iter(self.fastq.scan_input(),
+                    templates.seqs, columnar=True,
+                    templates=[ci for ci, plus in templates.mapping],
+                    merge=True)
+        else:
+            batches = scanner.findseqs_iter(self.fastq.scan_input(),
+                    templates.seqs, coverages=templates.mapping)
+
+        for batch in batches:
+            with self.lock:
+                if hits:
+                    self.apply_hits(Hits(batch['hits']),
+                            HitSeqs(*batch['hitseqs']))
+                else:
+                    coverages = self.coverages.values()
+                    for seq_nr, counts in batch['coverages'].items():
+                        coverages[seq_nr].apply_counts(counts)
+
+        self.stats = scanner.stats()
         self.scantime = time.time() - t0
+        self.sampled = self.stats['sampled']
 
-        self.update_coverages()
+        if hits:
+            merged = batches.merged()
+            self.hits = Hits(merged['hits'])
+            self.hitseqs = HitSeqs(*merged['hitseqs'])
+            lo.debug('found %d hits' % len(self.hits))
+        else:
+            self.hits = self.hitseqs = None
+
+    def apply_hits(self, hits, hitseqs):
+        ''' applies ``hits`` with corresponding ``hitseqs`` to
+            ``.coverages`` -- the hits are grouped by ``seq_nr`` (i.e. by
+            coverage and strand) and every group is applied in one call to
+            :py:meth:`Coverage.apply_many` '''
+        coverages = self.coverages.values()
+        n = len(coverages)
+
+        order = sorted(xrange(len(hits)), key=hits.seq_nr.__getitem__)
+        seq_nrs = map(hits.seq_nr.__getitem__, order)
+        seq_poss = map(hits.seq_pos.__getitem__, order)
+        lengths = map(hits.length.__getitem__, order)
+        hitseqs = map(list(hitseqs).__getitem__, order)
+
+        i = 0
+        for seq_nr, group in groupby(seq_nrs):
+            j = i + len(list(group))
+            coverages[seq_nr % n].apply_many(seq_poss[i:j], lengths[i:j],
+                    hitseqs[i:j], seq_nr < n)
+            i = j
 
 
     @tictoc('update_coverages')
@@ -376,9 +1001,7 @@ class Analyser:
         assert self.hitseqs is not None, 'cannot update coverages without .hitseqs'
         assert self.fastq is not None, 'cannot update coverages without .fastq'
 
-        for hit, hitseq in zip(self.hits, self.hitseqs):
-            coverage = self.coverage_at(hit.seq_nr)
-            coverage.apply_hit(hit, hitseq, hit.seq_nr < len(self.coverages))
+        self.apply_hits(self.hits, self.hitseqs)
 
 
     def update_testsuites(self):
@@ -395,22 +1018,36 @@ class Analyser:
                 self.results[name] = 'ERROR : ' + str(e)
 
     @tictoc('encode')
-    def encode(self, hits=False):
+    def encode(self, hits=False, arrays=False):
         ''' returns an object containing the following serializable information
 
             - ``analyses`` : final scanning results
             - ``info`` : meta-information about the file and scanning parameters
+              (``sampled`` is the fraction of the file that was scanned; the
+              coverages of a subsample divided by it estimate the coverages
+              of the entire file)
             - ``stats`` : scanning statistics
             - ``coverages`` : intermediate results (a :py:class:`Coverage` for
               every :py:class:`kvarq.genes.Test` in every used
               :py:class:`kvarq.genes.Testsuite`)
-            - ``hits`` (optional) : direct results form scanning
+            - ``hits`` (optional) : direct results form scanning (only
+              available if :py:meth:`.scan` was called with ``hits=True``)
+
+            if ``arrays`` is set, every coverage is returned as a tuple
+            ``(coverage, mutations)``, the hits as a dictionary of
+            :py:class:`array.array` indexed by field and the hit sequences as
+            a tuple ``(data, offsets)`` (see :py:class:`HitSeqs`); use
+            :py:func:`kvarq.resultfile.dump` to save these arrays
         '''
 
         more ={}
-        if hits:
-            more['hits'] = self.hits
-            more['hitseqs'] = self.hitseqs
+        if hits and self.hits is not None:
+            if arrays:
+                more['hits'] = dict(zip(Hits.types, self.hits.columns()))
+                more['hitseqs'] = (self.hitseqs.data, self.hitseqs.offsets)
+            else:
+                more['hits'] = self.hits.rows()
+                more['hitseqs'] = list(self.hitseqs)
 
         return dict(
                 analyses=self.results,
@@ -421,15 +1058,18 @@ class Analyser:
                     'readlength':self.fastq_readlength,
                     'records_approx':self.fastq_records_approx,
                     'scantime':self.scantime,
+                    'sampled':self.sampled,
                     'when':time.asctime(time.localtime()),
                     'version':VERSION,
+                    'file_pos_bits':engine.FILE_POS_BITS,
                     'config':self.config,
                     'spacing':self.spacing,
                     'testsuites':dict([(name, testsuite.version)
                             for name, testsuite in self.testsuites.items()]),
                 },
                 stats=self.stats,
-                coverages=[(name, coverage.serialize())
+                coverages=[(name, (coverage.coverage, coverage.mutations)
+                        if arrays else coverage.serialize())
                     for name, coverage in self.coverages.items()],
                 **more
             )
@@ -439,7 +1079,8 @@ class Analyser:
     def decode(self, testsuites, data):
         '''
         :param testsuites: dictionary of :py:class:`kvarq.genes.Testsuite`
-        :param data: dictionary as returned by :py:meth:`.encode`
+        :param data: dictionary as returned by :py:meth:`.encode` (with or
+            without ``arrays``)
 
         regenerates attributes as they were after the call to :py:meth:`.scan`
         previous to the call to :py:meth:`.encode` that generated the data
@@ -449,6 +1090,14 @@ class Analyser:
         file can still be found under location specified in the ``.json``
         file
 
+        the coverages are only created from the ``data`` (which reads the
+        sequences of the templates) when they are first accessed (see
+        :py:class:`LazyCoverages`), and the same is true for ``.hits`` and
+        ``.hitseqs``, so that the ``.results`` and other information can be
+        accessed quickly; the format of all coverages is checked right away
+        and a :py:class:`.DataInconcistencyException` is risen for malformed
+        coverages (see :py:func:`check_coverage`)
+
         this method uses :py:func:`kvarq.legacy.convert_legacy_data` to load
         data generated by older version of KvarQ. if the testsuites that were
         used to generate the data are not compatible with the testsuites currently
@@ -466,16 +1115,12 @@ class Analyser:
         self.fastq_records_approx = data['info'].get('records_approx', -1)
         self.stats = data['stats']
         self.scantime = data['info'].get('scantime', -1)
+        self.sampled = data['info'].get('sampled', 1.)
 
-        if 'hits' in data:
-            self.hits = [engine.Hit(*hit) for hit in data['hits']]
-        else:
-            self.hits = None
-
-        if 'hitseqs' in data:
-            self.hitseqs = data['hitseqs']
-        else:
-            self.hitseqs = None
+        self.hits = self.hitseqs = None
+        for key in ('hits', 'hitseqs'):
+            if key in data:
+                self._encoded[key] = data[key]
 
         if os.path.isfile(self.fastq_filenames[0]):
             lo.info('found .fastq file : ' + self.fastq_filenames[0])
@@ -514,7 +1159,7 @@ class Analyser:
                 templates[str(test.template)] = test.template
 
         self.spacing = data['info']['spacing']
-        self.coverages = OrderedDict()
+        self.coverages = LazyCoverages()
         for name, serialized_coverage in data['coverages']:
             if not name in templates:
                 # newer versions of testsuites can discard tests (backwards
@@ -523,26 +1168,52 @@ class Analyser:
                 #raise DecodingException('template "%s" not found in testsuites %s' %
                 #        (name, ', '.join(self.testsuites.keys())))
 
-            template = templates[name]
-            if isinstance(template, genes.DynamicTemplate):
-                seq = template.seq(spacing=self.spacing)
-            else:
-                seq = template.seq()
+            # (the format is checked now, the depths are only decoded
+            # when the coverage is accessed)
+            length = check_coverage(name, serialized_coverage)
+            self.coverages.set_lazy(name, functools.partial(decode_coverage,
+                    templates[name], self.spacing, serialized_coverage, length))
+
+    @property
+    def hits(self):
+        ''' :py:class:`Hits` found by :py:meth:`.scan` (or ``None``) '''
+        hits = self._encoded.pop('hits', None)
+        if isinstance(hits, dict):
+            self._hits = Hits(hits)
+        elif hits is not None:
+            self._hits = Hits.from_rows(hits)
+        return self._hits
+
+    @hits.setter
+    def hits(self, hits):
+        self._encoded.pop('hits', None)
+        self._hits = hits
 
-            coverage = Coverage(seq)
-            coverage.deserialize(serialized_coverage)
-            self.coverages[name] = coverage
+    @property
+    def hitseqs(self):
+        ''' :py:class:`HitSeqs` of the ``.hits`` (or ``None``) '''
+        hitseqs = self._encoded.pop('hitseqs', None)
+        if isinstance(hitseqs, tuple):
+            self._hitseqs = HitSeqs(*hitseqs)
+        elif hitseqs is not None:
+            self._hitseqs = HitSeqs.from_list(hitseqs)
+        return self._hitseqs
+
+    @hitseqs.setter
+    def hitseqs(self, hitseqs):
+        self._encoded.pop('hitseqs', None)
+        self._hitseqs = hitseqs
 
     @tictoc('extract_hits')
     def extract_hits(self, fname):
         out = open(fname, 'w')
-        for hit in self.hits:
-            out.write(self.fastq.readrecordat(hit))
+        for file_pos in self.hits.file_pos:
+            out.write(self.fastq.readrecordat(file_pos))
 
 
 class AnalyserJson:
 
-    ''' helper class to handle .json files created from
+    ''' helper class to handle .json (or binary .kvarq) files created from
         :py:class:`Analyser`.encode() '''
 
     def __init__(self, jpath, minver=None):
@@ -552,7 +1223,7 @@ class AnalyserJson:
             by ``minver``) '''
 
         try:
-            self.data = json.load(codecs.open(jpath, encoding='utf-8'))
+            self.data = resultfile.load_summary(jpath)
         except ValueError, e:
             raise DecodingException, 'not valid .json format : '+str(e)
 
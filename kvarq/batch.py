@@ -0,0 +1,275 @@
+'''
+Scanning of many ``.fastq`` files with the same testsuites.  The sequences
+of the testsuites are prepared only once (see
+:py:class:`kvarq.analyse.TemplateSet`), the files are then scanned
+concurrently using one :py:class:`kvarq.engine.Scanner` per worker and the
+results of every sample are saved in its own ``.json`` file.
+
+Small files are scanned in parallel with one thread each, while large files
+are scanned one after another using all threads.  Every completed sample is
+appended to a manifest file in the output directory, so that an interrupted
+batch can be resumed::
+
+    batch = Batch(fastqs, 'results/', testsuites, threads=8)
+    batch.run()
+'''
+
+from kvarq import engine
+from kvarq import analyse
+from kvarq import resultfile
+from kvarq.fastq import Fastq, FastqFileFormatException, inflated_size
+from kvarq.log import lo, format_traceback
+from kvarq.config import default_config
+
+import threading
+import json
+import os, os.path
+import sys
+
+MANIFEST = 'kvarq_batch.manifest'
+EXTENSIONS = ('.fastq.gz', '.fastq')
+
+
+def sample_name(fname):
+    ''' :returns: name of ``.fastq[.gz]`` file without directory and
+        extension
+        :raises ValueError: if the file has another extension '''
+    base = os.path.basename(fname)
+    for extension in EXTENSIONS:
+        if base.endswith(extension):
+            return base[:-len(extension)]
+    raise ValueError('"%s" must have extension ".fastq" or ".fastq.gz"' % fname)
+
+def other_name(fname):
+    ''' :returns: name of other file of paired set ``*_1.fastq[.gz]`` and
+        ``*_2.fastq[.gz]`` (or ``None``) '''
+    base = fname[:fname.rfind('.fastq')]
+    if base[-2:] == '_1':
+        return base[:-2] + '_2' + fname[len(base):]
+    if base[-2:] == '_2':
+        return base[:-2] + '_1' + fname[len(base):]
+
+
+class Batch:
+
+    '''
+    Scans a list of ``.fastq`` files, saving the results as
+    ``outdir/<sample>.json`` (where ``<sample>`` is the name of the
+    ``.fastq`` file without extension).
+
+    The manifest ``outdir/kvarq_batch.manifest`` contains a ``.json``
+    line for every completed sample; samples found in the manifest
+    (with an existing ``.json`` file) are skipped when the batch is run
+    again.
+    '''
+
+    def __init__(self, fastqs, outdir, testsuites, threads=default_config['threads'],
+            large=256*1024**2, paired=True, variant=None,
+            quality=default_config['quality'], spacing=default_config['spacing'],
+            do_reverse=True, cachedir=None, hits=False, **config):
+        '''
+        :param fastqs: list of ``.fastq`` files to scan (second files of
+            paired sets are scanned together with their first file if
+            ``paired`` is set)
+        :param outdir: directory where ``.json`` files and manifest are
+            written
+        :param testsuites: dictionary of instances of
+            :py:class:`kvarq.genes.Testsuite`
+        :param threads: total number of scanning threads
+        :param large: files (sum of paired files) of at least this many
+            bytes of uncompressed data (see
+            :py:func:`kvarq.fastq.inflated_size`) are scanned one after another using all threads, smaller
+            files are scanned concurrently using one thread each
+        :param quality: minimum PHRED score (``Amin`` is computed for
+            every file according to its variant)
+        :param cachedir: see :py:class:`kvarq.analyse.TemplateSet`
+        :param hits: whether to save the hits in the ``.json`` files
+        :param config: other keyword arguments of
+            :py:func:`kvarq.engine.config` (such as ``maxerrors``)
+
+        :raises ValueError: if a file does not have the extension ``.fastq``
+            or ``.fastq.gz`` or if several files (e.g. ``a/x.fastq`` and
+            ``b/x.fastq.gz``) would be saved in the same ``.json`` file
+        '''
+        # (the same file specified twice is scanned once)
+        unique = []
+        samples = {}
+        for fname in fastqs:
+            fnames = samples.setdefault(sample_name(fname), set())
+            if os.path.abspath(fname) not in fnames:
+                fnames.add(os.path.abspath(fname))
+                unique.append(fname)
+        fastqs = unique
+        duplicates = sorted([name for name, fnames in samples.items()
+                if len(fnames) > 1])
+        if duplicates:
+            raise ValueError('several files with the same sample name : %s '
+                    '(rename the files or scan them in separate batches)'
+                    % ', '.join(['%s (%s)' % (name, ', '.join(sorted(samples[name])))
+                        for name in duplicates]))
+
+        self.outdir = outdir
+        self.threads = max(1, threads)
+        self.large = large
+        self.paired = paired
+        self.variant = variant
+        self.quality = quality
+        self.hits = hits
+        self.config = config
+
+        self.templates = analyse.TemplateSet(testsuites, spacing=spacing,
+                do_reverse=do_reverse, cachedir=cachedir)
+
+        self.fastqs = [fname for fname in fastqs if not (paired and
+                fname[:fname.rfind('.fastq')].endswith('_2') and
+                other_name(fname) in fastqs)]
+
+        self.manifest = os.path.join(outdir, MANIFEST)
+        self.done = {}
+        self.failed = {}
+        self.stopped = False
+        self.scanners = []
+
+        # testsuites are shared by all workers
+        self.lock = threading.Lock()
+
+    def json_name(self, fname):
+        return os.path.join(self.outdir, sample_name(fname) + '.json')
+
+    def read_manifest(self):
+        ''' :returns: dictionary of completed samples indexed by absolute
+            ``.fastq`` file name '''
+        done = {}
+        if os.path.exists(self.manifest):
+            for line in file(self.manifest):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of interrupted batch
+                    continue
+                if os.path.exists(entry['json']):
+                    done[entry['fastq']] = entry
+        return done
+
+    def pending(self):
+        ''' :returns: list of ``.fastq`` files not yet completed '''
+        done = self.read_manifest()
+        return [fname for fname in self.fastqs
+                if os.path.abspath(fname) not in done]
+
+    def scan_one(self, scanner, fname, nthreads):
+        ''' scans ``fname`` and saves results; failures are logged and
+            saved in ``.failed`` '''
+
+        try:
+            fastq = Fastq(fname, paired=self.paired, variant=self.variant)
+            scanner.config(nthreads=nthreads, Amin=fastq.Q2A(self.quality),
+                    Azero=fastq.Azero, **self.config)
+
+            analyser = analyse.Analyser()
+            analyser.scan(fastq, None, hits=self.hits,
+                    templates=self.templates, scanner=scanner)
+            if self.stopped:
+                return
+
+            with self.lock:
+                analyser.update_testsuites()
+            data = analyser.encode(hits=self.hits, arrays=True)
+
+            # file is renamed only when complete
+            jname = self.json_name(fname)
+            tmpname = jname + '.part'
+            resultfile.dump(data, tmpname, binary=False)
+            os.rename(tmpname, jname)
+
+        except (FastqFileFormatException, IOError, OSError), e:
+            lo.error('could not scan %s : %s' % (fname, e))
+            with self.lock:
+                self.failed[fname] = str(e)
+            return
+        except Exception, e:
+            lo.error('could not scan %s : %s [%s]' % (
+                    fname, e, format_traceback(sys.exc_info())))
+            with self.lock:
+                self.failed[fname] = str(e)
+            return
+
+        entry = dict(fastq=os.path.abspath(fname), json=os.path.abspath(jname),
+                scantime=analyser.scantime)
+        with self.lock:
+            m = file(self.manifest, 'a')
+            m.write(json.dumps(entry) + '\n')
+            m.close()
+            self.done[fname] = entry
+        lo.info('scanned %s in %.2fs' % (fname, analyser.scantime))
+
+    def worker(self, queue, nthreads):
+        scanner = engine.Scanner()
+        with self.lock:
+            self.scanners.append(scanner)
+        while not self.stopped:
+            with self.lock:
+                if not queue:
+                    break
+                fname = queue.pop(0)
+            self.scan_one(scanner, fname, nthreads)
+        with self.lock:
+            self.scanners.remove(scanner)
+
+    def run(self):
+        '''
+        scans all pending files (blocks until all are scanned or
+        :py:meth:`stop` is called)
+
+        :returns: dictionary of failed samples (error message indexed by
+            ``.fastq`` file name)
+        '''
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+        pending = self.pending()
+        lo.info('scanning %d of %d samples (%d already completed)' % (
+                len(pending), len(self.fastqs), len(self.fastqs) - len(pending)))
+
+        def size(fname):
+            names = [fname]
+            if self.paired and fname[:fname.rfind('.fastq')].endswith('_1'):
+                names.append(other_name(fname))
+            return sum([inflated_size(name) if name.endswith('.gz')
+                    else os.path.getsize(name)
+                    for name in names if os.path.exists(name)])
+        sizes = dict([(fname, size(fname)) for fname in pending])
+        large = [fname for fname in pending if sizes[fname] >= self.large]
+        small = [fname for fname in pending if sizes[fname] < self.large]
+
+        # large files : all threads within one file
+        if large:
+            self.worker(large, self.threads)
+
+        # small files : files in parallel
+        if small:
+            workers = [threading.Thread(target=self.worker, args=(small, 1),
+                    name='batch-worker-%d' % i)
+                    for i in range(min(self.threads, len(small)))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                # (join with timeout to keep main thread responsive)
+                while worker.is_alive():
+                    worker.join(1)
+
+        return self.failed
+
+    def stop(self):
+        ''' stops scanning; samples currently being scanned are not
+            saved and will be scanned again when the batch is resumed '''
+        self.stopped = True
+        with self.lock:
+            for scanner in self.scanners:
+                scanner.stop()
+
+    def progress(self):
+        ''' :returns: ``(completed, total)`` number of samples, including
+            samples that were completed in previous runs '''
+        return len(self.fastqs) - len(self.pending()), len(self.fastqs)
+
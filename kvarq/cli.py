@@ -6,19 +6,19 @@ from kvarq import VERSION
 from kvarq import genes
 from kvarq import engine
 from kvarq import analyse
-from kvarq.util import ProgressBar, TextHist, json_dump, JsonSummary, get_help_path
+from kvarq import batch as kvarq_batch
+from kvarq import resultfile
+from kvarq.util import ProgressBar, TextHist, JsonSummary, get_help_path
 from kvarq.fastq import Fastq, FastqFileFormatException
 from kvarq.log import lo, appendlog, set_debug, set_warning, format_traceback
-from kvarq.config import default_config
+from kvarq.config import default_config, default_cachedir
 from kvarq.testsuites import discover_testsuites, load_testsuites, update_testsuites
 
 import argparse
 import sys
 import threading
 import time
-import json
 import os, os.path
-import codecs
 from pprint import pprint
 import glob
 
@@ -67,6 +67,14 @@ def scan(args):
         sys.stderr.write('(use the -t command line switch)\n\n')
         sys.exit(ERROR_COMMAND_LINE_SWITCH)
 
+    if not 0 < args.sample <= 1:
+        sys.stderr.write('\n*** --sample must be > 0 and <= 1 ***\n\n')
+        sys.exit(ERROR_COMMAND_LINE_SWITCH)
+
+    if args.fastq == '-' and args.extract_hits:
+        sys.stderr.write('\n*** cannot --extract_hits from standard input ***\n\n')
+        sys.exit(ERROR_COMMAND_LINE_SWITCH)
+
     # prepare scanning {{{2
 
     try:
@@ -81,10 +89,15 @@ def scan(args):
             Amin=fastq.Q2A(args.quality),
             Azero=fastq.Azero,
             minreadlength=args.readlength,
-            minoverlap=args.overlap
+            minoverlap=args.overlap,
+            maxcoverage=args.coverage,
+            sample=args.sample,
+            seed=args.seed
         )
 
     analyser = analyse.Analyser()
+    templates = analyse.TemplateSet(testsuites, spacing=args.spacing,
+            do_reverse=not args.no_reverse, cachedir=args.cache_directory)
 
     if not args.force:
         if os.path.exists(args.json):
@@ -96,10 +109,10 @@ def scan(args):
 
     # do scanning {{{2
 
-    mb = os.path.getsize(args.fastq) / 1024 / 1024
     lo.info('scanning {} ({})...'.format(
             ', '.join(fastq.filenames()),
-            ', '.join(['%.2f MB' % (filesize/1024.**2) for filesize in fastq.filesizes()])
+            ', '.join([filesize is None and 'stream' or '%.2f MB' % (filesize/1024.**2)
+                    for filesize in fastq.filesizes()])
         ))
     t0 = time.time()
 
@@ -114,8 +127,8 @@ def scan(args):
 
         def run(self):
             try:
-                self.analyser.spacing = args.spacing
-                self.analyser.scan(fastq, testsuites, do_reverse=not args.no_reverse)
+                self.analyser.scan(fastq, testsuites, templates=templates,
+                        hits=args.hits or bool(args.extract_hits))
                 self.finished = True
             except Exception, e:
                 self.exception = e
@@ -137,20 +150,14 @@ def scan(args):
         if not stats['records_parsed']:
             continue
 
-        if args.progress:
+        if args.progress and stats['total']:
             pb.update(stats['progress'])
             sys.stderr.write(str(pb))
-
-#        if args.coverage:
-#            means = sorted([n/len(analyser[i])
-#                    for i, n in enumerate(stats['nseqbasehits'])])
-#
-#            if means and means[len(means)/2] > args.coverage:
-#                print >> sys.stderr
-#                lo.info('aborting scanning: median of coverage %d > %d'%(
-#                        means[len(means)/2], args.coverage))
-#                engine.stop()
-#                break
+        elif args.progress:
+            # size of streams is not known
+            sys.stderr.write(pb.r + '%.2f MB (%d records) in %s' % (
+                    stats['parsed']/1024.**2, stats['records_parsed'],
+                    pb.fmt_secs(time.time() - t0)))
 
         # <CTRL-C> : output additional information
         if stats['sigints'] > sigints:
@@ -182,20 +189,104 @@ def scan(args):
     sys.stderr.write('\n')
     mbp = '%smb'% (stats['parsed']/1024**2)
     mbt = '%smb'% (stats['total' ]/1024**2)
-    lo.info('performed scanning of %.2f%% (%s/%s, %d records) in %.3f seconds'% (
-            1e2*stats['progress'], mbp, mbt, stats['records_parsed'], time.time()-t0))
+    if stats['total']:
+        lo.info('performed scanning of %.2f%% (%s/%s, %d records) in %.3f seconds'% (
+                1e2*stats['progress'], mbp, mbt, stats['records_parsed'], time.time()-t0))
+    else:
+        lo.info('performed scanning of stream (%s, %d records) in %.3f seconds'% (
+                mbp, stats['records_parsed'], time.time()-t0))
+    if args.coverage:
+        lo.info('%d/%d templates reached coverage %d' % (analyser.stats['nretired'],
+                len(analyser.coverages), args.coverage))
+    if args.sample < 1:
+        lo.info('scanned subsample of %d records (%.2f%% of the parsed data)' % (
+                analyser.stats['records_sampled'], 1e2*analyser.sampled))
 
     # save to file {{{2
     analyser.update_testsuites()
 
-    data = analyser.encode(hits=args.hits)
-    j = codecs.open(args.json, 'w', 'utf-8')
-    json_dump(data, j)
+    data = analyser.encode(hits=args.hits, arrays=True)
+    resultfile.dump(data, args.json)
 
     if args.extract_hits:
         at.analyser.extract_hits(args.extract_hits)
 
 
+# batch {{{1
+
+def batch(args):
+
+    testsuite_paths = discover_testsuites(args.testsuite_directory or [])
+    if args.select_all:
+        testsuites = load_testsuites(testsuite_paths, testsuite_paths.keys())
+    else:
+        testsuites = load_testsuites(testsuite_paths, args.select)
+
+    if not testsuites:
+        sys.stderr.write('\n*** you must specify at least one testsuite! ***\n\n')
+        sys.stderr.write('(use the -t command line switch)\n\n')
+        sys.exit(ERROR_COMMAND_LINE_SWITCH)
+
+    if not 0 < args.sample <= 1:
+        sys.stderr.write('\n*** --sample must be > 0 and <= 1 ***\n\n')
+        sys.exit(ERROR_COMMAND_LINE_SWITCH)
+
+    try:
+        b = kvarq_batch.Batch(args.fastq, args.outdir, testsuites,
+                threads=args.threads,
+                large=args.large * 1024**2,
+                paired=not args.no_paired,
+                variant=args.variant,
+                quality=args.quality,
+                spacing=args.spacing,
+                do_reverse=not args.no_reverse,
+                cachedir=args.cache_directory,
+                hits=args.hits,
+                maxerrors=args.errors,
+                minreadlength=args.readlength,
+                minoverlap=args.overlap,
+                maxcoverage=args.coverage,
+                sample=args.sample,
+                seed=args.seed)
+    except ValueError, e:
+        sys.stderr.write('\n*** %s ***\n\n' % e)
+        sys.exit(ERROR_COMMAND_LINE_SWITCH)
+
+    t0 = time.time()
+    bt = threading.Thread(target=b.run, name='batch-thread')
+    bt.start()
+
+    # <CTRL-C> twice within 2s stops the batch (see scan); the samples are
+    # scanned by their own scanners, so the default scanner keeps counting
+    sigints = engine.stats()['sigints']
+    sigintt = 0
+    while bt.is_alive():
+        bt.join(1)
+        stats = engine.stats()
+        if args.progress:
+            sys.stderr.write('\r%d/%d samples' % b.progress())
+        if stats['sigints'] > sigints:
+            if time.time() - sigintt < 2.:
+                sys.stderr.write('\n\n*** caught multiple <CTRL-C> '
+                        'within 2s : abort batch (run again to resume) ***\n')
+                b.stop()
+                bt.join()
+                break
+            sys.stderr.write('\n%d/%d samples completed\n' % b.progress())
+            sigints = stats['sigints']
+            sigintt = time.time()
+
+    if args.progress:
+        sys.stderr.write('\n')
+    done, total = b.progress()
+    lo.info('completed %d/%d samples in %.3f seconds' % (
+            done, total, time.time() - t0))
+    if b.failed:
+        lo.error('could not scan %d samples : %s' % (
+                len(b.failed), ', '.join(sorted(b.failed))))
+        sys.exit(ERROR_FASTQ_FORMAT_ERROR)
+
+
 # show {{{1
 
 def show(args):
@@ -228,7 +319,7 @@ def update(args):
     if args.fastq:
         lo.warning('re-reading of hits not currently implemented')
 
-    data = json.load(file(args.json))
+    data = resultfile.load(args.json)
 
     testsuite_paths = discover_testsuites(args.testsuite_directory or [])
     testsuites = {}
@@ -238,11 +329,10 @@ def update(args):
     analyser.decode(testsuites, data)
     analyser.update_testsuites()
 
-    # save results back to .json
-    data = analyser.encode(hits = analyser.hits is not None)
-    j = codecs.open(args.json, 'w', 'utf-8')
+    # save results back to same file (in same format)
+    data = analyser.encode(hits = analyser.hits is not None, arrays=True)
+    resultfile.dump(data, args.json, binary=resultfile.is_binary(args.json))
     lo.info('re-wrote results to file ' + args.json)
-    json.dump(data, j, indent=2)
 
 
 # summarize {{{1
@@ -257,11 +347,22 @@ def summarize(args):
     js.dump()
 
 
+# convert {{{1
+
+def convert(args):
+
+    if os.path.exists(args.output) and not args.force:
+        lo.error('will not overwrite file ' + args.output)
+        sys.exit(ERROR_FILE_EXISTS)
+
+    resultfile.dump(resultfile.load(args.input), args.output)
+
+
 # illustrate {{{1
 
 def illustrate(args):
 
-    data = json.load(file(args.file))
+    data = resultfile.load(args.file)
 
     testsuite_paths = discover_testsuites(args.testsuite_directory or [])
     testsuites = {}
@@ -379,6 +480,11 @@ parser.add_argument('-x', '--excepthook', action='store_true',
         help='catch exception and launch debugger')
 parser.add_argument('-l', '--log',
         help='append log to specified file (similar to redirecting stderr, but without progress bar)')
+parser.add_argument('--cache', action='store_const', dest='cache_directory',
+        const=default_cachedir(),
+        help='cache the prepared sequences of the testsuites for faster startup of scan and batch in the directory %s (caching is disabled by default)' % default_cachedir())
+parser.add_argument('--cache-directory',
+        help='same as --cache, but using the specified directory')
 parser.add_argument('-t', '--testsuite-directory', action='append',
         help='specify a directory that contains subdirectories from which testsuites can be loaded; these are added to the pool of testsuites that can later be selected (scan, info) or that are autoloaded (illustrate, explore, update)')
 
@@ -425,9 +531,13 @@ parser_scan.add_argument('-o', '--overlap', action='store', type=int,
 parser_scan.add_argument('-s', '--spacing', action='store', type=int,
         default=default_config['spacing'],
         help='default flank length on both sides of templates generated from genome (default=%d)' % default_config['spacing'])
-#parser_scan.add_argument('-c', '--coverage', type=int,
-#        default=default_config['stop median coverage'],
-#        help='stop scanning when median coverage (including margins) is above specified value (default=%d) -- specify 0 to force scanning of entire file' % default_config['stop median coverage'])
+parser_scan.add_argument('-c', '--coverage', type=int,
+        default=default_config['stop coverage'],
+        help='stop looking for templates whose mean coverage on both strands (bases found / template length, including margins) reaches the specified value and stop scanning when all templates reached it (default=%d) -- specify 0 to force scanning of entire file' % default_config['stop coverage'])
+parser_scan.add_argument('--sample', type=float, default=1.,
+        help='only scan the specified fraction of the records for a fast preview (the file is subsampled in blocks of 64kb; the scanned fraction is saved in the .json file; default=1)')
+parser_scan.add_argument('--seed', type=int, default=0,
+        help='choose a different subsample when using --sample (default=0)')
 parser_scan.add_argument('-1', '--no-reverse', action='store_true',
         help='do not scan for hits in reverse strand')
 parser_scan.add_argument('-P', '--no-paired', action='store_true',
@@ -445,9 +555,61 @@ parser_scan.add_argument('-x', '--extract_hits',
 
 # main arguments
 parser_scan.add_argument('fastq',
-        help='name of .fastq file to scan')
+        help='name of .fastq file to scan ("-" reads .fastq or .fastq.gz data from standard input)')
 parser_scan.add_argument('json',
-        help='name of .json file to where results are stored (or loaded, see -S)')
+        help='name of .json file to where results are stored (or loaded, see -S); results are stored in the binary format if the file name ends with .kvarq')
+
+# batch {{{2
+parser_batch = subparsers.add_parser('batch',
+        help='scan many .fastq files with the same testsuites and save the results of every sample in its own .json file; a manifest in the output directory records completed samples so that an interrupted batch can be resumed by running the same command again')
+parser_batch.set_defaults(func=batch)
+
+parser_batch.add_argument('-p', '--progress', action='store_true',
+        help='shows number of completed samples on stderr')
+parser_batch.add_argument('-L', '--select-all', action='store_true',
+        help='load all discovered testsuites')
+parser_batch.add_argument('-l', '--select', action='append',
+        help='select testsuites (see scan)')
+parser_batch.add_argument('-t', '--threads', action='store', type=int,
+        default=default_config['threads'],
+        help='total number of threads; small files are scanned concurrently with one thread each, large files one after another with all threads (default: %d)' % default_config['threads'])
+parser_batch.add_argument('--large', type=int, default=256,
+        help='files (including paired file) of at least this many megabytes (uncompressed) are considered large (default=256)')
+parser_batch.add_argument('-Q', '--quality', action='store', type=int,
+        default=default_config['quality'],
+        help='discard nucleotides with Q score inferior to this value (default=%d)' % default_config['quality'])
+parser_batch.add_argument('-e', '--errors', action='store', type=int,
+        default=default_config['errors'],
+        help='maximal number of errors allowed when comparing base sequences (default=%d)' % default_config['errors'])
+parser_batch.add_argument('-r', '--readlength', action='store', type=int,
+        default=default_config['minimum readlength'],
+        help='minimum read length (default=%d)' % default_config['minimum readlength'])
+parser_batch.add_argument('-o', '--overlap', action='store', type=int,
+        default=default_config['minimum overlap'],
+        help='minimum read overlap (default=%d)' % default_config['minimum overlap'])
+parser_batch.add_argument('-s', '--spacing', action='store', type=int,
+        default=default_config['spacing'],
+        help='default flank length on both sides of templates generated from genome (default=%d)' % default_config['spacing'])
+parser_batch.add_argument('-c', '--coverage', type=int,
+        default=default_config['stop coverage'],
+        help='stop scanning a file once all templates reached this mean coverage (see scan; default=%d)' % default_config['stop coverage'])
+parser_batch.add_argument('--sample', type=float, default=1.,
+        help='only scan the specified fraction of the records (see scan; default=1)')
+parser_batch.add_argument('--seed', type=int, default=0,
+        help='choose a different subsample when using --sample (default=0)')
+parser_batch.add_argument('-1', '--no-reverse', action='store_true',
+        help='do not scan for hits in reverse strand')
+parser_batch.add_argument('-P', '--no-paired', action='store_true',
+        help='do not scan "strain_2.fastq[.gz]" together with "strain_1.fastq[.gz]"')
+parser_batch.add_argument('--variant', choices=Fastq.vendor_variants.keys(),
+        help='specify .fastq variant manually in case heuristic determination fails')
+parser_batch.add_argument('-H', '--hits', action='store_true',
+        help='saves all hits in the .json files')
+
+parser_batch.add_argument('outdir',
+        help='directory where the .json files (named after the .fastq files) and the manifest are stored')
+parser_batch.add_argument('fastq', nargs='+',
+        help='names of .fastq files to scan')
 
 # update {{{2
 parser_update = subparsers.add_parser('update',
@@ -486,6 +648,18 @@ parser_summarize.set_defaults(func=summarize)
 parser_summarize.add_argument('json', nargs='+',
         help='input .json files')
 
+# convert {{{2
+parser_convert = subparsers.add_parser('convert',
+        help='converts results between .json and the binary .kvarq format (that is faster to load and smaller when hits are saved); the format of the output is chosen by its extension')
+parser_convert.set_defaults(func=convert)
+
+parser_convert.add_argument('-f', '--force', action='store_true',
+        help='overwrite any existing output file')
+parser_convert.add_argument('input',
+        help='name of .json or .kvarq file to read')
+parser_convert.add_argument('output',
+        help='name of .json or .kvarq file to write')
+
 # illustrate {{{2
 parser_illustrate = subparsers.add_parser('illustrate',
         help='illustrate some information contained in a .json file (previously generated using the "scan" command)')
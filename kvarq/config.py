@@ -1,14 +1,30 @@
 
+import sys
+import os, os.path
+
 default_config = {
     'quality' : 13,
     'errors' : 2,
     'minimum overlap' : 25,
     'minimum readlength' : 25,
-#    'stop median coverage' : 30,
+    'stop coverage' : 0,
     'threads' : 8,
     'spacing': 25,
 }
 
+def default_cachedir():
+    ''' :returns: per-user directory where the prepared sequences of
+        testsuites are cached when caching is enabled (see
+        :py:class:`kvarq.analyse.TemplateSet`) '''
+    home = os.path.expanduser('~')
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or home
+    elif sys.platform == 'darwin':
+        base = os.path.join(home, 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(home, '.cache')
+    return os.path.join(base, 'kvarq')
+
 def config_params(config, fastq):
     return dict(
             nthreads=config['threads'],
@@ -16,6 +32,9 @@ def config_params(config, fastq):
             minreadlength=config['minimum readlength'],
             minoverlap=config['minimum overlap'],
             Amin=fastq.Q2A(config['quality']),
-            Azero=fastq.Azero
+            Azero=fastq.Azero,
+            maxcoverage=config.get('stop coverage', 0),
+            # the GUI scans the same files again
+            gzindex=1
         )
 
@@ -1,8 +1,13 @@
 
 import math
 import gzip
-import os.path
+import zlib
+import os, os.path
+import sys
+import errno
+import threading
 import collections
+from cStringIO import StringIO
 
 from kvarq.log import lo, tictoc
 
@@ -36,6 +41,36 @@ from http://en.wikipedia.org/wiki/FASTQ_format#Encoding:
 class FastqFileFormatException(Exception):
     pass
 
+
+# sizes returned by inflated_size() indexed by file name and stat() results
+inflated_sizes = {}
+INFLATED_SIZES_MAX = 1024
+
+def inflated_size(fname):
+    '''
+    determines the size of the inflated data of a ``.gz`` file without
+    inflating the whole file; the size is computed only once for every
+    file as long as it is not modified
+
+    The size is computed by :py:func:`kvarq.engine.inflated_size` : it is
+    exact for BGZF files and for files that consist of a single gzip member,
+    and extrapolated from the first bytes of the file otherwise.  The engine
+    starts scanning a ``.gz`` file with the same size.
+
+    :returns: size of the inflated data in bytes (or the size of the file
+        if it does not start with a gzip header)
+    '''
+    from kvarq import engine
+    st = os.stat(fname)
+    key = (os.path.abspath(fname),
+            st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    if key not in inflated_sizes:
+        if len(inflated_sizes) >= INFLATED_SIZES_MAX:
+            inflated_sizes.clear()
+        inflated_sizes[key] = engine.inflated_size(fname)
+    return inflated_sizes[key]
+
+
 class Fastq:
 
     ASCII = '!"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ' + \
@@ -52,12 +87,19 @@ class Fastq:
             ('Illumina 1.8+', VendorProperties(range(0, 62), 0))
         ))
 
+    # number of bytes read from streams to determine variant
+    STREAM_HEAD = 1024**2
+    # number of bytes copied at once from streams to the engine
+    STREAM_CHUNK = 1024**2
+
     def __init__(self, fname, variant=None, fd=None, paired=False, quiet=False):
         '''
         open ``.fastq`` or ``.fastq.gz`` file and determine its
         variant (setting attribute ``.Azero`` accordingly)
 
-        :param fname: name of file to open
+        :param fname: name of file to open; ``"-"`` (standard input), a
+            file descriptor or an object with a ``.read()`` method are
+            read as a stream (see :py:meth:`.scan_input`)
         :param variant: specify one of ``.vendor_variants`` -- if none
             is specified, then the PHRED score of the fastq file is
             analyzed and
@@ -69,13 +111,17 @@ class Fastq:
             and ``.filenames()``)
         '''
         self.fname = fname
+        self._inflated_sizes = None
+        self.stream = None
 
         if fd:
             self.fd = fd
         else:
             self.fd = None
 
-        if self.fname.endswith('.fastq.gz'):
+        if fname == '-' or isinstance(fname, int) or hasattr(fname, 'read'):
+            self.open_stream(fname)
+        elif self.fname.endswith('.fastq.gz'):
             self.gz = True
             if not self.fd:
                 self.fd = gzip.GzipFile(self.fname, 'rb')
@@ -87,9 +133,12 @@ class Fastq:
             raise FastqFileFormatException(
                         'fastq file must have extension ".fastq" or ".fastq.gz"')
 
+        # file objects indexed by file number (see .seek())
+        self.fds = {0: self.fd}
+
         # save second name of base if exists
         self.fname2 = None
-        if paired:
+        if paired and self.stream is None:
             base = fname[:fname.rindex('.fastq')]
             if base[-2:] == '_1':
                 fname2 = base[:-2] + '_2' + fname[fname.rindex('.fastq'):]
@@ -97,7 +146,8 @@ class Fastq:
                     lo.info('including paired file "%s"' % fname2)
                     self.fname2 = fname2
 
-        if sum(self.filesizes()) == 0:
+        if self.stream is not None and not self.head or \
+                self.stream is None and sum(self.filesizes()) == 0:
             raise FastqFileFormatException('cannot scan empty file')
 
         # scan some records
@@ -144,28 +194,137 @@ class Fastq:
         self.fd.seek(0)
         lines = [self.fd.readline() for i in range(4)]
         self.readlength = len(lines[1].strip('\r\n'))
-        if self.gz:
-            self.records_approx = None
-        else:
-            self.records_approx = os.path.getsize(self.fname) / len(''.join(lines))
-            if self.fname2 is not None:
-                self.records_approx *= 2
+        self.records_approx = None
+        if self.stream is None:
+            self.records_approx = sum(self.inflated_sizes()) / len(''.join(lines))
 
         # output some infos
         if not quiet:
-            if self.gz:
-                lo.info('gzipped fastq : readlength=? records_approx=? dQ=%d variants=%s' % (
-                        self.dQ, str(self.variants)))
-            else:
-                lo.info('fastq : readlength=%d records_approx=%d dQ=%d variants=%s' % (
-                        self.readlength, self.records_approx, self.dQ, str(self.variants)))
+            lo.info('%s%s : readlength=%d records_approx=%s dQ=%d variants=%s' % (
+                    self.gz and 'gzipped fastq' or 'fastq',
+                    self.stream is not None and ' stream' or '', self.readlength,
+                    self.records_approx or '?', self.dQ, str(self.variants)))
+
+    def open_stream(self, source):
+        '''
+        reads the first :py:attr:`STREAM_HEAD` bytes of a stream that cannot
+        be rewound; the format is then checked on these bytes (inflated if
+        the stream is gzip compressed) and the whole stream is later passed
+        to the engine by :py:meth:`scan_input`
+
+        :param source: ``"-"`` for standard input, a file descriptor or an
+            object with a ``.read()`` method
+        '''
+        if source == '-':
+            source = sys.stdin
+        elif isinstance(source, int):
+            source = os.fdopen(source, 'rb')
+        self.stream = source
+        self.fname = getattr(source, 'name', '<stream>')
+
+        # regular files (e.g. redirected standard input) are passed to the
+        # engine directly (see .scan_input())
+        self.stream_pos = None
+        if isinstance(source, file):
+            try:
+                self.stream_pos = (source.fileno(), source.tell())
+            except IOError:
+                pass
+
+        self.head = ''
+        while len(self.head) < self.STREAM_HEAD:
+            data = source.read(self.STREAM_HEAD - len(self.head))
+            if not data:
+                break
+            self.head += data
+
+        self.gz = self.head[:2] == '\x1f\x8b'
+        text = self.head
+        if self.gz:
+            # inflate all (possibly incomplete) members within head
+            parts = []
+            data = self.head
+            try:
+                while data:
+                    dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    parts.append(dobj.decompress(data))
+                    data = dobj.unused_data
+            except zlib.error, e:
+                raise FastqFileFormatException(
+                        'cannot inflate gzipped stream : ' + str(e))
+            text = ''.join(parts)
+
+        # only complete records are checked if head is not the whole stream
+        if len(self.head) == self.STREAM_HEAD:
+            lines = text.split('\n')
+            text = '\n'.join(lines[:(len(lines) - 1) / 4 * 4] + [''])
+        self.fd = StringIO(text)
+
+    def scan_input(self):
+        '''
+        :returns: what is passed to :py:func:`kvarq.engine.findseqs` :
+            :py:meth:`.filenames` or, for streams, a file descriptor from
+            which the engine reads the whole stream (the head that was read
+            by :py:meth:`.open_stream` is fed back together with the rest
+            of the stream by a separate thread) -- streams can only be
+            scanned once
+        '''
+        if self.stream is None:
+            return self.filenames()
+
+        if self.head is None:
+            raise IOError('stream "%s" was already scanned' % self.fname)
+        head = self.head
+        self.head = None
+
+        if self.stream_pos is not None:
+            fd = os.dup(self.stream_pos[0])
+            os.lseek(fd, self.stream_pos[1], os.SEEK_SET)
+            return fd
+
+        r, w = os.pipe()
+        feeder = threading.Thread(target=self.feed_stream,
+                args=(head, os.fdopen(w, 'wb')), name='fastq-feeder')
+        feeder.daemon = True
+        feeder.start()
+        return r
+
+    def feed_stream(self, head, out):
+        ''' copies ``head`` and the rest of the stream into file ``out``
+            (until the engine stops reading from the other end) '''
+        try:
+            try:
+                data = head
+                while data:
+                    out.write(data)
+                    data = self.stream.read(self.STREAM_CHUNK)
+            finally:
+                out.close()
+        except IOError, e:
+            if e.errno != errno.EPIPE:
+                lo.error('cannot read stream "%s" : %s' % (self.fname, e))
 
 
     def filesizes(self):
         ''' returns list of filesize(s) -- see ``paired`` parameter in
-            :py:meth:`.__init__` '''
+            :py:meth:`.__init__` (``[None]`` for streams) '''
+        if self.stream is not None:
+            return [None]
         return [os.path.getsize(fname) for fname in self.filenames()]
 
+    def inflated_sizes(self):
+        ''' returns list of size(s) of the uncompressed data -- same as
+            :py:meth:`.filesizes` for ``.fastq`` files and estimated for
+            ``.fastq.gz`` files (see :py:func:`inflated_size`) '''
+        if self.stream is not None:
+            return [None]
+        if self._inflated_sizes is None:
+            self._inflated_sizes = [
+                    inflated_size(fname) if fname.endswith('.gz')
+                    else os.path.getsize(fname)
+                    for fname in self.filenames()]
+        return self._inflated_sizes
+
     def filenames(self):
         ''' returns list of filename(s) -- see ``paired`` parameter in
             :py:meth:`.__init__` '''
@@ -179,7 +338,7 @@ class Fastq:
 
         :param n: number of records to scan
         :param points: number of points within file to scan for records;
-            this value is ignored for gzipped fastq files
+            this value is ignored for gzipped fastq files and streams
         :returns: minimum and maximum value of PHRED score (index within
             ``ASCII``)
         '''
@@ -187,12 +346,13 @@ class Fastq:
         ret_max = -999
         self.fd.seek(0)
 
-        if self.gz:
-            lo.debug('gzipped fastq : scan %d points at start only' % n)
+        if self.gz or self.stream is not None:
+            lo.debug('gzipped fastq/stream : scan %d points at start only' % n)
+            points = 1
 
         for point in range(points):
 
-            if not self.gz and point > 0:
+            if point > 0:
                 # (oversamples small files)
                 self.fd.seek(os.path.getsize(self.fname)*point/points)
                 self.seekback()
@@ -267,18 +427,19 @@ class Fastq:
         :param Amin: minimum PHRED value
         :param n: number of records to sample
         :param points: number of points within file to scan for records;
-            this value is ignored for gzipped fastq files
+            this value is ignored for gzipped fastq files and streams
         :returns: list of quality trimmed record lengths ``n`` items
         '''
         self.fd.seek(0)
 
-        if self.gz:
-            lo.debug('gzipped fastq : scan %d points at start only' % n)
+        if self.gz or self.stream is not None:
+            lo.debug('gzipped fastq/stream : scan %d points at start only' % n)
+            points = 1
 
         lengths = []
         for point in range(points):
 
-            if not self.gz and point > 0:
+            if point > 0:
                 self.fd.seek(os.path.getsize(self.fname)*point/points)
                 self.seekback()
 
@@ -307,14 +468,32 @@ class Fastq:
                 pos = -1
         return pos_, length
 
+    def seek(self, file_pos):
+        ''' sets :py:attr:`fd` to the file that contains ``file_pos`` and
+            moves its file pointer there -- when paired files are scanned,
+            :py:mod:`kvarq.engine` stores the number of the file in the bits
+            above ``kvarq.engine.FILE_POS_BITS`` of ``file_pos`` '''
+        from kvarq.engine import FILE_POS_BITS
+        if self.stream is not None:
+            raise IOError('cannot seek in stream "%s"' % self.fname)
+        i = file_pos >> FILE_POS_BITS
+        if i not in self.fds:
+            fname = self.filenames()[i]
+            if self.gz:
+                self.fds[i] = gzip.GzipFile(fname, 'rb')
+            else:
+                self.fds[i] = open(fname, 'rb')
+        self.fd = self.fds[i]
+        self.fd.seek(file_pos & ((1 << FILE_POS_BITS) - 1))
+
     def readhit(self, hit):
         ''' :param hit: a :py:class:`kvarq.engine.Hit`
             :returns: a string base sequence '''
         if hit.seq_pos < 0:
-            self.fd.seek(hit.file_pos-hit.seq_pos)
+            self.seek(hit.file_pos-hit.seq_pos)
             return self.fd.read(hit.length)
         else:
-            self.fd.seek(hit.file_pos)
+            self.seek(hit.file_pos)
             return self.fd.read(hit.length)
 
     def lineup(self):
@@ -373,12 +552,15 @@ class Fastq:
         return ident, seq, plus, scores
 
     def readrecordat(self, hit):
-        ''' :param hit: a :py:class:`kvarq.engine.Hit`
+        ''' :param hit: a :py:class:`kvarq.engine.Hit` (or its ``file_pos``)
             :returns: the four .fastq files representing the record '''
-        self.fd.seek(hit.file_pos)
+        self.seek(getattr(hit, 'file_pos', hit))
+        pos = self.fd.tell()
         self.seekback()
         ident, seq, plus, scores = self.readrecord() # previous record
-        ident, seq, plus, scores = self.readrecord() # our record
+        if self.fd.tell() <= pos:
+            # (unless our record is the first record of the file)
+            ident, seq, plus, scores = self.readrecord() # our record
         return '\n'.join([ident, seq, plus, scores]) + '\n'
 
     @tictoc('fastq.readhits')
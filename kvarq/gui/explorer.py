@@ -4,6 +4,7 @@ from kvarq.log import lo, set_debug
 from kvarq.analyse import Analyser, DecodingException
 from kvarq.analyse import VersionConflictException, TestsuiteVersionConflictException
 from kvarq.util import get_root_path, JsonSummary
+from kvarq import resultfile
 from kvarq.gui.util import open_help, ThemedTk, BackgroundJob, askopenfilename
 from kvarq.gui.tkplot import CoverageWindow, ReadlengthWindow, HitHistogramWindow, \
         MeanCoverageWindow, SpoligoWindow
@@ -28,13 +29,15 @@ class DirectoryExplorer:
 
         if dname:
             self.dname = os.path.abspath(dname)
-            self.jpaths = glob.glob(os.path.join(self.dname, '*.json'))
+            self.jpaths = sorted(glob.glob(os.path.join(self.dname, '*.json'))
+                    + glob.glob(os.path.join(self.dname, '*' + resultfile.EXTENSION)))
         else:
             jpaths = askopenfilename(
                     initialdir=os.getcwd(),
                     title='Choose .json files to explore',
                     multiple=True,
-                    filetypes=[('json files', '*.json')])
+                    filetypes=[('json files', '*.json'),
+                        ('kvarq files', '*' + resultfile.EXTENSION)])
 
             if not jpaths:
                 return
@@ -201,7 +204,7 @@ class JsonExplorer:
         else:
             try:
 
-                data = json.load(file(jpath_or_analyser))
+                data = resultfile.load(jpath_or_analyser)
                 update_testsuites(testsuites, data['info']['testsuites'], testsuite_paths)
 
                 self.analyser = Analyser()
@@ -336,7 +339,8 @@ class JsonExplorer:
         if self.aname == 'info':
             self.infos = [
                     'fastq : ' + ', '.join(self.analyser.fastq_filenames),
-                    'size : ' + ', '.join(['%.2f MB'%(fastq_size/1024.**2)
+                    'size : ' + ', '.join([fastq_size is None and '?' or
+                            '%.2f MB'%(fastq_size/1024.**2)
                             for fastq_size in self.analyser.fastq_sizes]),
                     'readlength : %d'%self.analyser.fastq_readlength,
                     'records_approx : %s'%str(self.analyser.fastq_records_approx or '?'),
@@ -349,6 +353,8 @@ class JsonExplorer:
                     'mean coverage...',
                     'hits/template...',
                     'records_parsed : %d'%self.analyser.stats.get('records_parsed', -1),
+                    'records_sampled : %d'%self.analyser.stats.get('records_sampled',
+                            self.analyser.stats.get('records_parsed', -1)),
                     'progress : %.1f %%'%(float(self.analyser.stats['progress'])*100),
                 ]
 
@@ -1,10 +1,10 @@
 
 from kvarq.log import lo, tic, toc
-from kvarq import VERSION, genes, engine, analyse
+from kvarq import VERSION, genes, engine, analyse, resultfile
 from kvarq.fastq import Fastq, FastqFileFormatException
 from kvarq.gui.explorer import JsonExplorer
 from kvarq.engine import Hit
-from kvarq.util import ProgressBar
+from kvarq.util import ProgressBar, TextHist
 from kvarq.gui.util import open_help, ThemedTk, askopenfilename
 from kvarq.testsuites import load_testsuites
 from kvarq.config import config_params
@@ -21,16 +21,16 @@ import sys
 import logging
 import threading
 import time
-import json
 
 
 class AnalyseThread(threading.Thread):
 
-    def __init__(self, analyser, fastq, testsuites):
+    def __init__(self, analyser, fastq, testsuites, hits=False):
         super(AnalyseThread, self).__init__(name='analyse-thread')
         self.analyser = analyser
         self.fastq = fastq
         self.testsuites = testsuites
+        self.hits = hits
         self.finished = False
         self.exception = None
         self.stopped = False
@@ -38,7 +38,7 @@ class AnalyseThread(threading.Thread):
     def run(self):
         try:
 #            lo.debug('AnalyseThread : start')
-            self.analyser.scan(self.fastq, self.testsuites)
+            self.analyser.scan(self.fastq, self.testsuites, hits=self.hits)
 #            lo.debug('AnalyseThread : stop')
             self.finished = True
         except Exception, e:
@@ -142,6 +142,13 @@ class SimpleGUI(ThemedTk):
         self.pblabel.pack(side=tk.LEFT)
         frame.pack(side=tk.TOP, expand=False, fill=tk.X)
 
+        # mean coverage of templates, updated while scanning
+        frame = tk.Frame(self)
+        self.covlabel = tk.Label(frame, font=self.monospace, justify=tk.LEFT)
+        self.covlabel.pack(side=tk.LEFT)
+        self.covt = 0
+        frame.pack(side=tk.TOP, expand=False, fill=tk.X)
+
         frame = tk.Frame(self)
         self.show = tk.Button(frame, text='show', command=self.show_cb, state=tk.DISABLED)
         self.show.pack(side=tk.LEFT)
@@ -258,7 +265,7 @@ class SimpleGUI(ThemedTk):
             engine.config(**config_params(self.settings.config, self.fastq))
 
             self.at = AnalyseThread(self.analyser, self.fastq,
-                    self.selected_testsuites)
+                    self.selected_testsuites, hits=self.save_hits)
             self.t0 = time.time()
             self.at.start()
             self.pb.start()
@@ -306,14 +313,8 @@ class SimpleGUI(ThemedTk):
         self.pb_longest = max(self.pb_longest, len(pb_str)) # prevent too much window resizing
         self.pblabel.config(text=('{:<%d}' % self.pb_longest).format(pb_str))
 
-#        if self.settings.config['stop median coverage'] and not self.at.stopped:
-#            means = sorted([n/len(self.analyser[i])
-#                    for i, n in enumerate(stats['nseqbasehits'])])
-#
-#            if means and means[len(means)/2] > self.settings.config['stop median coverage']:
-#                lo.info('aborting scanning: median of coverage %d > %d'%(
-#                        means[len(means)/2], self.settings.config['stop median coverage']))
-#                self.at.stop()
+        if self.analyser.coverages and time.time() - self.covt > 1:
+            self.update_coverages()
 
         if self.at.finished or self.at.exception:
             self.at.join()
@@ -321,6 +322,7 @@ class SimpleGUI(ThemedTk):
             if self.at.finished:
                 lo.info('finished scanning after %.3f seconds'% (time.time()-self.t0))
                 self.pblabel.config(text=str(self.pb)[:str(self.pb).index(']')+1]+' -- done')
+                self.update_coverages()
                 self.finish_scanning()
             if self.at.exception:
                 lo.error('could not scan %s : %s' %
@@ -336,6 +338,16 @@ class SimpleGUI(ThemedTk):
 
         self.after(100, self.update)
 
+    def update_coverages(self):
+        ''' shows histogram of mean coverages of all templates (coverages
+            are updated by the analyser while scanning) '''
+        with self.analyser.lock:
+            means = sorted([coverage.mean()
+                    for coverage in self.analyser.coverages.values()])
+        self.covlabel.config(text=TextHist(bins=5, width=40,
+                title='mean coverages').draw(means, indexed=False))
+        self.covt = time.time()
+
     def show_cb(self):
         if self.analyser.results is None:
             tkMessageBox.showinfo('no results yet', 'please stop/finish the scanning first')
@@ -346,18 +358,20 @@ class SimpleGUI(ThemedTk):
     def save_cb(self):
 
         if len(self.analysers) == 1:
-            jf = tkFileDialog.asksaveasfile(
+            jfn = tkFileDialog.asksaveasfilename(
                     parent=self,
                     initialfile=os.path.splitext(os.path.basename(
                             self.fastq.fname))[0] + '.json',
                     initialdir=os.path.dirname(self.fastq.fname),
                     defaultextension='.json', 
+                    filetypes=[('json files', '*.json'),
+                        ('kvarq files', '*' + resultfile.EXTENSION)],
                     title='select .json to store results of scan')
-            if not jf:
+            if not jfn:
                 return
             tic('dumping json')
-            data = self.analyser.encode(hits=self.save_hits)
-            json.dump(data, jf, indent=2)
+            data = self.analyser.encode(hits=self.save_hits, arrays=True)
+            resultfile.dump(data, jfn)
             toc('dumping json')
 
         else:
@@ -375,8 +389,8 @@ class SimpleGUI(ThemedTk):
                     base += '_'
                 lo.info('saving to ' + jsonfn)
                 tic('dumping json')
-                data = analyser.encode(hits=self.save_hits)
-                json.dump(data, file(jsonfn, 'w'), indent=2)
+                data = analyser.encode(hits=self.save_hits, arrays=True)
+                resultfile.dump(data, jsonfn)
                 toc('dumping json')
 
     def destroy_cb(self, x=None):
@@ -150,6 +150,7 @@ class CoverageDisplay(IndexableDisplay):
         w, h = self.width(), self.height()
 
         x = self.data
+        mutations = self.coverage.mutations
         self.hitheight = min(3., float(h) / max(x))
         for i in range(len(x)):
             rx = w * i / len(x)
@@ -158,7 +159,7 @@ class CoverageDisplay(IndexableDisplay):
             self.create_rectangle(rx, 0, rw, rh,
                     fill=self.colors['coverage'], outline='')
 
-            for j, b in enumerate(sorted(self.coverage.mutations.get(i, ''))):
+            for j, b in enumerate(sorted(mutations.get(i, ''))):
                 my = int(j * self.hitheight)
                 mh = int((j + 1) * self.hitheight) - int(j * self.hitheight)
                 self.create_rectangle(rx, my, rw, mh,
@@ -1,6 +1,7 @@
 
 from distutils.version import StrictVersion
 from collections import OrderedDict
+from itertools import imap
 
 from kvarq import VERSION
 from kvarq import genes
@@ -90,4 +91,48 @@ def convert_legacy_data(testsuites, data):
             VersionConflictException('could not elevate version more than to "%d.%d"' %
                     (version[0], version[1]))
 
+    # file_pos of hits in the second file of paired sets
+    if 'file_pos_bits' not in data['info']:
+        convert_paired_file_pos(data)
+
     return data
+
+
+def convert_paired_file_pos(data):
+    '''
+    converts the ``file_pos`` of the hits in the second file of a paired set
+    from files that were written before the files of paired sets were read
+    concurrently (see :py:class:`kvarq.engine.Hit`) : the ``file_pos``
+    continued after the size of the first file, now it is counted from the
+    beginning of the second file plus ``1 << kvarq.engine.FILE_POS_BITS``
+
+    the hits are discarded if the first file is a ``.gz`` file (its inflated
+    size is not saved in the data)
+    '''
+    from kvarq.engine import FILE_POS_BITS
+    from kvarq.resultfile import column
+
+    info = data['info']
+    info['file_pos_bits'] = FILE_POS_BITS
+    if 'hits' not in data or len(info['fastq']) < 2:
+        return
+
+    if info['fastq'][0].endswith('.gz') or info['size'][0] is None:
+        lo.warning('cannot convert file positions of hits in paired files '
+                'of old version; discarding hits')
+        del data['hits']
+        data.pop('hitseqs', None)
+        return
+
+    size = info['size'][0]
+    def file_pos(pos):
+        if pos < size or pos >> FILE_POS_BITS:
+            return pos
+        return (1 << FILE_POS_BITS) + pos - size
+
+    hits = data['hits']
+    if isinstance(hits, dict):
+        hits['file_pos'] = column('i8', imap(file_pos, hits['file_pos']))
+    else:
+        data['hits'] = [[hit[0], file_pos(hit[1])] + list(hit[2:])
+                for hit in hits]
@@ -0,0 +1,329 @@
+'''
+Reading and writing of scanning results
+
+The results of :py:meth:`kvarq.analyse.Analyser.encode` are either saved as
+``.json`` or in the binary ``.kvarq`` format that contains a small ``.json``
+header (with the ``analyses``, ``info`` and ``stats``) followed by packed
+little-endian arrays with the coverages and (optionally) the hits, which are
+read from a memory mapped file without any parsing::
+
+    MAGIC                     8 bytes
+    length of header          uint32
+    header                    .json, padded with spaces to a multiple of 8
+    arrays                    every array starts at a multiple of 8
+
+The header entry ``arrays`` contains ``[type, offset, count]`` of every array
+(the offset is relative to the end of the header) and the entry
+``coverages`` contains ``[name, length, number of mutated positions]`` of
+every coverage.  A coverage is stored as its depth at every position, the
+mutated positions and the five counts (``A``, ``C``, ``G``, ``T``, ``N``) of
+the alternate bases at every mutated position.
+
+Both formats can be converted into each other without loss of information.
+'''
+
+import sys
+import json
+import codecs
+import mmap
+import struct
+from array import array
+from itertools import izip, islice
+from collections import OrderedDict
+
+from kvarq.util import json_dump
+
+
+EXTENSION = '.kvarq'
+MAGIC = '\x89KVARQ\r\n'
+
+# same order as kvarq.analyse.BASES
+BASES = 'ACGTN'
+
+# struct format characters of the types used for the arrays
+TYPES = dict(u1='B', i4='i', u4='I', i8='q')
+
+# same fields as kvarq.analyse.Hits
+HIT_COLUMNS = [('seq_nr', 'i4'), ('file_pos', 'i8'), ('seq_pos', 'i4'),
+        ('length', 'i4'), ('readlength', 'i4')]
+
+
+def is_binary(fname):
+    ''' :returns: whether file ``fname`` is in the binary format '''
+    with open(fname, 'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+def typecode(t):
+    ''' :returns: :py:mod:`array` typecode of the same size and signedness as
+        the type ``t`` (or the largest typecode available) '''
+    typecodes = 'bhil' if t[0] == 'i' else 'BHIL'
+    for tc in typecodes:
+        if array(tc).itemsize == int(t[1:]):
+            return tc
+    return typecodes[-1]
+
+def column(t, values=()):
+    ''' :returns: :py:class:`array.array` of type ``t`` containing
+        ``values`` or a list if there is no typecode of that size (as for
+        64 bit integers if ``long`` has only 32 bits, e.g. on 64 bit
+        windows) '''
+    tc = typecode(t)
+    if array(tc).itemsize != int(t[1:]):
+        return list(values)
+    return array(tc, values)
+
+def pack(values, t):
+    ''' :returns: string of ``values`` packed as little-endian type ``t`` '''
+    tc = typecode(t)
+    if array(tc).itemsize != int(t[1:]):
+        return struct.pack('<%d%s' % (len(values), TYPES[t]), *values)
+    if not isinstance(values, array) or values.typecode != tc:
+        values = array(tc, values)
+    if sys.byteorder == 'big':
+        values = array(tc, values)
+        values.byteswap()
+    return values.tostring()
+
+def unpack(data, t):
+    ''' :returns: :py:class:`array.array` of little-endian type ``t`` packed
+        in string ``data`` (see :py:func:`column`) '''
+    tc = typecode(t)
+    size = int(t[1:])
+    if array(tc).itemsize != size:
+        return column(t, struct.unpack('<%d%s' % (len(data) / size, TYPES[t]),
+                data))
+    values = array(tc)
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def serialize_coverage(coverage, mutations):
+    ''' :returns: string of depths ``coverage`` and dictionary of alternate
+        bases ``mutations`` (see :py:meth:`kvarq.analyse.Coverage.serialize`) '''
+    cov = '-'.join([str(c) for c in coverage])
+    mut = '-'.join(['%d[%s]'%(idx, ''.join(sorted(mutations[idx])))
+            for idx in sorted(mutations.keys())])
+    return cov + ' ' + mut
+
+def parse_coverage(serialized_coverage):
+    ''' :returns: ``(coverage, mutations)`` from string returned by
+        :py:func:`serialize_coverage` '''
+    c_s, space, m_s = serialized_coverage.partition(' ')
+    coverage = [int(x) for x in c_s.split('-')]
+    if m_s:
+        mutations = dict([(int(x[:x.index('[')]), x[x.index('[')+1:x.index(']')])
+                for x in m_s.split('-')])
+    else:
+        mutations = {}
+    return coverage, mutations
+
+class LazyList(list):
+
+    '''
+    List whose items are only created one by one while it is iterated
+    (e.g. by :py:func:`kvarq.util.json_dump`), so that hits can be written
+    to ``.json`` files directly from their columns.
+    '''
+
+    def __init__(self, length, items):
+        '''
+        :param length: number of items
+        :param items: function that returns an iterator over the items
+        '''
+        self.length = length
+        self.items = items
+
+    def __len__(self):
+        return self.length
+
+    def __nonzero__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        return self.items()
+
+
+def to_json(data):
+    '''
+    :param data: dictionary as returned by
+        :py:meth:`kvarq.analyse.Analyser.encode` (or :py:func:`load`)
+    :returns: same dictionary with the coverages serialized and the hits
+        as lists (as saved in ``.json`` files); hits that are stored in
+        columns are returned as :py:class:`LazyList`
+    '''
+    data = dict(data)
+    data['coverages'] = [(name, coverage if isinstance(coverage, basestring)
+                else serialize_coverage(*coverage))
+            for name, coverage in data['coverages']]
+    if isinstance(data.get('hits'), dict):
+        columns = [data['hits'][field] for field, t in HIT_COLUMNS]
+        data['hits'] = LazyList(len(columns[0]), lambda: izip(*columns))
+    if isinstance(data.get('hitseqs'), tuple):
+        seqs, offsets = data['hitseqs']
+        data['hitseqs'] = LazyList(len(offsets) - 1, lambda: (seqs[start:stop]
+                for start, stop in izip(offsets, islice(offsets, 1, None))))
+    return data
+
+
+def dump_binary(data, fd):
+    '''
+    :param data: dictionary as returned by
+        :py:meth:`kvarq.analyse.Analyser.encode` (or :py:func:`load`)
+    :param fd: file opened for writing in binary mode
+
+    writes ``data`` in the binary format
+    '''
+    header = dict([(key, data[key]) for key in ('analyses', 'info', 'stats')])
+    header['coverages'] = []
+    chunks = OrderedDict([(name, ([], t)) for name, t in (
+            ('depths', 'u4'), ('mutation_positions', 'u4'),
+            ('mutation_counts', 'u4'))])
+
+    for name, coverage in data['coverages']:
+        if isinstance(coverage, basestring):
+            coverage = parse_coverage(coverage)
+        depths, mutations = coverage
+        positions = sorted(mutations.keys())
+        counts = []
+        for pos in positions:
+            bases = mutations[pos]
+            counts += [bases.count(base) for base in BASES]
+            if sum(counts[-len(BASES):]) != len(bases):
+                raise ValueError('cannot save mutations "%s" of coverage "%s"'
+                        % (bases, name))
+        header['coverages'].append([name, len(depths), len(positions)])
+        chunks['depths'][0].append(pack(depths, 'u4'))
+        chunks['mutation_positions'][0].append(pack(positions, 'u4'))
+        chunks['mutation_counts'][0].append(pack(counts, 'u4'))
+
+    hits = data.get('hits')
+    if hits is not None:
+        if not isinstance(hits, dict):
+            columns = zip(*hits) or [()] * len(HIT_COLUMNS)
+            hits = dict(zip([field for field, t in HIT_COLUMNS], columns))
+        for field, t in HIT_COLUMNS:
+            chunks['hits.' + field] = ([pack(hits[field], t)], t)
+
+    hitseqs = data.get('hitseqs')
+    if hitseqs is not None:
+        if not isinstance(hitseqs, tuple):
+            offsets = [0]
+            for seq in hitseqs:
+                offsets.append(offsets[-1] + len(seq))
+            hitseqs = (''.join(hitseqs), offsets)
+        seqs, offsets = hitseqs
+        chunks['hitseqs.offsets'] = ([pack(offsets, 'i8')], 'i8')
+        chunks['hitseqs.data'] = ([str(seqs)], 'u1')
+
+    header['arrays'] = OrderedDict()
+    offset = 0
+    for name, (parts, t) in chunks.items():
+        size = sum(map(len, parts))
+        header['arrays'][name] = [t, offset, size / int(t[1:])]
+        offset += size + (-size) % 8
+
+    encoded = json.dumps(header)
+    encoded += ' ' * ((-len(MAGIC) - 4 - len(encoded)) % 8)
+    fd.write(MAGIC + struct.pack('<I', len(encoded)) + encoded)
+    for parts, t in chunks.values():
+        size = 0
+        for part in parts:
+            fd.write(part)
+            size += len(part)
+        fd.write('\0' * ((-size) % 8))
+
+
+def read_header(fd):
+    ''' :returns: header read from file ``fd`` in the binary format '''
+    if fd.read(len(MAGIC)) != MAGIC:
+        raise ValueError('"%s" is not in the binary format' % fd.name)
+    length, = struct.unpack('<I', fd.read(4))
+    return json.loads(fd.read(length))
+
+def load_binary(fname):
+    '''
+    :returns: dictionary in the same format as returned by
+        :py:meth:`kvarq.analyse.Analyser.encode` with ``arrays=True``
+        from a file in the binary format
+    '''
+    with open(fname, 'rb') as fd:
+        header = read_header(fd)
+        base = fd.tell()
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(name):
+        t, offset, count = header['arrays'][name]
+        start = base + offset
+        data = mm[start:start + count * int(t[1:])]
+        if t == 'u1':
+            return data
+        return unpack(data, t)
+
+    data = dict([(key, header[key]) for key in ('analyses', 'info', 'stats')])
+
+    depths = get('depths')
+    positions = get('mutation_positions')
+    counts = get('mutation_counts')
+    data['coverages'] = []
+    i = j = 0
+    for name, length, nmutations in header['coverages']:
+        mutations = {}
+        for pos in positions[j:j + nmutations]:
+            mutations[pos] = ''.join([b * n for b, n in
+                    zip(BASES, counts[len(BASES) * j:len(BASES) * (j + 1)])])
+            j += 1
+        data['coverages'].append((name, (depths[i:i + length], mutations)))
+        i += length
+
+    if 'hits.seq_nr' in header['arrays']:
+        data['hits'] = dict([(field, get('hits.' + field))
+                for field, t in HIT_COLUMNS])
+    if 'hitseqs.data' in header['arrays']:
+        data['hitseqs'] = (get('hitseqs.data'), get('hitseqs.offsets'))
+
+    mm.close()
+    return data
+
+
+def load(fname):
+    '''
+    :returns: dictionary as returned by
+        :py:meth:`kvarq.analyse.Analyser.encode` from a ``.json`` file or a
+        file in the binary format
+    :raises ValueError: if the file cannot be read
+    '''
+    if is_binary(fname):
+        return load_binary(fname)
+    return json.load(codecs.open(fname, encoding='utf-8'))
+
+def load_summary(fname):
+    '''
+    :returns: dictionary with the ``analyses``, ``info`` and ``stats`` of
+        the results in ``fname`` (only the header is read from files in the
+        binary format)
+    :raises ValueError: if the file cannot be read
+    '''
+    if is_binary(fname):
+        with open(fname, 'rb') as fd:
+            header = read_header(fd)
+        return dict([(key, header[key]) for key in ('analyses', 'info', 'stats')])
+    return load(fname)
+
+def dump(data, fname, binary=None):
+    '''
+    :param data: dictionary as returned by
+        :py:meth:`kvarq.analyse.Analyser.encode` (or :py:func:`load`)
+    :param fname: name of file to write
+    :param binary: whether to use the binary format; by default, the binary
+        format is used for file names ending in ``.kvarq``
+    '''
+    if binary is None:
+        binary = fname.endswith(EXTENSION)
+    if binary:
+        with open(fname, 'wb') as fd:
+            dump_binary(data, fd)
+    else:
+        with codecs.open(fname, 'w', 'utf-8') as fd:
+            json_dump(to_json(data), fd)
@@ -358,7 +358,8 @@ class csv_xls_writer:
 
 class JsonSummary:
     '''
-    reads in several .json files and dumps output table in .csv format
+    reads in several .json (or binary .kvarq) files and dumps output table in
+    .csv format
     '''
 
     def __init__(self):
@@ -368,9 +369,10 @@ class JsonSummary:
 
     def add(self, fname):
         '''
-        :param fname: name of .json file to parse
+        :param fname: name of .json (or .kvarq) file to parse
         '''
-        d = json.load(file(fname))
+        from kvarq.resultfile import load_summary
+        d = load_summary(fname)
         self.data[fname] = {}
         for k, v in d['analyses'].items():
             self.data[fname][k] = v
@@ -380,7 +382,7 @@ class JsonSummary:
             if isinstance(v, (list, tuple)):
                 self.colspan[k] = max(self.colspan[k], len(v))
         self.data[fname]['filename'] = fname
-        self.data[fname]['filesize'] = sum(d['info']['size'])
+        self.data[fname]['filesize'] = sum([size or 0 for size in d['info']['size']])
         self.data[fname]['scantime'] = int(d['info']['scantime'])
 
     def dump(self, fd=sys.stdout):
@@ -10,6 +10,10 @@ from kvarq.engine import Hit
 
 import unittest
 import os.path
+import tempfile
+import shutil
+import marshal
+import operator
 
 
 MTBCpath = os.path.join(os.path.dirname(__file__), os.path.pardir, 'testsuites', 'MTBC')
@@ -39,6 +43,7 @@ class AnalyserTest(unittest.TestCase):
         analyser.update_coverages()
         analyser.update_testsuites()
         results1 = analyser.results
+        hits1, hitseqs1 = list(analyser.hits), list(analyser.hitseqs)
         data = analyser.encode(hits=True)
 
         analyser = analyse.Analyser()
@@ -48,6 +53,49 @@ class AnalyserTest(unittest.TestCase):
         results2 = analyser.results
 
         assert results1 == results2
+        assert len(hits1) > 0
+        assert list(analyser.hits) == hits1
+        assert list(analyser.hitseqs) == hitseqs1
+        assert analyser.hitseqs[-1] == hitseqs1[-1]
+
+
+    def test_lazy_decoding(self):
+
+        ''' coverages are only created when accessed after decoding '''
+
+        analyser = analyse.Analyser()
+        analyser.scan(Fastq(self.fname), {'spoligo' : spoligo}, hits=True)
+        analyser.update_testsuites()
+        coverages1 = analyser.coverages
+        data = analyser.encode(hits=True, arrays=True)
+
+        analyser = analyse.Analyser()
+        analyser.decode({'spoligo' : spoligo}, data)
+        assert len(analyser.coverages.factories) == len(coverages1)
+        name = coverages1.keys()[1]
+        assert analyser.coverages[name].serialize() == coverages1[name].serialize()
+        assert len(analyser.coverages.factories) == len(coverages1) - 1
+
+        analyser.update_testsuites()
+        assert not analyser.coverages.factories
+        assert [coverage.serialize() for coverage in analyser.coverages.values()] \
+                == [coverage.serialize() for coverage in coverages1.values()]
+        assert len(analyser.hits) == len(analyser.hitseqs) > 0
+
+        # malformed coverages are detected when decoding
+        data = analyser.encode()
+        name = data['coverages'][0][0]
+        for serialized in ('1-2-x ', '1-2-3 7[A]', ''):
+            broken = dict(data, coverages=[(name, serialized)] + data['coverages'][1:])
+            self.assertRaises(analyse.DataInconcistencyException,
+                    analyse.Analyser().decode, {'spoligo' : spoligo}, broken)
+
+        # the length is checked when the sequence of the template is read
+        broken = dict(data, coverages=[(name, '1-2-3 ')] + data['coverages'][1:])
+        analyser = analyse.Analyser()
+        analyser.decode({'spoligo' : spoligo}, broken)
+        self.assertRaises(analyse.DataInconcistencyException,
+                analyser.coverages.__getitem__, name)
 
 
     def test_genes(self):
@@ -106,5 +154,147 @@ class AnalyserTest(unittest.TestCase):
         assert fs.keys()[1] == 'A'
         assert fs.values()[1] < 0.35
 
+    def test_coverage_counts(self):
+        ''' hits on both strands are counted per base on the + strand '''
+        seq = genes.Sequence('AACCGGTT')
+        cov = Coverage(seq)
+        cov.apply_bases(2, 4, 'CTGG', on_plus_strand=True)
+        # reverse complement of 'CCGGTA' on the - strand
+        cov.apply_bases(-1, 6, 'TACCGG', on_plus_strand=False)
+
+        counts = [0] * 40
+        for pos, base in ((2, 'C'), (3, 'T'), (4, 'G'), (5, 'G'),
+                (2, 'C'), (3, 'C'), (4, 'G'), (5, 'G'), (6, 'T'), (7, 'A')):
+            counts[5 * pos + 'ACGTN'.index(base)] += 1
+        assert list(cov.counts) == counts
+        assert list(cov.coverage) == [0, 0, 2, 2, 2, 2, 1, 1]
+        assert cov.mutations == {3: 'T', 7: 'A'}
+        assert cov.bases_at(3) == {'C': 1, 'T': 1}
+
+        # same counts as returned by the engine
+        cov2 = Coverage(seq)
+        cov2.apply_counts(counts)
+        assert cov2.serialize() == cov.serialize()
+
+        # depth and alternate bases can be set independently
+        cov2.coverage = [10] * 8
+        assert cov2.mutations == cov.mutations
+        assert cov2.bases_at(3) == {'C': 9, 'T': 1}
+        cov2.mutations = {}
+        assert list(cov2.coverage) == [10] * 8
+
+        # returned values are read-only : changes would be lost
+        self.assertRaises(TypeError, operator.setitem, cov.coverage, 0, 1)
+        self.assertRaises(TypeError, operator.setitem, cov.mutations, 0, 'T')
+        self.assertRaises(TypeError, cov.mutations.update, {0: 'T'})
+        self.assertRaises(TypeError, cov.mutations.pop, 3)
+        assert cov.mutations == {3: 'T', 7: 'A'}
+
+    def test_coverage_many(self):
+        ''' hits applied together count the same as hits applied one by one '''
+        seq = genes.Sequence('AACCGGTTACGT')
+        hits = [(-2, 6, 'GGACCG'), (3, 9, 'CAGTTACGA'), (0, 12, 'AACCGGTTACGT'),
+                (8, 4, 'NCGTAA')]
+        for on_plus_strand in (True, False):
+            cov1 = Coverage(seq)
+            for seq_pos, length, hitseq in hits:
+                cov1.apply_bases(seq_pos, length, hitseq, on_plus_strand)
+            cov2 = Coverage(seq)
+            cov2.apply_many(*(zip(*hits) + [on_plus_strand]))
+            assert list(cov2.counts) == list(cov1.counts)
+            assert cov2.mutations
+
+    def test_mismatches(self):
+        ''' long strings are compared slice by slice '''
+        n = 2 * analyse.MISMATCHES_SLICE + 10
+        a = 'ACGT' * (n / 4) + 'AC'
+        for idxs in ([], [0], [n - 1], [3, analyse.MISMATCHES_SLICE - 1,
+                analyse.MISMATCHES_SLICE, 2 * analyse.MISMATCHES_SLICE + 1]):
+            b = list(a)
+            for i in idxs:
+                b[i] = 'N'
+            assert analyse.mismatches(a, ''.join(b)) == idxs
+        assert analyse.mismatches('', '') == []
+
+    def test_coverage_stats(self):
+        ''' statistics are updated when the coverage changes '''
+        seq = genes.Sequence('AACCGGTT', left=2, right=2)
+        cov = Coverage(seq)
+        cov.coverage = [1, 1, 2, 2, 4, 4, 1, 1]
+        assert cov.mean() == 2
+        assert cov.mean(include_margins=False) == 3
+        assert cov.std() == 1.5 ** .5
+        assert cov.std(include_margins=False) == 1
+        # population standard deviation of the positions between the margins
+        cov.coverage = [0, 9, 1, 2, 3, 6, 9, 0]
+        assert cov.mean(include_margins=False) == 3
+        assert cov.std(include_margins=False) == 3.5 ** .5
+        self.assertAlmostEqual(cov.std(),
+                (sum([(x - 3.75) ** 2 for x in cov.coverage]) / 8) ** .5)
+        cov.coverage = [1, 1, 2, 2, 4, 4, 1, 1]
+        assert cov.minf() == 1 and not cov.mixed()
+
+        cov.apply_bases(2, 4, 'CTGG', on_plus_strand=True)
+        assert cov.mean(include_margins=False) == 4
+        assert cov.minf() == 2 / 3.
+        assert cov.mixed()
+        assert cov.seqmean() == 3.75
+
+
+    def test_template_cache(self):
+
+        ''' prepared sequences are read from cache '''
+
+        cachedir = tempfile.mkdtemp()
+        testsuites = dict(phylo=phylo, spoligo=spoligo)
+
+        def same(a, b):
+            return ((a.bases, a.left, a.right, a.pos, a.plus_strand)
+                    == (b.bases, b.left, b.right, b.pos, b.plus_strand))
+
+        try:
+            templates = analyse.TemplateSet(testsuites, spacing=20)
+            cached1 = analyse.TemplateSet(testsuites, spacing=20, cachedir=cachedir)
+            assert len(os.listdir(cachedir)) == 1
+            cached2 = analyse.TemplateSet(testsuites, spacing=20, cachedir=cachedir)
+
+            for cached in (cached1, cached2):
+                assert cached.seqs == templates.seqs
+                assert cached.mapping == templates.mapping
+                assert cached.sequences.keys() == templates.sequences.keys()
+                for name, (plus, minus) in templates.sequences.items():
+                    assert same(plus, cached.sequences[name][0])
+                    assert same(minus, cached.sequences[name][1])
+
+            # other spacing is cached separately
+            analyse.TemplateSet(testsuites, spacing=10, cachedir=cachedir)
+            assert len(os.listdir(cachedir)) == 2
+
+            # files that cannot be decoded are ignored and overwritten
+            fname = os.path.join(cachedir,
+                    'templates-%s.marshal' % cached1.cache_key())
+            for data in ([('name', 'ACGT')], [('a', 'AC', 0, 0, 0, 'GT')], None):
+                marshal.dump(data, file(fname, 'wb'))
+                cached = analyse.TemplateSet(testsuites, spacing=20, cachedir=cachedir)
+                assert cached.seqs == templates.seqs
+                names = templates.sequences.keys()
+                assert same(cached.load_cache(fname, names).values()[0][0],
+                        templates.sequences.values()[0][0])
+
+            # only the most recently used files are kept
+            os.utime(fname, (0, 0))
+            cache_size = analyse.TemplateSet.cache_size
+            analyse.TemplateSet.cache_size = 2
+            try:
+                analyse.TemplateSet(testsuites, spacing=5, cachedir=cachedir)
+            finally:
+                analyse.TemplateSet.cache_size = cache_size
+            assert len(os.listdir(cachedir)) == 2
+            assert not os.path.exists(fname)
+
+        finally:
+            shutil.rmtree(cachedir)
+
+
 if __name__ == '__main__': unittest.main()
 
@@ -1,15 +1,17 @@
 
 import unittest
-import sys, os.path, os, logging, time, tempfile
+import sys, os.path, os, logging, time, tempfile, json, shutil
 from cStringIO import StringIO
 
 from kvarq import VERSION
 import kvarq.cli
+from kvarq.batch import MANIFEST
 from kvarq.log import lo
 
 here_dir = os.path.abspath(os.path.dirname(__file__))
 MTBC_fastq1 = os.path.join(here_dir, 'fastqs', 'L3_N1014_hits_5k.fastq')
 MTBC_fastq2 = os.path.join(here_dir, 'fastqs', 'N0116_1_hits_1k.fastq')
+broken_fastq = os.path.join(here_dir, 'fastqs', 'L3_N1014_hits_500_BROKEN.fastq')
 root_dir = os.path.join(here_dir, os.pardir)
 testsuites_alt = os.path.join(here_dir, 'override_testsuites')
 
@@ -174,5 +176,102 @@ class CliTest(unittest.TestCase):
         lo.setLevel(logging.INFO)
 
 
+    def test_batch(self):
+
+        outdir = tempfile.mkdtemp()
+        ntf = tempfile.NamedTemporaryFile(delete=False)
+        lo.setLevel(logging.FATAL)
+
+        # (discover testsuites independently of how kvarq was imported)
+        testsuites = ['-t', os.path.join(root_dir, 'testsuites'),
+                '--cache-directory', '']
+
+        def manifest():
+            return [json.loads(line)['fastq']
+                    for line in file(os.path.join(outdir, MANIFEST))]
+
+        try:
+            json1 = os.path.join(outdir, 'L3_N1014_hits_5k.json')
+            json2 = os.path.join(outdir, 'N0116_1_hits_1k.json')
+
+            # broken file is reported but does not stop the batch
+            self.main(testsuites + ['batch', '-l', 'MTBC/spoligo', '-t', '2', outdir,
+                    MTBC_fastq1, MTBC_fastq2, broken_fastq],
+                    err=kvarq.cli.ERROR_FASTQ_FORMAT_ERROR)
+            assert sorted(manifest()) == sorted([MTBC_fastq1, MTBC_fastq2])
+
+            # same results as scan
+            self.main(testsuites + ['scan', '-l', 'MTBC/spoligo', '-f',
+                    MTBC_fastq2, ntf.name])
+            scanned = json.load(file(ntf.name))
+            batched = json.load(file(json2))
+            assert scanned['analyses'] == batched['analyses']
+            assert scanned['coverages'] == batched['coverages']
+
+            # same results reading from standard input
+            stdin = sys.stdin
+            sys.stdin = file(MTBC_fastq2, 'rb')
+            try:
+                self.main(testsuites + ['scan', '-l', 'MTBC/spoligo', '-f',
+                        '-', ntf.name])
+            finally:
+                sys.stdin.close()
+                sys.stdin = stdin
+            assert json.load(file(ntf.name))['coverages'] == batched['coverages']
+
+            # resume : only missing samples are scanned again
+            os.remove(json2)
+            mtime = os.path.getmtime(json1)
+            self.main(testsuites + ['batch', '-l', 'MTBC/spoligo', '-t', '2', outdir,
+                    MTBC_fastq1, MTBC_fastq2])
+            assert manifest()[-1] == MTBC_fastq2 and len(manifest()) == 3
+            assert os.path.getmtime(json1) == mtime
+            assert json.load(file(json2))['coverages'] == batched['coverages']
+
+        finally:
+            lo.setLevel(logging.INFO)
+            ntf.close()
+            os.remove(ntf.name)
+            shutil.rmtree(outdir)
+
+    def test_batch_names(self):
+
+        ''' files that cannot be saved under their own sample name are refused
+            before scanning '''
+
+        tmpdir = tempfile.mkdtemp()
+        outdir = os.path.join(tmpdir, 'results')
+        testsuites = ['-t', os.path.join(root_dir, 'testsuites'),
+                '--cache-directory', '']
+
+        try:
+            fq = os.path.join(tmpdir, 'sample.fq')
+            shutil.copy(MTBC_fastq2, fq)
+            out, err = self.main(testsuites + ['batch', '-l', 'MTBC/spoligo',
+                    outdir, MTBC_fastq1, fq],
+                    err=kvarq.cli.ERROR_COMMAND_LINE_SWITCH)
+            assert 'extension' in err and fq in err
+
+            for name in ('a', 'b'):
+                os.mkdir(os.path.join(tmpdir, name))
+                shutil.copy(MTBC_fastq2, os.path.join(tmpdir, name, 'x.fastq'))
+            out, err = self.main(testsuites + ['batch', '-l', 'MTBC/spoligo',
+                    outdir, os.path.join(tmpdir, 'a', 'x.fastq'),
+                    os.path.join(tmpdir, 'b', 'x.fastq')],
+                    err=kvarq.cli.ERROR_COMMAND_LINE_SWITCH)
+            assert 'same sample name : x ' in err
+            assert not os.path.exists(outdir)
+
+            # the same file specified twice is scanned once
+            self.main(testsuites + ['batch', '-l', 'MTBC/spoligo', outdir,
+                    os.path.join(tmpdir, 'a', 'x.fastq'),
+                    os.path.join(tmpdir, 'a', os.curdir, 'x.fastq')])
+            assert sorted(os.listdir(outdir)) == sorted(['x.json', MANIFEST])
+            assert len(file(os.path.join(outdir, MANIFEST)).readlines()) == 1
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__': unittest.main()
 
@@ -4,10 +4,14 @@ from kvarq import genes
 
 import unittest
 import os.path
+import signal
 import math
 import random
 import gzip
+import zlib
+import struct
 import tempfile
+import threading
 
 
 class FastqGenerator:
@@ -132,7 +136,7 @@ class EngineTest(unittest.TestCase):
 
     def setUp(self):
         engine.config(nthreads=1, maxerrors=2, minoverlap=25,
-                Amin='!', Azero='!')
+                Amin='!', Azero='!', maxcoverage=0, sample=1, gzindex=0)
 
     def test_findseqs(self, gz=False):
         ''' find specified sequences in handwritten .fastq file '''
@@ -200,9 +204,31 @@ class EngineTest(unittest.TestCase):
             fnames = (self.fname_1 + '.gz', self.fname_2 + '.gz')
 
         ret = engine.findseqs(fname, seqs)
-        ret_12 = engine.findseqs(fnames, seqs)
-
-        assert ret == ret_12
+        for nthreads in (1, 3):
+            engine.config(nthreads=nthreads)
+            ret_12 = engine.findseqs(fnames, seqs)
+
+            # both files are read concurrently : records of the second file
+            # start at 1 << FILE_POS_BITS
+            size_1 = len(file(self.fname_1).read())
+            def file_pos(pos):
+                if pos < size_1:
+                    return pos
+                return (1 << engine.FILE_POS_BITS) + pos - size_1
+            hits = [hit._replace(file_pos=file_pos(hit.file_pos))
+                    for hit in ret['hits']]
+            assert hits == list(ret_12['hits'])
+            assert ret['hitseqs'] == ret_12['hitseqs']
+            for key in ('records_parsed', 'readlengths', 'nseqhits',
+                    'nseqbasehits', 'parsed', 'total'):
+                assert ret['stats'][key] == ret_12['stats'][key]
+
+        # hits are read from the file they were found in
+        fastq = Fastq(fname, variant='Sanger', quiet=True)
+        fastq_12 = Fastq(fnames[0], variant='Sanger', paired=True, quiet=True)
+        assert fastq_12.readhits(ret_12['hits']) == fastq.readhits(ret['hits'])
+        assert [fastq_12.readrecordat(hit) for hit in ret_12['hits']] == \
+                [fastq.readrecordat(hit) for hit in ret['hits']]
 
 
     def test_maxerror(self):
@@ -358,6 +384,622 @@ ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT
                     ret = engine.findseqs(self.tfn.name, ['A'*80])
                     assert len(ret['hits']) == n
 
+    def read_records(self):
+        ''' :returns: list of ``(file_pos, bases)`` of all records in
+            the generated ``.fastq`` file '''
+        reads = []
+        records = file(self.tfn.name).read().split('\n')
+        fpos = 0
+        for i, line in enumerate(records):
+            if i % 4 == 1:
+                reads.append((fpos, line))
+            fpos += len(line) + 1
+        return reads
+
+    def brute_force(self, reads, seqs, minoverlap, maxerrors):
+        ''' :returns: hits of ``seqs`` in ``reads`` found by comparing
+            every possible alignment character by character '''
+        expected = []
+        for fpos, read in reads:
+            rl = len(read)
+            for seq_nr, seq in enumerate(seqs):
+                seql = len(seq)
+                def test(a, b, spos, length):
+                    if sum([x != y for x, y in zip(a, b)]) <= maxerrors:
+                        expected.append((seq_nr, fpos, spos, length))
+                if rl > minoverlap and seql > minoverlap:
+                    for i in range(rl - minoverlap, max(0, rl - seql), -1):
+                        test(read[i:], seq, -i, rl - i)
+                    for i in range(seql - minoverlap, max(0, seql - rl - 1), -1):
+                        test(seq[i:], read, i, seql - i)
+                if rl > seql:
+                    for i in range(rl - seql + 1):
+                        test(read[i:i + seql], seq, -i, seql)
+                else:
+                    for i in range(seql - rl + 1):
+                        test(seq[i:i + rl], read, i, rl)
+        return sorted(expected)
+
+    def test_seeds(self):
+        ''' compare hits found using seed index with brute force scan '''
+        fq = FastqGenerator(self.tfn.name, force=True)
+        seqs = [fq.randseq(l) for l in (12, 30, 60, 80, 150)]
+        seqs += [seqs[3], seqs[4][:40]] # identical sequences and prefixes
+        minoverlap = 20
+        readlength = 80
+
+        def mutate(bases, n):
+            bases = list(bases)
+            for i in random.sample(range(len(bases)), n):
+                bases[i] = 'ACGTN'[random.randint(0, 4)]
+            return ''.join(bases)
+
+        for i in range(40):
+            seq = random.choice(seqs)
+            if len(seq) > minoverlap:
+                fq.cover_seq(mutate(seq, random.randint(0, 4)),
+                        minoverlap=minoverlap, readlength=readlength,
+                        left=0, right=0)
+            else:
+                fq.write_seq(fq.randseq(readlength - len(seq)) + seq)
+        fq.flush()
+        reads = self.read_records()
+
+        for maxerrors in range(4):
+            expected = self.brute_force(reads, seqs, minoverlap, maxerrors)
+            engine.config(maxerrors=maxerrors, minoverlap=minoverlap,
+                    minreadlength=minoverlap, Amin='!')
+            hits = engine.findseqs(self.tfn.name, seqs)['hits']
+            assert sorted([hit[:4] for hit in hits]) == expected
+
+    def test_masked(self):
+        ''' N in reads and templates is compared like any other character '''
+        fq = FastqGenerator(self.tfn.name, force=True)
+
+        def mask(bases, positions, c='N'):
+            bases = list(bases)
+            for i in positions:
+                bases[i] = c
+            return ''.join(bases)
+
+        # positions at the start (part of the first seeds), around the
+        # boundaries of the 32-base words and at the end of the sequences
+        seq = fq.randseq(70)
+        masked = mask(seq, (5, 33, 64))
+        seqs = [masked, mask(seq[:40], (0, 39)), mask(seq, (31, 32), '.')]
+
+        reads = []
+        for positions in ((), (0,), (1, 2), (5,), (5, 33, 64), (31, 32),
+                (20, 40), (69,), (0, 69), (33, 63, 64, 65)):
+            reads.append(mask(masked, positions))
+            reads.append(mask(seq, positions))
+        for bases in list(reads):
+            # partial overlaps with N at the ends of the reads
+            reads.append(mask(bases[:30], (0, 29)))
+            reads.append(mask(bases[-30:], (0, 29)))
+            reads.append(mask(bases[10:50], (39,)))
+        for bases in reads:
+            fq.write_seq(bases)
+        fq.flush()
+        reads = self.read_records()
+
+        for minoverlap in (12, 25):
+            for maxerrors in range(4):
+                expected = self.brute_force(reads, seqs, minoverlap, maxerrors)
+                engine.config(maxerrors=maxerrors, minoverlap=minoverlap,
+                        minreadlength=minoverlap, Amin='!')
+                hits = engine.findseqs(self.tfn.name, seqs)['hits']
+                assert sorted([hit[:4] for hit in hits]) == expected
+                assert expected
+
+
+    def test_columnar(self):
+        ''' hits can be returned as arrays '''
+        engine.config(maxerrors=2, minoverlap=25, minreadlength=25, Amin='!',
+                nthreads=2)
+        seqs = ('GAGCATGTGGAGCAACTTGTGGGAGCGCCGGGCAACGCCCTGTCTCTTAT', 'CCCC')
+        ret = engine.findseqs(self.fname, seqs)
+        ret_c = engine.findseqs(self.fname, seqs, columnar=True)
+
+        columns = [ret_c['hits'][field] for field in engine.Hit._fields]
+        assert len(ret['hits']) > 0
+        assert [engine.Hit(*values) for values in zip(*columns)] == list(ret['hits'])
+        data, offsets = ret_c['hitseqs']
+        assert len(offsets) == len(ret['hitseqs']) + 1
+        assert [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)] \
+                == list(ret['hitseqs'])
+        assert ret['stats']['nseqhits'] == ret_c['stats']['nseqhits']
+
+    def test_coverages(self):
+        ''' bases of hits can be counted in engine '''
+        engine.config(maxerrors=2, minoverlap=25, minreadlength=25, Amin='!')
+        seq = genes.Sequence('GAGCATGTGGAGCAACTTGTGGGAGCGCCGGGCAACGCCCTGTCTCTTAT')
+        seqs = (seq.bases, 'CCCC', seq.reverse().bases)
+        mapping = ((0, True), (1, True), (0, False))
+
+        # count bases from hits
+        ret = engine.findseqs(self.fname, seqs)
+        expected = [[0] * 5 * len(seq), [0] * 5 * 4]
+        for hit, hitseq in zip(ret['hits'], ret['hitseqs']):
+            ci, plus = mapping[hit.seq_nr]
+            for i, j in enumerate(range(max(0, hit.seq_pos), max(0, hit.seq_pos) + hit.length)):
+                b = hitseq[i] if plus else genes.Sequence.pairs[hitseq[i]]
+                pos = j if plus else len(seqs[hit.seq_nr]) - 1 - j
+                expected[ci][5 * pos + 'ACGTN'.index(b)] += 1
+        assert sum(expected[0]) > 0
+
+        for nthreads in (1, 3):
+            engine.config(nthreads=nthreads)
+            ret_c = engine.findseqs(self.fname, seqs, coverages=mapping)
+            assert 'hits' not in ret_c
+            assert [list(counts) for counts in ret_c['coverages']] == expected
+            assert ret_c['stats']['nseqhits'] == ret['stats']['nseqhits']
+            assert ret_c['stats']['nseqbasehits'] == ret['stats']['nseqbasehits']
+
+        self.assertRaises(ValueError, engine.findseqs, self.fname, seqs,
+                coverages=((0, True), (0, True), (0, False)))
+        self.assertRaises(TypeError, engine.findseqs, self.fname, seqs,
+                coverages=((0, True),))
+
+    def test_findseqs_iter(self):
+        ''' hits can be consumed in batches while scanning '''
+        engine.config(maxerrors=2, minoverlap=25, minreadlength=25, Amin='!')
+        seq = genes.Sequence('GAGCATGTGGAGCAACTTGTGGGAGCGCCGGGCAACGCCCTGTCTCTTAT')
+        seqs = (seq.bases, 'CCCC', seq.reverse().bases)
+        mapping = ((0, True), (1, True), (0, False))
+        ret = engine.findseqs(self.fname, seqs)
+        ret_c = engine.findseqs(self.fname, seqs, coverages=mapping)
+
+        for nthreads in (1, 3):
+            engine.config(nthreads=nthreads)
+
+            batches = list(engine.findseqs_iter(self.fname, seqs,
+                    batchsize=10, maxbatches=1))
+            assert len(batches) > 1
+            hits = sum([list(zip(batch['hits'], batch['hitseqs']))
+                    for batch in batches], [])
+            assert sorted(hits) == sorted(zip(ret['hits'], ret['hitseqs']))
+            assert engine.stats()['nseqhits'] == ret['stats']['nseqhits']
+
+            counts = [[0] * len(coverage) for coverage in ret_c['coverages']]
+            for batch in engine.findseqs_iter(self.fname, seqs,
+                    coverages=mapping, batchsize=10):
+                for ci, delta in batch['coverages'].items():
+                    counts[ci] = [x + y for x, y in zip(counts[ci], delta)]
+            assert counts == [list(coverage) for coverage in ret_c['coverages']]
+
+            # hits of all batches merged by the engine
+            batches = engine.findseqs_iter(self.fname, seqs, columnar=True,
+                    batchsize=10, maxbatches=1, merge=True)
+            self.assertRaises(RuntimeError, batches.merged)
+            assert len(list(batches)) > 1
+            merged = batches.merged()
+            ret_m = engine.findseqs(self.fname, seqs, columnar=True)
+            for field in engine.Hit._fields:
+                assert list(merged['hits'][field]) == list(ret_m['hits'][field])
+            assert [list(x) for x in merged['hitseqs']] == \
+                    [list(x) for x in ret_m['hitseqs']]
+            self.assertRaises(ValueError, batches.merged)
+
+        batches = engine.findseqs_iter(self.fname, seqs)
+        list(batches)
+        self.assertRaises(ValueError, batches.merged)
+        self.assertRaises(ValueError, engine.findseqs_iter, self.fname, seqs,
+                coverages=mapping, merge=True)
+
+        # abandoned iteration stops scanning
+        batches = engine.findseqs_iter(self.fname, seqs, batchsize=10, maxbatches=1)
+        batches.next()
+        del batches
+        assert engine.findseqs(self.fname, seqs)['hits'] == ret['hits']
+
+    def test_threads(self):
+        ''' scanning threads get chunks from reader thread '''
+        engine.config(maxerrors=2, minoverlap=25, minreadlength=25, Amin='!')
+        seqs = ('GAGCATGTGGAGCAACTTGTGGGAGCGCCGGGCAACGCCCTGTCTCTTAT', 'CCCC')
+        for fname in (self.fname, self.fname + '.gz'):
+            engine.config(nthreads=1)
+            ret_1 = engine.findseqs(fname, seqs)
+            engine.config(nthreads=4)
+            ret_4 = engine.findseqs(fname, seqs)
+            assert sorted(ret_1['hits']) == sorted(ret_4['hits'])
+            assert ret_1['stats']['records_parsed'] == ret_4['stats']['records_parsed']
+            assert ret_1['stats']['nseqhits'] == ret_4['stats']['nseqhits']
+
+            # hits of all threads are merged in file order
+            assert ret_1['hits'] == ret_4['hits']
+            assert ret_1['hitseqs'] == ret_4['hitseqs']
+            assert [hit.file_pos for hit in ret_4['hits']] == \
+                    sorted([hit.file_pos for hit in ret_4['hits']])
+            assert len(ret_4['hits']) > 0
+            for stats in (ret_1['stats'], ret_4['stats']):
+                assert stats['reader_stall'] >= 0 and stats['worker_stall'] >= 0
+
+    def test_gz_ranges(self):
+        ''' rescanning .gz file inflates ranges in parallel '''
+        fq = FastqGenerator(self.tfn.name, force=True)
+        seqs = [fq.randseq(60) for i in range(5)]
+        for i in range(1000):
+            if i % 10:
+                fq.write_seq(fq.randseq(100))
+            else:
+                fq.cover_seq(seqs[i % 5], minoverlap=25, readlength=100)
+        fq.fd.close()
+
+        # > 2 checkpoints (GZ_CHECKPOINT_SPACING)
+        records = file(self.tfn.name).read()
+        fname = self.tfn.name + '.gz'
+        f = gzip.GzipFile(fname, 'wb', compresslevel=1)
+        for i in range(20 * 1024**2 / len(records) + 1):
+            f.write(records)
+        f.close()
+
+        try:
+            engine.config(maxerrors=1, minoverlap=25, minreadlength=25,
+                    Amin='!', nthreads=1)
+            ret_1 = engine.findseqs(fname, seqs)
+            # only indexed when configured
+            engine.config(nthreads=3)
+            ret_3 = engine.findseqs(fname, seqs)
+            engine.config(nthreads=1, gzindex=1)
+            assert engine.get_config()['gzindex'] == 1
+            engine.findseqs(fname, seqs)
+            engine.config(nthreads=3)
+            ret_3i = engine.findseqs(fname, seqs)
+        finally:
+            os.remove(fname)
+
+        assert len(ret_1['hits']) > 0
+        for ret in (ret_3, ret_3i):
+            assert sorted(ret_1['hits']) == sorted(ret['hits'])
+            for key in ('records_parsed', 'readlengths', 'nseqhits'):
+                assert ret_1['stats'][key] == ret['stats'][key]
+        assert ret_3i['stats']['total'] == ret_3i['stats']['parsed']
+
+    def test_mapped(self):
+        ''' .fastq files are scanned in ranges with identical file positions '''
+        random.seed(7)
+        seqs = [''.join(random.choice('ACGT') for j in range(60)) for i in range(5)]
+        fd = file(self.tfn.name, 'w')
+        for i in range(3000):
+            read = ''.join(random.choice('ACGT') for j in range(100))
+            if i % 10 == 0:
+                offset = random.randint(-30, 70)
+                seq = seqs[i % 5]
+                read = (read[:max(0, offset)] + seq[max(0, -offset):] + read)[:100]
+            # PHRED scores starting with '@' or '+' look like record boundaries
+            score = random.choice('@+I') + 'I' * 99
+            fd.write('@read%d\n%s\n+\n%s\n' % (i, read, score))
+        fd.close()
+
+        fname = self.tfn.name + '.gz'
+        f = gzip.GzipFile(fname, 'wb')
+        f.write(file(self.tfn.name).read())
+        f.close()
+
+        try:
+            engine.config(maxerrors=1, minoverlap=25, minreadlength=25,
+                    Amin='!', nthreads=1)
+            ret_gz = engine.findseqs(fname, seqs)
+        finally:
+            os.remove(fname)
+        ret = {}
+        for nthreads in (1, 4):
+            engine.config(nthreads=nthreads)
+            ret[nthreads] = engine.findseqs(self.tfn.name, seqs)
+
+        assert len(ret_gz['hits']) > 0
+        for nthreads in (1, 4):
+            assert sorted(ret_gz['hits']) == sorted(ret[nthreads]['hits'])
+            for key in ('records_parsed', 'readlengths', 'nseqhits'):
+                assert ret_gz['stats'][key] == ret[nthreads]['stats'][key]
+            assert ret[nthreads]['stats']['total'] == os.path.getsize(self.tfn.name)
+            assert ret[nthreads]['stats']['parsed'] == os.path.getsize(self.tfn.name)
+
+    def test_maxcoverage(self):
+        ''' sequences are retired when reaching maxcoverage '''
+        random.seed(3)
+        seqs = [''.join(random.choice('ACGT') for j in range(60)) for i in range(3)]
+        fd = file(self.tfn.name, 'w')
+        for i in range(5000):
+            read = ''.join(random.choice('ACGT') for j in range(100))
+            # seqs[2] is only found in the second half of the file
+            if i % 10 == 0 and (i % 30 != 20 or i > 2500):
+                read = read[:20] + seqs[i % 3] + read[80:]
+            fd.write('@read%d\n%s\n+\n%s\n' % (i, read, 'I' * 100))
+        fd.close()
+
+        engine.config(maxerrors=0, minoverlap=25, minreadlength=25)
+        full = engine.findseqs(self.tfn.name, seqs)['stats']
+        assert full['nretired'] == 0
+
+        for nthreads in (1, 3):
+            engine.config(nthreads=nthreads, maxcoverage=10)
+            stats = engine.findseqs(self.tfn.name, seqs)['stats']
+            assert stats['nretired'] == 3
+            assert stats['records_parsed'] < full['records_parsed']
+            for i in range(3):
+                assert 10 <= stats['nseqhits'][i] < full['nseqhits'][i]
+
+            # seqs[2] is not retired : whole file is scanned
+            engine.config(maxcoverage=100)
+            stats = engine.findseqs(self.tfn.name, seqs)['stats']
+            assert stats['nretired'] == 2
+            assert stats['records_parsed'] == full['records_parsed']
+            assert stats['nseqhits'][2] == full['nseqhits'][2]
+            assert stats['nseqhits'][0] < full['nseqhits'][0]
+
+    def test_maxcoverage_templates(self):
+        ''' sequences of the same template are retired together '''
+        random.seed(4)
+        a, b = [''.join(random.choice('ACGT') for j in range(60)) for i in range(2)]
+        seqs = (a, b, genes.Sequence(a).reverse().bases)
+        fd = file(self.tfn.name, 'w')
+        for i in range(5000):
+            read = ''.join(random.choice('ACGT') for j in range(100))
+            # the reverse complement of a alone never reaches maxcoverage
+            if i % 10 < 2 or (i % 100 == 3 and i < 900):
+                read = read[:20] + seqs[i % 10 if i % 10 < 2 else 2] + read[80:]
+            fd.write('@read%d\n%s\n+\n%s\n' % (i, read, 'I' * 100))
+        fd.close()
+
+        engine.config(maxerrors=0, minoverlap=25, minreadlength=25)
+        full = engine.findseqs(self.tfn.name, seqs)['stats']
+        assert full['nseqhits'][2] == 9
+
+        for nthreads in (1, 3):
+            engine.config(nthreads=nthreads, maxcoverage=10)
+            stats = engine.findseqs(self.tfn.name, seqs)['stats']
+            assert stats['nretired'] == 2
+            assert stats['records_parsed'] == full['records_parsed']
+
+            stats = engine.findseqs(self.tfn.name, seqs, templates=(0, 1, 0))['stats']
+            assert stats['nretired'] == 2
+            assert stats['records_parsed'] < full['records_parsed']
+
+            # templates default to coverages
+            stats = engine.findseqs(self.tfn.name, seqs,
+                    coverages=((0, True), (1, True), (0, False)))['stats']
+            assert stats['nretired'] == 2
+            assert stats['records_parsed'] < full['records_parsed']
+
+        self.assertRaises(ValueError, engine.findseqs, self.tfn.name, seqs,
+                templates=(0, 1, 3))
+        self.assertRaises(TypeError, engine.findseqs, self.tfn.name, seqs,
+                templates=(0, 1))
+
+    def test_sample(self):
+        ''' subsampled records do not depend on threads or compression '''
+        random.seed(4)
+        seqs = [''.join(random.choice('ACGT') for j in range(60)) for i in range(3)]
+        fd = file(self.tfn.name, 'w')
+        for i in range(10000):
+            read = ''.join(random.choice('ACGT') for j in range(100))
+            if i % 10 == 0:
+                read = read[:20] + seqs[i % 3] + read[80:]
+            fd.write('@read%d\n%s\n+\n%s\n' % (i, read, 'I' * 100))
+        fd.close()
+        fname = self.tfn.name + '.gz'
+        gz = gzip.open(fname, 'wb')
+        gz.write(file(self.tfn.name).read())
+        gz.close()
+
+        def hits(fname, **kwargs):
+            engine.config(**kwargs)
+            ret = engine.findseqs(fname, seqs)
+            return sorted(ret['hits']), ret['stats']
+
+        try:
+            engine.config(maxerrors=0, minoverlap=25, minreadlength=25)
+            full, stats = hits(self.tfn.name)
+            assert stats['sampled'] == 1
+
+            assert stats['records_parsed'] == stats['records_sampled'] == 10000
+
+            sample, stats = hits(self.tfn.name, sample=.5, seed=1)
+            assert 0 < len(sample) < len(full)
+            assert set(sample) <= set(full)
+            assert 0 < stats['records_sampled'] < 10000
+            assert stats['records_sampled'] <= stats['records_parsed']
+            assert .2 < stats['sampled'] < .8
+            assert engine.get_config()['seed'] == 1
+
+            # compressed files are parsed completely
+            stats = hits(fname, sample=.5, seed=1)[1]
+            assert stats['records_parsed'] == 10000
+            assert 0 < stats['records_sampled'] < 10000
+
+            for nthreads in (1, 3):
+                for name in (self.tfn.name, fname):
+                    assert hits(name, sample=.5, seed=1, nthreads=nthreads)[0] == sample
+
+            assert hits(self.tfn.name, sample=.5, seed=2)[0] != sample
+            assert hits(self.tfn.name, sample=1)[0] == full
+
+            for sample in (0, -.5, 1.5):
+                self.assertRaises(ValueError, engine.config, sample=sample)
+            assert engine.get_config()['sample'] == 1
+        finally:
+            os.unlink(fname)
+
+    def test_scanners(self):
+        ''' scanners with different configurations scan concurrently '''
+        random.seed(5)
+        seqs = [''.join(random.choice('ACGT') for j in range(60)) for i in range(3)]
+        fd = file(self.tfn.name, 'w')
+        for i in range(5000):
+            read = ''.join(random.choice('ACGT') for j in range(100))
+            if i % 10 == 0:
+                read = read[:20] + seqs[i % 3] + read[80:]
+                if i % 20 == 0:
+                    read = read[:50] + 'ACGT'[('ACGT'.index(read[50]) + 1) % 4] + read[51:]
+            fd.write('@read%d\n%s\n+\n%s\n' % (i, read, 'I' * 100))
+        fd.close()
+
+        configs = [dict(maxerrors=0, minoverlap=25, nthreads=1),
+                dict(maxerrors=1, minoverlap=25, nthreads=2),
+                dict(maxerrors=1, minoverlap=25, nthreads=1, sample=.5, seed=3)]
+        scanners = [engine.Scanner(**config) for config in configs]
+        assert scanners[1].get_config()['maxerrors'] == 1
+        assert engine.get_config()['maxerrors'] == 2
+
+        expected = [sorted(scanner.findseqs(self.tfn.name, seqs)['hits'])
+                for scanner in scanners]
+        assert 0 < len(expected[0]) < len(expected[1])
+        assert len(expected[2]) < len(expected[1])
+
+        results = [None] * len(scanners)
+        def scan(i):
+            results[i] = scanners[i].findseqs(self.tfn.name, seqs)
+        threads = [threading.Thread(target=scan, args=(i,))
+                for i in range(len(scanners))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(len(scanners)):
+            assert sorted(results[i]['hits']) == expected[i]
+            assert results[i]['stats']['records_parsed'] == \
+                    scanners[i].stats()['records_parsed']
+        assert results[0]['stats']['records_parsed'] == 5000
+
+        # module functions use the default scanner
+        engine.config(maxerrors=1)
+        assert sorted(engine.findseqs(self.tfn.name, seqs)['hits']) == expected[1]
+        assert engine.default_scanner.get_config()['maxerrors'] == 1
+
+    def test_bgzf(self):
+        ''' BGZF files are inflated in parallel blockwise '''
+        fq = FastqGenerator(self.tfn.name, force=True)
+        seqs = [fq.randseq(60) for i in range(5)]
+        for i in range(1000):
+            if i % 10:
+                fq.write_seq(fq.randseq(100))
+            else:
+                fq.cover_seq(seqs[i % 5], minoverlap=25, readlength=100)
+        fq.fd.close()
+
+        # blocks are not aligned with records; > 2 checkpoints
+        records = file(self.tfn.name).read()
+        data = records * (20 * 1024**2 / len(records) + 1)
+        fname = self.tfn.name + '.gz'
+        f = file(fname, 'wb')
+        for i in range(0, len(data), 65280) + [len(data)]:
+            block = data[i:i + 65280]
+            deflater = zlib.compressobj(1, zlib.DEFLATED, -15)
+            deflated = deflater.compress(block) + deflater.flush()
+            f.write('\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0')
+            f.write(struct.pack('<H', len(deflated) + 25))
+            f.write(deflated)
+            f.write(struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+        f.close()
+
+        try:
+            engine.config(maxerrors=1, minoverlap=25, minreadlength=25,
+                    Amin='!', nthreads=1)
+            ret_1 = engine.findseqs(fname, seqs)
+            engine.config(nthreads=3)
+            ret_3 = engine.findseqs(fname, seqs)
+        finally:
+            os.remove(fname)
+
+        assert len(ret_1['hits']) > 0
+        assert sorted(ret_1['hits']) == sorted(ret_3['hits'])
+        for key in ('records_parsed', 'readlengths', 'nseqhits'):
+            assert ret_1['stats'][key] == ret_3['stats'][key]
+        for ret in (ret_1, ret_3):
+            assert ret['stats']['total'] == len(data)
+            assert ret['stats']['parsed'] == len(data)
+
+    def test_sigints(self):
+        ''' every scanner counts <CTRL-C> since the beginning of its own scan '''
+        if not hasattr(signal, 'SIGINT') or os.name == 'nt':
+            return
+        scanners = [engine.Scanner(nthreads=1, Amin='!') for i in range(2)]
+        idle = engine.Scanner()
+
+        os.kill(os.getpid(), signal.SIGINT)
+        batches1 = scanners[0].findseqs_iter(self.fname, ['CCCC'], batchsize=1)
+        batches1.next()
+        assert scanners[0].stats()['sigints'] == 0
+        os.kill(os.getpid(), signal.SIGINT)
+        assert scanners[0].stats()['sigints'] == 1
+
+        # a concurrent scan does not reset the count of the first one
+        batches2 = scanners[1].findseqs_iter(self.fname, ['CCCC'], batchsize=1)
+        batches2.next()
+        os.kill(os.getpid(), signal.SIGINT)
+        assert scanners[0].stats()['sigints'] == 2
+        assert scanners[1].stats()['sigints'] == 1
+        assert idle.stats()['sigints'] == 3
+        list(batches1)
+        list(batches2)
+
+        # neither does a subsequent scan
+        scanners[0].findseqs(self.fname, ['CCCC'])
+        assert scanners[0].stats()['sigints'] == 0
+        assert scanners[1].stats()['sigints'] == 1
+
+    def test_gz_size(self):
+        ''' size of inflated data is read from gzip trailer before scanning '''
+        records = file(self.fname).read()
+        data = records * 20
+        fname = self.tfn.name + '.gz'
+        f = gzip.GzipFile(fname, 'wb')
+        f.write(data)
+        f.close()
+
+        try:
+            scanner = engine.Scanner()
+            scanner.config(nthreads=1, Amin='!')
+            batches = scanner.findseqs_iter(fname, ['CCCC'], batchsize=1)
+            batches.next()
+            assert scanner.stats()['total'] == len(data)
+            del batches
+
+            # several members : exact once the file was inflated
+            f = file(fname, 'wb')
+            for i in range(3):
+                gz = gzip.GzipFile(fileobj=f, mode='wb')
+                gz.write(data * (i + 1))
+                gz.close()
+            f.close()
+            assert engine.inflated_size(fname) != 6 * len(data)
+            list(scanner.findseqs_iter(fname, ['CCCC'], batchsize=1))
+            stats = scanner.stats()
+            assert stats['total'] == stats['parsed'] == 6 * len(data)
+            assert stats['progress'] == 1
+        finally:
+            os.remove(fname)
+
+    def test_stream(self):
+        ''' plain and gzipped data are read from a pipe '''
+        seqs = ('CCC', 'TTTT', 'TGTAG', 'ATATT')
+        engine.config(maxerrors=0, minoverlap=1000, minreadlength=3, Amin='!')
+        records = file(self.fname).read()
+        hits = engine.findseqs(self.fname, seqs)['hits']
+
+        for data, n in ((records, 1),
+                # two gzip members
+                (2 * file(self.fname + '.gz', 'rb').read(), 2)):
+            r, w = os.pipe()
+            def feed():
+                os.write(w, data)
+                os.close(w)
+            feeder = threading.Thread(target=feed)
+            feeder.start()
+            ret = engine.findseqs(r, seqs)
+            feeder.join()
+
+            assert ret['hits'] == tuple([hit._replace(file_pos=hit.file_pos + i*len(records))
+                    for i in range(n) for hit in hits])
+            assert ret['stats']['parsed'] == n * len(records)
+            assert ret['stats']['total'] == 0
+
+            # file descriptor is closed when scanning ends
+            self.assertRaises(OSError, os.close, r)
+
 
 if __name__ == '__main__': unittest.main()
 
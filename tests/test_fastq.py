@@ -1,12 +1,17 @@
 
-from kvarq.fastq import Fastq, FastqFileFormatException
+from kvarq import engine
+from kvarq.fastq import Fastq, FastqFileFormatException, inflated_size
 from kvarq.log import lo
 
 import unittest
 import tempfile
 import gzip
+import zlib
+import struct
 import os
 import logging
+import random
+from cStringIO import StringIO
 
 from _util import lo_exceptor
 
@@ -17,6 +22,7 @@ class TestFastq(unittest.TestCase):
         #set_debug()
         #set_warning()
         self.gz = False
+        self.stream = False
         self.tfastq = __file__ + '.fastq'
 
     def tearDown(self):
@@ -25,6 +31,8 @@ class TestFastq(unittest.TestCase):
                 os.unlink(self.tfastq + gz)
 
     def ntf_write_fastq(self, content, variant=None):
+        if self.stream:
+            return Fastq(StringIO(self.stream_data(content)), variant=variant)
         ntfn = self.tfastq
         if self.gz:
             ntfn += '.gz'
@@ -37,6 +45,15 @@ class TestFastq(unittest.TestCase):
             ntf.close()
         return Fastq(ntfn, variant=variant)
 
+    def stream_data(self, content):
+        if not self.gz:
+            return content
+        data = StringIO()
+        gzf = gzip.GzipFile(fileobj=data, mode='w')
+        gzf.write(content)
+        gzf.close()
+        return data.getvalue()
+
     def ntf_write_quality(self, quality, variant=None):
         return self.ntf_write_fastq(
                 '@IDENTIFIER\n' +
@@ -134,6 +151,48 @@ ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT
         except FastqFileFormatException:
             pass
 
+    def test_inflated_size(self):
+        record = '@IDENTIFIER\n' + 'A' * 50 + '\n+\n' + '#' * 50 + '\n'
+        fq = self.ntf_write_fastq(record * 1000)
+        assert fq.records_approx == 1000
+        assert fq.inflated_sizes() == fq.filesizes()
+
+        # gzip trailer
+        self.gz = True
+        fq = self.ntf_write_fastq(record * 1000)
+        assert fq.records_approx == 1000
+        assert fq.inflated_sizes() == [len(record) * 1000]
+
+        # blocks of BGZF files
+        f = file(self.tfastq + '.gz', 'wb')
+        for i in range(3):
+            block = record * 100
+            deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = deflater.compress(block) + deflater.flush()
+            f.write('\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0')
+            f.write(struct.pack('<H', len(deflated) + 25))
+            f.write(deflated)
+            f.write(struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block)))
+        f.close()
+        assert inflated_size(self.tfastq + '.gz') == len(record) * 300
+        assert Fastq(self.tfastq + '.gz').records_approx == 300
+
+        # blocks are only read once
+        engine_inflated_size = engine.inflated_size
+        def no_inflated_size(fname):
+            raise AssertionError('size computed again')
+        engine.inflated_size = no_inflated_size
+        try:
+            assert inflated_size(self.tfastq + '.gz') == len(record) * 300
+        finally:
+            engine.inflated_size = engine_inflated_size
+
+        # files too short for a gzip trailer
+        for data in ('', '\x1f\x8b'):
+            file(self.tfastq + '.gz', 'wb').write(data)
+            assert inflated_size(self.tfastq + '.gz') == len(data)
+        self.gz = False
+
     def test_gz(self):
         ''' repeats tests with gzipped fastq files '''
         self.gz = True
@@ -141,5 +200,30 @@ ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT
         self.test_fastq_variant()
         self.gz = False
 
+    def test_stream(self):
+        ''' repeats tests reading plain/gzipped data from streams '''
+        self.stream = True
+        for self.gz in (False, True):
+            self.test_fastq_format()
+            self.test_fastq_variant()
+
+            # head is fed back to engine together with rest of stream
+            rnd = random.Random(42)
+            data = self.stream_data(''.join(['@IDENTIFIER\n%s\n+\n%s\n' % (
+                    ''.join([rnd.choice('ACGT') for i in range(50)]),
+                    ''.join([rnd.choice(Fastq.ASCII[:40]) for i in range(50)]))
+                    for j in range(30000)]))
+            fq = Fastq(StringIO(data), quiet=True)
+            assert len(data) > fq.STREAM_HEAD or not self.gz
+            assert fq.filesizes() == [None] and fq.records_approx is None
+            fd = fq.scan_input()
+            f = os.fdopen(fd, 'rb')
+            assert f.read() == data
+            f.close()
+            self.assertRaises(IOError, fq.scan_input)
+            self.assertRaises(IOError, fq.readrecordat, 0)
+
+        self.gz = self.stream = False
+
 if __name__ == '__main__': unittest.main()
 
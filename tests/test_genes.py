@@ -81,14 +81,14 @@ class GenesTest(unittest.TestCase):
         # no mutations
         assert not snp1000.validate(coverage)
         # not enough coverage
-        coverage.mutations = dict([(25, 'C')])
+        coverage.mutations = dict([(25, 'G')])
         assert not snp1000.validate(coverage)
-        # not enough mutations
+        # not enough mutations (i.e. original base instead of SNP)
         coverage.coverage = [20] * len(coverage.coverage)
-        coverage.mutations = dict([(25, 'C'*10)])
+        coverage.mutations = dict([(25, 'G'*10)])
         assert not snp1000.validate(coverage)
         # this should validate
-        coverage.mutations = dict([(25, 'C')])
+        coverage.mutations = dict([(25, 'G')])
         assert snp1000.validate(coverage)
 
         # then test mutation filtering of TemplateFromGenome
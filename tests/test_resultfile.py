@@ -0,0 +1,107 @@
+
+import unittest
+import os, os.path
+import tempfile
+import shutil
+import json
+
+from kvarq import resultfile
+from kvarq.engine import FILE_POS_BITS
+from kvarq.legacy import convert_legacy_data
+from kvarq.util import JsonSummary
+
+
+class ResultfileTest(unittest.TestCase):
+
+    ''' tests :py:mod:`kvarq.resultfile` '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = dict(
+                analyses={'phylo': 'lineage 2', 'spoligo': ['1', '0']},
+                info={'format': 'kvarq', 'version': '0.12.2', 'size': [1234],
+                    'scantime': 12.5, 'fastq': ['sample.fastq']},
+                stats={'readlengths': [0, 3, 5], 'records_parsed': 8},
+                coverages=[('SNP1', '0-1-2-3 1[AT]-3[CCN]'),
+                    ('SNP2', '5-5-0-12-4 ')],
+                hits=[[0, 17, 1, 2, 2], [1, 2**40, 0, 3, 3]],
+                hitseqs=['AC', 'NTT'],
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_convert(self):
+
+        ''' json -> kvarq -> json does not lose any information '''
+
+        jpath = os.path.join(self.tmpdir, 'sample.json')
+        kpath = os.path.join(self.tmpdir, 'sample.kvarq')
+        jpath2 = os.path.join(self.tmpdir, 'sample2.json')
+
+        resultfile.dump(self.data, jpath)
+        assert not resultfile.is_binary(jpath)
+        resultfile.dump(resultfile.load(jpath), kpath)
+        assert resultfile.is_binary(kpath)
+        resultfile.dump(resultfile.load(kpath), jpath2)
+
+        assert json.load(file(jpath2)) == json.load(file(jpath))
+
+        data = resultfile.load(kpath)
+        assert data['analyses'] == self.data['analyses']
+        coverage, mutations = data['coverages'][0][1]
+        assert list(coverage) == [0, 1, 2, 3]
+        assert mutations == {1: 'AT', 3: 'CCN'}
+        assert list(data['hits']['file_pos']) == [17, 2**40]
+        seqs, offsets = data['hitseqs']
+        assert seqs == 'ACNTT' and list(offsets) == [0, 2, 5]
+
+        # without hits
+        del self.data['hits'], self.data['hitseqs']
+        resultfile.dump(self.data, kpath)
+        assert 'hits' not in resultfile.load(kpath)
+
+    def test_summary(self):
+
+        jpath = os.path.join(self.tmpdir, 'sample.json')
+        kpath = os.path.join(self.tmpdir, 'sample.kvarq')
+        resultfile.dump(self.data, jpath)
+        resultfile.dump(self.data, kpath)
+
+        js = JsonSummary()
+        js.add(jpath)
+        js.add(kpath)
+        row = js.data[jpath]
+        del row['filename']
+        assert js.data[kpath] == dict(row, filename=kpath)
+        assert row['filesize'] == 1234
+
+    def test_legacy_file_pos(self):
+
+        ''' file_pos of hits in second paired file of old files are converted '''
+
+        self.data['info'].update(fastq=['x_1.fastq', 'x_2.fastq'], size=[100, 80],
+                version='0.12.2')
+        self.data['hits'] = [[0, 17, 1, 2, 2], [1, 120, 0, 3, 3]]
+        positions = [17, (1 << FILE_POS_BITS) + 20]
+
+        kpath = os.path.join(self.tmpdir, 'sample.kvarq')
+        resultfile.dump(self.data, kpath)
+        data = convert_legacy_data({}, resultfile.load(kpath))
+        assert list(data['hits']['file_pos']) == positions
+        assert data['info']['file_pos_bits'] == FILE_POS_BITS
+
+        data = convert_legacy_data({}, json.loads(json.dumps(self.data)))
+        assert [hit[1] for hit in data['hits']] == positions
+        # (new files are not converted again)
+        assert convert_legacy_data({}, data)['hits'] == data['hits']
+
+        # inflated size of .gz files is unknown
+        self.data['info']['fastq'] = ['x_1.fastq.gz', 'x_2.fastq.gz']
+        data = convert_legacy_data({}, json.loads(json.dumps(self.data)))
+        assert 'hits' not in data and 'hitseqs' not in data
+        assert data['coverages']
+
+
+if __name__ == '__main__': unittest.main()
+